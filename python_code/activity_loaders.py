@@ -0,0 +1,202 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from ride_ingestion import file_md5
+from instrumentation import instrumented
+
+# typed loaders of the Golden Cheetah aggregate exports of 0. Data exploration.ipynb and 5. Training stress
+# calculations.ipynb: Activities.csv (one row per ride, hundreds of metrics) and GC_PMC_CP_data.csv (one row per day).
+# Only the requested columns are parsed, dates use a fixed format and the result is cached as parquet until the
+# content of the export changes
+
+# bump this version when the parsing changes, so all cached files are invalidated
+LOADER_VERSION = 1
+
+# columns of the activities used in the notebooks, with the names after normalization (stripped, spaces as _)
+ACTIVITY_COLUMNS = ['date', 'time', 'filename', 'Average_Cadence', 'Average_Power', 'BikeScore', 'Duration',
+                    'Relative_Intensity', 'Nonzero_Average_Power', 'Time_Moving', 'TRIMP(100)_Points', 'TRIMP_Points',
+                    'TRIMP_Zonal_Points', 'xPower']
+
+# text columns of the activities, all other columns are read as float64
+ACTIVITY_TEXT_COLUMNS = ['date', 'time', 'filename']
+
+# month abbreviations of the PMC export. The export follows the language of Golden Cheetah (Dutch here),
+# the English abbreviations which differ are accepted too
+MONTHS = {'jan': '01', 'feb': '02', 'mrt': '03', 'apr': '04', 'mei': '05', 'jun': '06', 'jul': '07', 'aug': '08',
+          'sep': '09', 'okt': '10', 'nov': '11', 'dec': '12', 'mar': '03', 'may': '05', 'oct': '10'}
+
+CACHE_MANIFEST_NAME = '_cache_manifest.json'
+
+
+def normalize_column(name):
+    # column names of the notebooks: stripped and every whitespace run replaced by _
+    return '_'.join(name.split())
+
+
+def _raw_header(path, sep):
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\n').split(sep)
+    # the export ends the header with a separator, which gives an unnamed empty column
+    return {normalize_column(name): name for name in header if name.strip()}
+
+
+def _source_md5(path, cache_dir):
+    # md5 of the source file, only hashed again when its mtime or size changed
+    manifest_path = os.path.join(cache_dir, CACHE_MANIFEST_NAME)
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+
+    stat = os.stat(path)
+    key = os.path.abspath(path)
+    entry = manifest.get(key)
+    if entry is not None and entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+        return entry['md5']
+
+    manifest[key] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'md5': file_md5(path)}
+    with open(manifest_path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(manifest_path + '.tmp', manifest_path)
+    return manifest[key]['md5']
+
+
+def _cached(path, cache_dir, name, columns, parse):
+    # parse the source, or read the parquet file of an earlier parse of the same content and columns
+    if cache_dir is None:
+        return parse()
+    os.makedirs(cache_dir, exist_ok=True)
+    key = hashlib.sha1(json.dumps([LOADER_VERSION, _source_md5(path, cache_dir), columns]).encode('utf-8'))
+    cache_path = os.path.join(cache_dir, '{}_{}.parquet'.format(name, key.hexdigest()[:16]))
+    if os.path.exists(cache_path):
+        return pd.read_parquet(cache_path)
+
+    df = parse()
+    df.to_parquet(cache_path + '.tmp', index=True)
+    os.replace(cache_path + '.tmp', cache_path)
+    return df
+
+
+def ride_start_keys(filenames):
+    '''
+    Returns the start time of rides from their Golden Cheetah filename (e.g. 2017_02_24_20_56_22.csv or .json).
+    Only the unique filenames are parsed
+
+            Parameters:
+                    filenames: pandas Series (categorical or text) or array with filenames
+            Returns:
+                    numpy datetime64 array with the start time of every filename (NaT when it is no GC filename)
+    '''
+    codes, uniques = pd.factorize(np.asarray(filenames, dtype=object))
+    starts = pd.to_datetime(pd.Series(uniques, dtype=object).str[:19], format='%Y_%m_%d_%H_%M_%S',
+                            errors='coerce').to_numpy()
+    out = starts[codes]
+    out[codes < 0] = np.datetime64('NaT')
+    return out
+
+
+@instrumented(rows_arg=None)
+def read_activities(path, columns=ACTIVITY_COLUMNS, cache_dir=None):
+    '''
+    Returns a pandas DataFrame with a subset of the columns of the Golden Cheetah Activities.csv export, with
+    the preprocessing of the notebooks: parsed dates, csv filenames and the start hour of the activity
+
+            Parameters:
+                    path (str): path of Activities.csv
+                    columns (list): normalized column names to read (e.g. 'TRIMP_Points'), default = ACTIVITY_COLUMNS.
+                                    'date', 'time' and 'filename' are always read
+                    cache_dir (str): directory of the parquet cache, default = None (no caching)
+            Returns:
+                    df: pandas DataFrame with the columns, 'start_hour_of_day_activity' and 'ride_start', the start
+                        time from the filename to join rides on (see join_activities)
+    '''
+    columns = list(dict.fromkeys(ACTIVITY_TEXT_COLUMNS + list(columns)))
+
+    def parse():
+        raw_names = _raw_header(path, ',')
+        missing = [name for name in columns if name not in raw_names]
+        if missing:
+            raise ValueError('columns not in {}: {}'.format(path, missing))
+        dtypes = {raw_names[name]: str if name in ACTIVITY_TEXT_COLUMNS else np.float64 for name in columns}
+
+        df = pd.read_csv(path, usecols=list(dtypes), dtype=dtypes)
+        df.columns = [normalize_column(name) for name in df.columns]
+        df = df[columns]
+
+        df['date'] = pd.to_datetime(df['date'].str.strip(), format='%m/%d/%y')
+        df['filename'] = df['filename'].str.strip().str.replace('json', 'csv', regex=False)
+
+        # add hour of day as variable (when .30 round back, otherwise to next hour)
+        time = pd.to_datetime(df['time'].str.strip(), format='%H:%M:%S')
+        df['start_hour_of_day_activity'] = (time.dt.hour + (time.dt.minute > 30)).astype(np.int64)
+        df['ride_start'] = ride_start_keys(df['filename'])
+        return df
+
+    return _cached(path, cache_dir, 'activities', columns, parse)
+
+
+@instrumented(rows_arg=None)
+def read_pmc_cp(path, columns=None, cache_dir=None):
+    '''
+    Returns a pandas DataFrame of the Golden Cheetah PMC / CP export (GC_PMC_CP_data.csv) with a parsed date index
+
+            Parameters:
+                    path (str): path of the ';' separated export with dates like 'jan 01 2017'
+                    columns (list): normalized column names to read (e.g. 'CP_(Ext)'), default = all columns
+                    cache_dir (str): directory of the parquet cache, default = None (no caching)
+            Returns:
+                    df: pandas DataFrame with a 'Date' DatetimeIndex and float64 columns
+    '''
+    def parse():
+        raw_names = _raw_header(path, ';')
+        names = [name for name in raw_names if name != 'Date' and (columns is None or name in columns)]
+        missing = [name for name in (columns or []) if name not in raw_names]
+        if missing:
+            raise ValueError('columns not in {}: {}'.format(path, missing))
+        dtypes = {raw_names['Date']: str}
+        dtypes.update({raw_names[name]: np.float64 for name in names})
+
+        df = pd.read_csv(path, sep=';', usecols=list(dtypes), dtype=dtypes)
+        df.columns = [normalize_column(name) for name in df.columns]
+
+        # replace the month name by its number, then one fixed format parse
+        date = df['Date'].str.strip().str.lower()
+        months = date.str[:3].map(MONTHS)
+        if months.isna().any():
+            raise ValueError('unknown month names in {}: {}'.format(path, sorted(date[months.isna()].str[:3].unique())))
+        df['Date'] = pd.to_datetime(months + date.str[3:], format='%m %d %Y')
+        return df.set_index('Date')[names]
+
+    return _cached(path, cache_dir, 'pmc_cp', columns, parse)
+
+
+def join_activities(df, df_activities, columns=None):
+    '''
+    Returns the activity columns aligned with the records (or rides) of a frame, joined on the ride start time
+    from the filename. Every filename is looked up once instead of merging on the text of every record
+
+            Parameters:
+                    df: pandas DataFrame with 'filename' (e.g. second by second data or ride statistics)
+                    df_activities: pandas DataFrame from read_activities
+                    columns (list): activity columns to join, default = all except the keys
+            Returns:
+                    df: pandas DataFrame with the activity columns and the index of df (NaN for unknown rides)
+    '''
+    columns = columns or [c for c in df_activities.columns if c not in ['filename', 'ride_start']]
+    codes, uniques = pd.factorize(np.asarray(df['filename'], dtype=object))
+
+    # position of every unique filename in the activities (the first activity of a start time), -1 when unknown
+    keys = df_activities['ride_start']
+    first = np.flatnonzero((~keys.duplicated() & keys.notna()).to_numpy())
+    positions = pd.Index(keys.to_numpy()[first]).get_indexer(ride_start_keys(uniques))
+    positions = np.where(positions >= 0, first[positions], -1)
+    rows = np.where(codes >= 0, positions[codes], -1)
+
+    out = df_activities[columns].iloc[np.maximum(rows, 0)].reset_index(drop=True)
+    out = out.where(pd.Series(rows >= 0))
+    out.index = df.index
+    return out
@@ -0,0 +1,292 @@
+import io
+import os
+import json
+import time
+import shutil
+import platform
+import tempfile
+import argparse
+import datetime
+import subprocess
+import contextlib
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+
+from synthetic_rides import synthetic_rides, write_synthetic_rides
+from ride_ingestion import read_ride_file
+from ride_segments import ride_segments
+from ride_feature_cache import preprocess_ride
+from ride_stats_calculation import ride_stats_calculation
+from reduce_memory import reduce_mem_usage
+from feature_generation import simple_cycling_features, build_feature_block, build_feature_frame
+from model_performance_rides import metrics_feat_sel
+from lightgbm_nested_cv_runner import run_nested_cv
+from lightgbm_hyperparam_nested_cv_proc import lightgbm_hyperparam_nested_cv_proc
+
+# benchmarks of the pipeline stages on synthetic rides (see synthetic_rides.py) at growing numbers of records.
+# Every stage is timed without and memory profiled with tracemalloc, and the results are written to a JSON file
+# per commit, so two runs can be compared with compare_benchmarks
+
+ROW_COUNTS = [10**3, 10**4, 10**5, 10**6, 10**7]
+
+RIDER_PARAMS = {'rider_min_hr': 40, 'rider_max_hr': 200, 'rider_max_watts': 1500, 'rider_max_cad': 130}
+
+# small tuning configuration: the benchmark measures the scaling with the records, not the search
+TUNING = {'num_boost_round': 20, 'n_iter': 4, 'number_inner_splits': 3, 'number_outer_splits': 3}
+
+# the nested cv needs enough rides for its group folds
+MIN_RIDES = 10
+
+
+def _preprocessed(ctx):
+    # the row level preprocessing of 0. Data exploration.ipynb on all rides
+    if 'preprocessed' not in ctx:
+        df = ctx['df']
+        # the synthetic rides are contiguous, so a ride is a slice of the frame
+        order, names, starts, ends = ride_segments(df['filename'])
+        df_pre = pd.concat([preprocess_ride(df.iloc[start:end], RIDER_PARAMS) for start, end in zip(starts, ends)])
+        ctx['preprocessed'] = pd.concat([df.drop(columns=['hr']), df_pre], axis=1)
+    return ctx['preprocessed']
+
+
+def _modelset(ctx):
+    # simple cycling and engineered features with 'hr' and 'filename', like the input of the nested cv
+    if 'modelset' not in ctx:
+        df = ctx['df']
+        df_simple = simple_cycling_features(df)
+        df_features = pd.concat([df[['secs', 'alt', 'slope', 'temp', 'filename']], df_simple], axis=1)
+        df_features = pd.concat([df_features, build_feature_frame(df_features)], axis=1)
+        df_features['hr'] = df['hr']
+        ctx['modelset'] = df_features[df_features['hr'] > 0].reset_index(drop=True)
+    return ctx['modelset']
+
+
+def _model(ctx):
+    if 'model' not in ctx:
+        df = _modelset(ctx)
+        ctx['model'] = lgb.LGBMRegressor(n_estimators=20, verbose=-1).fit(df.drop(columns=['hr', 'filename']),
+                                                                          df['hr'])
+    return ctx['model']
+
+
+def _ride_files(ctx):
+    if 'files' not in ctx:
+        df = ctx['df']
+        n_rides = df['filename'].nunique()
+        secs = max(1, len(df) // n_rides)
+        ctx['files'] = write_synthetic_rides(os.path.join(ctx['tmp_dir'], 'ride_level_data'), n_rides,
+                                             ride_secs=(secs, secs), seed=ctx['seed'])
+    return ctx['files']
+
+
+def _config_path(ctx):
+    path = os.path.join(ctx['tmp_dir'], 'rider_config.json')
+    if not os.path.exists(path):
+        with open(path, 'w') as c:
+            json.dump({'rider_params': RIDER_PARAMS}, c)
+    return path
+
+
+def _quiet(function):
+    # the stages print their progress, the benchmark only wants the timing
+    def call(*args, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return function(*args, **kwargs)
+    return call
+
+
+def _metrics_feat_sel(engine):
+    def setup(ctx):
+        df = _modelset(ctx)
+        return (df.drop(columns=['hr', 'filename']), df[['filename']], df['hr'], _model(ctx), 'benchmark'), \
+               {'scaled_test_set': False, 'engine': engine}
+    return setup
+
+
+def _tuning_setup(ctx):
+    proc_results_name = os.path.join(ctx['tmp_dir'], 'list_model_lgb_{}'.format(time.perf_counter_ns()))
+    return (_modelset(ctx),), dict(TUNING, proc_results_name=proc_results_name)
+
+
+# benchmarked stages.
+# setup: returns (args, kwargs) of the function, called before every run and not timed
+# function: the measured call
+# max_rows: largest number of records the stage runs at by default (the tuning is too slow beyond it)
+BENCHMARK_STAGES = {
+    'read_ride_files': {'setup': lambda ctx: ((_ride_files(ctx),), {}),
+                        'function': lambda files: pd.concat([read_ride_file(path) for path in files],
+                                                            ignore_index=True),
+                        'max_rows': 10**6},
+    'preprocessing': {'setup': lambda ctx: ((ctx['df'],), {}),
+                      'function': lambda df: _preprocessed({'df': df}), 'max_rows': 10**7},
+    'ride_stats_groupby': {'setup': lambda ctx: ((_preprocessed(ctx),), {'config_path': _config_path(ctx)}),
+                           'function': ride_stats_calculation, 'max_rows': 10**6},
+    'ride_stats_vectorized': {'setup': lambda ctx: ((_preprocessed(ctx),), {'engine': 'vectorized',
+                                                                            'config_path': _config_path(ctx)}),
+                              'function': ride_stats_calculation, 'max_rows': 10**7},
+    'reduce_mem_usage': {'setup': lambda ctx: ((_preprocessed(ctx).copy(),), {'verbose': False}),
+                         'function': reduce_mem_usage, 'max_rows': 10**7},
+    'simple_cycling_features': {'setup': lambda ctx: ((ctx['df'],), {}),
+                                'function': simple_cycling_features, 'max_rows': 10**7},
+    'build_feature_block': {'setup': lambda ctx: ((pd.concat([ctx['df'][['secs', 'slope', 'filename']],
+                                                              simple_cycling_features(ctx['df'])], axis=1),), {}),
+                            'function': build_feature_block, 'max_rows': 10**7},
+    'metrics_feat_sel_groupby': {'setup': _metrics_feat_sel('groupby'), 'function': _quiet(metrics_feat_sel),
+                                 'max_rows': 10**6},
+    'metrics_feat_sel_vectorized': {'setup': _metrics_feat_sel('vectorized'), 'function': _quiet(metrics_feat_sel),
+                                    'max_rows': 10**7},
+    'lightgbm_hyperparam_nested_cv_proc': {'setup': _tuning_setup,
+                                           'function': _quiet(lightgbm_hyperparam_nested_cv_proc),
+                                           'max_rows': 10**5},
+    'run_nested_cv': {'setup': _tuning_setup, 'function': _quiet(run_nested_cv), 'max_rows': 10**5},
+}
+
+
+def git_commit(path=None):
+    '''
+    Returns the commit hash of the repository and whether the working tree has uncommitted changes
+    '''
+    path = path or os.path.dirname(os.path.abspath(__file__))
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=path, stderr=subprocess.DEVNULL)
+        status = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=path,
+                                         stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit.decode().strip(), bool(status.strip())
+
+
+def benchmark_stage(stage, ctx, repeat=3, max_seconds=10):
+    '''
+    Returns the timing and memory of one stage on the records of a benchmark context
+
+            Parameters:
+                    stage (str): name of the stage in BENCHMARK_STAGES
+                    ctx (dict): benchmark context with the synthetic rides in 'df'
+                    repeat (int): number of timed runs, the fastest counts, default = 3
+                    max_seconds (float): no further timed runs after a run slower than this, default = 10
+            Returns:
+                    dict: seconds (fastest run), runs, rows_per_sec and peak_mb (tracemalloc peak of a separate run,
+                          allocations of worker processes and native libraries like LightGBM are not included)
+    '''
+    setup, function = BENCHMARK_STAGES[stage]['setup'], BENCHMARK_STAGES[stage]['function']
+    times = []
+    for _ in range(repeat):
+        args, kwargs = setup(ctx)
+        start = time.perf_counter()
+        function(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+        if times[-1] > max_seconds:
+            break
+
+    # tracemalloc slows down allocations, so the peak memory has its own run
+    args, kwargs = setup(ctx)
+    tracemalloc.start()
+    try:
+        function(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    rows = len(ctx['df'])
+    return {'seconds': min(times), 'runs': len(times), 'rows_per_sec': rows / max(min(times), 1e-9),
+            'peak_mb': peak / 1024**2}
+
+
+def run_benchmarks(row_counts=ROW_COUNTS, stages=None, repeat=3, seed=0, max_rows=None, output_path=None,
+                   verbose=True):
+    '''
+    Returns the benchmark results of the stages at every number of records and writes them to a JSON file
+
+            Parameters:
+                    row_counts (list): numbers of records of the synthetic rides, default = ROW_COUNTS
+                    stages (list): names of the stages in BENCHMARK_STAGES, default = all stages
+                    repeat (int): number of timed runs per stage, default = 3
+                    seed (int): seed of the synthetic rides, default = 0
+                    max_rows (int): overrules the max_rows of all stages, default uses the stage max_rows
+                    output_path (str): JSON file of the results, default = benchmark_<commit>.json
+                    verbose (bool): print a line per stage and number of records
+            Returns:
+                    dict: commit, environment and per stage and number of records the timing and memory.
+                          Stages which raise an error are recorded with the error message
+    '''
+    stages = stages or list(BENCHMARK_STAGES)
+    commit, dirty = git_commit()
+    results = {'commit': commit, 'dirty': dirty, 'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+               'versions': {'numpy': np.__version__, 'pandas': pd.__version__, 'lightgbm': lgb.__version__},
+               'seed': seed, 'benchmarks': []}
+
+    for n_rows in row_counts:
+        n_rows = int(n_rows)
+        n_rides = max(MIN_RIDES, int(round(n_rows / 3600)))
+        tmp_dir = tempfile.mkdtemp(prefix='benchmark_stages_')
+        ctx = {'df': synthetic_rides(n_rows, n_rides=n_rides, seed=seed), 'tmp_dir': tmp_dir, 'seed': seed}
+        try:
+            for stage in stages:
+                entry = {'stage': stage, 'rows': n_rows, 'rides': n_rides}
+                if n_rows > (max_rows or BENCHMARK_STAGES[stage]['max_rows']):
+                    entry['skipped'] = True
+                else:
+                    try:
+                        entry.update(benchmark_stage(stage, ctx, repeat))
+                    except Exception as e:
+                        entry['error'] = '{}: {}'.format(type(e).__name__, e)
+                results['benchmarks'].append(entry)
+                if verbose and not entry.get('skipped'):
+                    if 'error' in entry:
+                        print('{:>10} rows  {:<36} {}'.format(n_rows, stage, entry['error']))
+                    else:
+                        print('{:>10} rows  {:<36} {:9.3f} s {:9.1f} MB peak'.format(n_rows, stage, entry['seconds'],
+                                                                                  entry['peak_mb']))
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    output_path = output_path or 'benchmark_{}.json'.format((commit or 'unknown')[:10])
+    with open(output_path, 'w') as f:
+        json.dump(results, f, indent=1)
+    return results
+
+
+def compare_benchmarks(baseline_path, path):
+    '''
+    Returns a pandas DataFrame with the ratio of the seconds and peak memory of two benchmark JSON files
+
+            Parameters:
+                    baseline_path (str): JSON file of the reference run (e.g. the previous commit)
+                    path (str): JSON file of the new run
+            Returns:
+                    df: pandas DataFrame per stage and number of records with both measurements and
+                        'seconds_ratio' / 'peak_mb_ratio' (new / baseline, above 1 is a regression)
+    '''
+    frames = []
+    for suffix, file_path in [('_baseline', baseline_path), ('', path)]:
+        with open(file_path, 'r') as f:
+            df = pd.DataFrame(json.load(f)['benchmarks'])
+        df = df.reindex(columns=['stage', 'rows', 'seconds', 'peak_mb']).dropna(subset=['seconds'])
+        frames.append(df.set_index(['stage', 'rows']).add_suffix(suffix))
+
+    df = frames[0].join(frames[1], how='inner')
+    df['seconds_ratio'] = df['seconds'] / df['seconds_baseline']
+    df['peak_mb_ratio'] = df['peak_mb'] / df['peak_mb_baseline']
+    return df.reset_index()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline stages on synthetic rides')
+    parser.add_argument('--rows', type=float, nargs='+', default=ROW_COUNTS, help='numbers of records')
+    parser.add_argument('--stages', nargs='+', choices=list(BENCHMARK_STAGES), help='stages, default = all')
+    parser.add_argument('--repeat', type=int, default=3, help='timed runs per stage')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the synthetic rides')
+    parser.add_argument('--max-rows', type=float, help='overrules the largest number of records of every stage')
+    parser.add_argument('--output', help='JSON file of the results, default = benchmark_<commit>.json')
+    parser.add_argument('--compare', help='JSON file of an earlier run to compare with')
+    args = parser.parse_args()
+
+    run_benchmarks(args.rows, args.stages, args.repeat, args.seed, args.max_rows and int(args.max_rows), args.output)
+    if args.compare:
+        output = args.output or 'benchmark_{}.json'.format((git_commit()[0] or 'unknown')[:10])
+        print(compare_benchmarks(args.compare, output).to_string(index=False))
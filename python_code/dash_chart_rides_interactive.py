@@ -1,62 +1,182 @@
-import dash
-import dash_core_components as dcc
-import dash_html_components as html
-import plotly.graph_objs as go
-import plotly.express as px
-import pandas as pd
-import pickle
-
-# define the dataset here
-df_raw_1_1 = pd.read_pickle('df_modelset_rider1.pickle')
-
-df = df_raw_1_1
-
-df = df.groupby(['secs','filename'], as_index=False)['hr','watts'].sum()
-df.set_index('secs', inplace=True)
-trace1 = go.Line(x=df.index, y=df[('hr')], name='heart rate')
-trace2 = go.Line(x=df.index, y=df[('watts')], name='watts')
-mgr_options = df["filename"].unique()
-
-app = dash.Dash()
-
-app.layout = html.Div([
-    html.H2("Select a ride file"),
-    html.Div(
-        [
-            dcc.Dropdown(
-                id="filename",
-                options=[{
-                    'label': i,
-                    'value': i
-                } for i in mgr_options],
-                value="All filenames"),
-        ],
-        style={'width': '25%',
-               'display': 'inline-block'}),
-    dcc.Graph(id='funnel-graph'),
-])
-
-@app.callback(
-    dash.dependencies.Output('funnel-graph', 'figure'),
-    [dash.dependencies.Input('filename', 'value')])
-def update_graph(filename):
-    if filename == "All filenames":
-        df_plot = df.copy()
-    else:
-        df_plot = df[df['filename'] == filename]
-
-    
-
-    trace1 = go.Line(x=df_plot.index, y=df_plot[('hr')], name='heart rate')
-    trace2 = go.Line(x=df_plot.index, y=df_plot[('watts')], name='watts')
-
-    return {
-        'data': [trace1, trace2],
-        'layout':
-        go.Layout(
-            title='Ride file {}'.format(filename)
-            )
-    }
-
-if __name__ == '__main__':
-    app.run_server(debug=True)
\ No newline at end of file
+import dash
+import dash_core_components as dcc
+import dash_html_components as html
+import plotly.graph_objs as go
+import plotly.express as px
+import pandas as pd
+import numpy as np
+import pickle
+import json
+import os
+from functools import lru_cache
+
+from downsampling import downsample
+
+# define the dataset here
+DATASET = 'df_modelset_rider1.pickle'
+# per ride store of the dataset, built once from the pickle and memory mapped afterwards
+STORE_DIR = 'df_modelset_rider1_store'
+COLUMNS = ['hr', 'watts']
+
+# number of points per series sent to the browser, about the width of the graph in pixels
+SCREEN_POINTS = 2000
+
+
+def build_ride_index(df, store_dir, columns=COLUMNS):
+    '''
+    Saves the rides as contiguous arrays (sorted by filename and secs) with an offset index per ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second data, 'secs' and 'filename'
+                    store_dir (str): directory of the store
+                    columns (list): columns to store, default = COLUMNS
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    # duplicate seconds of a ride are summed, like the original groupby(['secs','filename']).sum()
+    df = df.groupby(['filename','secs'], as_index=False, observed=True)[columns].sum()
+
+    filenames = df['filename'].astype(str).to_numpy()
+    starts = np.flatnonzero(np.r_[True, filenames[1:] != filenames[:-1]])
+    ends = np.append(starts[1:], len(df))
+    index = {name: [int(start), int(end)] for name, start, end in zip(filenames[starts], starts, ends)}
+
+    for col in ['secs'] + columns:
+        np.save(os.path.join(store_dir, col + '.npy'), df[col].to_numpy(dtype=np.float64))
+    with open(os.path.join(store_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+
+
+def open_ride_index(store_dir, columns=COLUMNS):
+    '''
+    Returns the memory mapped arrays and the offset index of a store saved with build_ride_index
+
+            Parameters:
+                    store_dir (str): directory of the store
+                    columns (list): columns to open, default = COLUMNS
+            Returns:
+                    arrays (dict): column name -> memory mapped numpy array
+                    index (dict): filename -> [start, end] positions of the ride in the arrays
+    '''
+    arrays = {col: np.load(os.path.join(store_dir, col + '.npy'), mmap_mode='r') for col in ['secs'] + columns}
+    with open(os.path.join(store_dir, 'index.json'), 'r') as f:
+        index = json.load(f)
+    return arrays, index
+
+
+# only read the pickle when the store is missing or older than the dataset. Without the pickle (e.g. when only the
+# store is deployed) the existing store is used
+store_index = os.path.join(STORE_DIR, 'index.json')
+if not os.path.exists(store_index) and not os.path.exists(DATASET):
+    raise FileNotFoundError('neither the ride store {} nor the dataset {} exists'.format(STORE_DIR, DATASET))
+if os.path.exists(DATASET) and (not os.path.exists(store_index) or
+                                os.path.getmtime(store_index) < os.path.getmtime(DATASET)):
+    build_ride_index(pd.read_pickle(DATASET), STORE_DIR)
+arrays, ride_index = open_ride_index(STORE_DIR)
+mgr_options = list(ride_index)
+
+
+def ride_slice(filename, x0=None, x1=None):
+    # positions of a ride within the visible secs range, found by binary search instead of a full scan
+    start, end = ride_index[filename]
+    secs = arrays['secs'][start:end]
+    lo = 0 if x0 is None else np.searchsorted(secs, x0, side='left')
+    hi = len(secs) if x1 is None else np.searchsorted(secs, x1, side='right')
+    # one point beyond both edges, so the line runs to the edge of the graph
+    return start + max(lo - 1, 0), start + min(hi + 1, len(secs))
+
+
+@lru_cache(maxsize=64)
+def ride_figure(filename, x0=None, x1=None):
+    '''
+    Returns the figure of a ride (or all rides) downsampled to SCREEN_POINTS within the visible secs range
+    '''
+    filenames = mgr_options if filename == "All filenames" else [filename]
+    # the points of all rides together fit the screen, rides stay separate lines
+    n_out = max(SCREEN_POINTS // len(filenames), 4)
+
+    data = []
+    for col, name in zip(COLUMNS, ['heart rate', 'watts']):
+        xs, ys = [], []
+        for f in filenames:
+            lo, hi = ride_slice(f, x0, x1)
+            x, y = downsample(arrays['secs'][lo:hi], arrays[col][lo:hi], n_out,
+                              method='lttb' if len(filenames) == 1 else 'minmax')
+            xs += [x, [None]]
+            ys += [y, [None]]
+        data.append(go.Scattergl(x=np.concatenate(xs) if xs else [], y=np.concatenate(ys) if ys else [],
+                                 mode='lines', name=name))
+
+    return {
+        'data': data,
+        'layout':
+        go.Layout(
+            title='Ride file {}'.format(filename),
+            uirevision=filename
+            )
+    }
+
+
+def relayout_range(relayout_data):
+    '''
+    Returns the visible secs range of a zoom, or None when the relayout event is no zoom of the x axis
+    (e.g. a reset of the zoom)
+
+            Parameters:
+                    relayout_data (dict): relayoutData of the graph, with 'xaxis.range[0]' and 'xaxis.range[1]'
+                                          for a zoom or 'xaxis.range' as list for a range set at once
+            Returns:
+                    tuple: x0 and x1 rounded outwards to whole seconds (so the figure cache is reused), or None
+    '''
+    if not relayout_data:
+        return None
+    if 'xaxis.range[0]' in relayout_data and 'xaxis.range[1]' in relayout_data:
+        x0, x1 = relayout_data['xaxis.range[0]'], relayout_data['xaxis.range[1]']
+    elif len(relayout_data.get('xaxis.range') or []) == 2:
+        x0, x1 = relayout_data['xaxis.range']
+    else:
+        return None
+    return int(np.floor(x0)), int(np.ceil(x1))
+
+
+app = dash.Dash()
+
+app.layout = html.Div([
+    html.H2("Select a ride file"),
+    html.Div(
+        [
+            dcc.Dropdown(
+                id="filename",
+                options=[{
+                    'label': i,
+                    'value': i
+                } for i in ["All filenames"] + mgr_options],
+                value="All filenames"),
+        ],
+        style={'width': '25%',
+               'display': 'inline-block'}),
+    dcc.Graph(id='funnel-graph'),
+])
+
+@app.callback(
+    dash.dependencies.Output('funnel-graph', 'figure'),
+    [dash.dependencies.Input('filename', 'value'),
+     dash.dependencies.Input('funnel-graph', 'relayoutData')])
+def update_graph(filename, relayout_data):
+    # a cleared dropdown (or a ride which is not in the store) keeps the current figure
+    if filename != "All filenames" and filename not in ride_index:
+        return dash.no_update
+
+    # a zoom only fetches the detail of the visible range, a new ride (or a reset of the zoom) the whole ride
+    triggered = [t['prop_id'] for t in dash.callback_context.triggered]
+    x0 = x1 = None
+    if 'funnel-graph.relayoutData' in triggered:
+        x_range = relayout_range(relayout_data)
+        # other relayout events (like the drag mode or a zoom of the y axis only) keep the current detail
+        if x_range is None and not (relayout_data or {}).get('xaxis.autorange'):
+            return dash.no_update
+        x0, x1 = x_range or (None, None)
+
+    return ride_figure(filename, x0, x1)
+
+if __name__ == '__main__':
+    app.run_server(debug=True)
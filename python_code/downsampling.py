@@ -0,0 +1,98 @@
+import numpy as np
+
+# downsampling of second by second series to the resolution of a screen or figure, shared by the dash app and the
+# figure rendering. Both methods return positions into the original arrays, so every column of a ride can be
+# downsampled with the same positions
+
+
+def minmax_indices(y, n_out):
+    '''
+    Returns the positions of the minimum and maximum of y in n_out / 2 equally sized buckets, so every peak and
+    dip stays visible
+
+            Parameters:
+                    y: numpy array with the values
+                    n_out (int): maximum number of positions
+            Returns:
+                    numpy array with sorted positions, including the first and last position
+    '''
+    n = len(y)
+    if n <= n_out or n_out < 4:
+        return np.arange(n)
+
+    y = np.asarray(y, dtype=np.float64)
+    n_buckets = (n_out - 2) // 2
+    size = int(np.ceil(n / n_buckets))
+    padded = np.full(n_buckets * size, np.nan)
+    padded[:n] = y
+    padded = padded.reshape(n_buckets, size)
+
+    missing = np.isnan(padded)
+    offsets = np.arange(n_buckets) * size
+    low = offsets + np.argmin(np.where(missing, np.inf, padded), axis=1)
+    high = offsets + np.argmax(np.where(missing, -np.inf, padded), axis=1)
+
+    idx = np.unique(np.concatenate([[0, n - 1], low, high]))
+    return idx[idx < n]
+
+
+def lttb_indices(x, y, n_out):
+    '''
+    Returns the positions selected by Largest-Triangle-Three-Buckets, which keeps the visual shape of a line
+
+            Parameters:
+                    x: numpy array with the x values (e.g. secs), increasing
+                    y: numpy array with the values
+                    n_out (int): number of positions
+            Returns:
+                    numpy array with sorted positions, including the first and last position
+    '''
+    n = len(y)
+    if n <= n_out or n_out < 3:
+        return np.arange(n)
+
+    x = np.asarray(x, dtype=np.float64)
+    # missing values never form the largest triangle
+    y = np.nan_to_num(np.asarray(y, dtype=np.float64))
+
+    # bucket boundaries of the n - 2 inner points
+    edges = (np.arange(n_out - 1) * (n - 2) / (n_out - 2)).astype(np.int64) + 1
+    edges[-1] = n - 1
+    # average point of every bucket, the third point of the triangle of the previous bucket
+    cx = np.add.reduceat(x[1:n - 1], edges[:-1] - 1) / np.diff(edges)
+    cy = np.add.reduceat(y[1:n - 1], edges[:-1] - 1) / np.diff(edges)
+    cx = np.append(cx[1:], x[-1])
+    cy = np.append(cy[1:], y[-1])
+
+    idx = np.empty(n_out, dtype=np.int64)
+    idx[0] = 0
+    idx[-1] = n - 1
+    a = 0
+    for i in range(n_out - 2):
+        lo, hi = edges[i], edges[i + 1]
+        area = np.abs((x[a] - cx[i]) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (cy[i] - y[a]))
+        a = lo + int(np.argmax(area))
+        idx[i + 1] = a
+
+    return idx
+
+
+def downsample(x, y, n_out, method='lttb'):
+    '''
+    Returns the downsampled x and y values
+
+            Parameters:
+                    x: numpy array with the x values (e.g. secs), increasing
+                    y: numpy array with the values
+                    n_out (int): maximum number of points, e.g. the width in pixels
+                    method (str): 'lttb' (default) or 'minmax'
+            Returns:
+                    x, y: numpy arrays with at most n_out points
+    '''
+    if method == 'lttb':
+        idx = lttb_indices(x, y, n_out)
+    elif method == 'minmax':
+        idx = minmax_indices(y, n_out)
+    else:
+        raise ValueError("method should be 'lttb' or 'minmax', got {}".format(method))
+    return np.asarray(x)[idx], np.asarray(y)[idx]
@@ -0,0 +1,191 @@
+import math
+
+import numpy as np
+import pandas as pd
+
+from ride_segments import ride_segments
+from instrumentation import instrumented
+
+# declarative feature specification of 2. Feature engineering.ipynb. Every entry creates a feature per column and
+# window. Entries can use features of earlier entries as column (e.g. the rolling mean of '1s_delta_watts').
+#   lag: value of the column window seconds earlier within the ride
+#   sma: simple moving average over the last window seconds within the ride
+#   delta: difference with the value window seconds earlier within the ride
+#   power: column to the power window (exp_ for squares, cub_ for cubes)
+#   cumsum: cumulative total and cumulative average within the ride
+CYCLING_COLS = ['watts', 'torque', 'cad', 'rotation_speed', 'slope']
+
+DEFAULT_FEATURE_SPEC = [
+    {'kind': 'power', 'cols': ['watts', 'secs', 'cad', 'torque', 'rotation_speed'], 'windows': [2, 3]},
+    {'kind': 'cumsum', 'cols': ['watts', 'cad', 'rotation_speed'], 'round': 0},
+    {'kind': 'lag', 'cols': CYCLING_COLS, 'windows': list(range(5, 61, 5))},
+    {'kind': 'sma', 'cols': CYCLING_COLS, 'windows': list(range(5, 61, 5))},
+    {'kind': 'delta', 'cols': ['watts', 'torque', 'cad', 'rotation_speed'], 'windows': list(range(1, 11))},
+    {'kind': 'sma', 'cols': ['1s_delta_watts', '1s_delta_torque', '1s_delta_rotation_speed', '1s_delta_cad'],
+     'windows': list(range(5, 31, 5)), 'name': '{window}s_{col}_mean'},
+]
+
+NAME_TEMPLATES = {'lag': '{window}s_lag_{col}', 'sma': '{window}s_sma_{col}', 'delta': '{window}s_delta_{col}'}
+POWER_PREFIXES = {2: 'exp_', 3: 'cub_'}
+
+
+@instrumented()
+def simple_cycling_features(df):
+    '''
+    Returns the corrected cadence and power, rotation speed and torque of 2. Feature engineering.ipynb
+
+            Parameters:
+                    df: pandas DataFrame with second by second 'cad' and 'watts'
+            Returns:
+                    df: pandas DataFrame with 'cad', 'watts', 'rotation_speed' and 'torque'
+    '''
+    out = pd.DataFrame(index=df.index)
+    # if watts is zero, cadence will be put to zero and the other way around
+    out['cad'] = np.where((df.watts==0) & (df.cad>0), 0, df.cad)
+    out['watts'] = np.where((df.watts>0) & (out.cad==0), 0, df.watts)
+
+    out['rotation_speed'] = np.round(((2*math.pi)/60)*out['cad'],2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['torque'] = np.round(out['watts']/out['rotation_speed'],2)
+    out['torque'] = out['torque'].replace([np.inf, -np.inf], np.nan).fillna(0)
+
+    return out
+
+
+def _entry_names(entry):
+    kind = entry['kind']
+    names = []
+    for col in entry['cols']:
+        if kind == 'cumsum':
+            names.append(('cum_total_' + col, col, 'total'))
+            names.append(('cum_average_' + col, col, 'average'))
+            continue
+        for window in entry['windows']:
+            if 'name' in entry:
+                name = entry['name'].format(window=window, col=col)
+            elif kind == 'power':
+                name = POWER_PREFIXES.get(window, 'pow{}_'.format(window)) + col
+            elif kind in NAME_TEMPLATES:
+                name = NAME_TEMPLATES[kind].format(window=window, col=col)
+            else:
+                raise ValueError('unknown feature kind {}'.format(kind))
+            names.append((name, col, window))
+    return names
+
+
+def feature_names(spec=DEFAULT_FEATURE_SPEC):
+    '''
+    Returns the names of the features created by a feature specification, in the order of the feature block
+
+            Parameters:
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+            Returns:
+                    list: feature names
+    '''
+    return [name for entry in spec for name, _, _ in _entry_names(entry)]
+
+
+@instrumented()
+def build_feature_block(df, spec=DEFAULT_FEATURE_SPEC, out=None):
+    '''
+    Returns a 2-D float32 block with the features of a feature specification. All features are vectorized shifts
+    and cumulative sum windows which never cross a ride boundary (like df.groupby('filename')[col].shift(i)).
+    Cumulative averages divide the cumulative sum by the 'secs' of the record
+
+            Parameters:
+                    df: pandas DataFrame with second by second data, 'secs' and 'filename', ordered by secs within
+                        a ride
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+                    out: optional preallocated float32 numpy array of shape (len(df), number of features)
+            Returns:
+                    block: float32 numpy array with one column per feature
+                    names (list): feature names of the block columns
+    '''
+    names = feature_names(spec)
+    n = len(df)
+    if out is None:
+        out = np.empty((n, len(names)), dtype=np.float32)
+    elif out.shape != (n, len(names)):
+        raise ValueError('out should have shape {}, got {}'.format((n, len(names)), out.shape))
+
+    # work in filename order. Rides keep their record order, so the block is only scattered back when needed
+    order, _, starts, ends = ride_segments(df['filename'])
+    ride_start = np.repeat(starts, ends - starts)
+    # position of every record within its ride
+    pos = np.arange(n) - ride_start
+
+    # features used as column of a later entry are kept in float64
+    referenced = set(col for entry in spec for col in entry['cols'])
+    kept = {}
+
+    def source(col):
+        if col in kept:
+            return kept[col]
+        values = df[col].to_numpy(dtype=np.float64)
+        return values if order is None else values[order]
+
+    def shifted(x, k):
+        lag = np.full(n, np.nan)
+        if k < n:
+            lag[k:] = x[:n - k]
+        lag[pos < k] = np.nan
+        return lag
+
+    def within_ride_cumsum(x):
+        # cumulative sum restarting at every ride
+        c = np.concatenate([[0.0], np.cumsum(x)])
+        return c[1:] - c[ride_start]
+
+    j = 0
+    for entry in spec:
+        kind = entry['kind']
+        for name, col, window in _entry_names(entry):
+            x = source(col)
+            if kind == 'lag':
+                values = shifted(x, window)
+            elif kind == 'delta':
+                values = x - shifted(x, window)
+            elif kind == 'power':
+                values = x**window
+            elif kind == 'sma':
+                missing = np.isnan(x)
+                c = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, x))])
+                m = np.concatenate([[0], np.cumsum(missing)])
+                idx = np.arange(n)
+                lo = np.maximum(idx + 1 - window, 0)
+                values = (c[idx + 1] - c[lo]) / window
+                # like rolling(window) the mean needs window valid values within the ride
+                values[(pos < window - 1) | (m[idx + 1] - m[lo] > 0)] = np.nan
+            elif kind == 'cumsum':
+                missing = np.isnan(x)
+                total = within_ride_cumsum(np.where(missing, 0.0, x))
+                total[missing] = np.nan
+                # like the notebook the average is over the seconds of the ride, not over the records
+                values = total if window == 'total' else total / source('secs')
+                if entry.get('round') is not None:
+                    values = np.round(values, entry['round'])
+
+            if order is None:
+                out[:, j] = values
+            else:
+                out[order, j] = values
+            if name in referenced:
+                kept[name] = values
+            j += 1
+
+    return out, names
+
+
+def build_feature_frame(df, spec=DEFAULT_FEATURE_SPEC):
+    '''
+    Returns a pandas DataFrame with the features of a feature specification (see build_feature_block)
+
+            Parameters:
+                    df: pandas DataFrame with second by second data, 'secs' and 'filename', ordered by secs within
+                        a ride
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+            Returns:
+                    df: pandas DataFrame with one float32 column per feature and the index of df
+    '''
+    block, names = build_feature_block(df, spec)
+    return pd.DataFrame(block, index=df.index, columns=names, copy=False)
@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
 
-def graph_ride_anomalies(df, df_stats, number_of_ride_files, value_to_sort, rows,cols):
+from ride_plot_rendering import SERIES_STYLES, ride_series, draw_ride
+
+def graph_ride_anomalies(df, df_stats, number_of_ride_files, value_to_sort, rows,cols, output_path=None):
     '''
     Returns a plot with ride(s) and power / heart rate development
 
@@ -11,23 +13,23 @@ def graph_ride_anomalies(df, df_stats, number_of_ride_files, value_to_sort, rows
                     values to sort (int): variable name plot top number of files
                     rows (int): number of rows in plot (rows * cols = number of files)
                     cols (int): number of columns in plot (rows * cols = number of files)
+                    output_path (str): optional path (png or svg) to save the plot to instead of showing it
             Returns:
-                    plot: matplotlib object with heart rate and power
+                    plot: matplotlib object with heart rate and power (or the output path)
     '''
             
     lijst = df_stats.sort_values(by=[value_to_sort], ascending = False).head(number_of_ride_files).filename.tolist()
     
-    grouped = df[df['filename'].isin(lijst)][['filename','hr','watts','secs']].groupby('filename',sort=False)
+    rides = ride_series(df, lijst, ['hr','watts'])
     
     ncols = cols
     nrows = rows
        
     fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(20,8), sharey=False)
-    for (key, ax) in zip(grouped.groups.keys(), axes.flatten()):
-        grouped.get_group(key).plot(x='secs', y=['watts','hr'],  ax=ax)
-        #grouped.get_group(key).plot(x='secs', y=['watts'], ax=ax.twinx(), color='b', alpha=0.3)
-        ax.legend().set_visible(False)
-        ax.set_title(grouped.get_group(key).filename.unique());
+    for (key, ax) in zip(rides, axes.flatten()):
+        draw_ride(ax, rides[key], SERIES_STYLES['anomalies'])
+        ax.set_xlabel('secs')
+        ax.set_title(key);
     
     fig.suptitle('Plots of example rides with {}'.format(value_to_sort) , fontsize=16) 
     
@@ -38,4 +40,9 @@ def graph_ride_anomalies(df, df_stats, number_of_ride_files, value_to_sort, rows
     plt.tight_layout()
     fig.subplots_adjust(top=0.91)
     
+    if output_path:
+        fig.savefig(output_path)
+        plt.close(fig)
+        return output_path
+
     return plt.show()
\ No newline at end of file
@@ -1,6 +1,8 @@
 import matplotlib.pyplot as plt
 
-def graph_rides_model_performance(df, df_metrics, number_of_files, value_to_sort, high, rows, cols):
+from ride_plot_rendering import SERIES_STYLES, ride_series, draw_ride
+
+def graph_rides_model_performance(df, df_metrics, number_of_files, value_to_sort, high, rows, cols, output_path=None):
     '''
     Returns a plot with ride(s) and power / heart rate development
 
@@ -12,24 +14,25 @@ def graph_rides_model_performance(df, df_metrics, number_of_files, value_to_sort
                     high: Boolean True or False. If True returns metrics ranking on descending order
                     rows (int): number of rows in plot (rows * cols = number of files)
                     cols (int): number of columns in plot (rows * cols = number of files)
+                    output_path (str): optional path (png or svg) to save the plot to instead of showing it
             Returns:
-                    plot: matplotlib object with heart rate ('hr') and predicted heart rate ('pred_hr') development for rides in selection
+                    plot: matplotlib object with heart rate ('hr') and predicted heart rate ('pred_hr') development for rides in selection (or the output path)
     '''
     if high is True:
         lijst = df_metrics.sort_values(by=[value_to_sort], ascending = False).head(number_of_files).filename.tolist()
     else:
         lijst = df_metrics.sort_values(by=[value_to_sort], ascending = True).head(number_of_files).filename.tolist()
     
-    grouped = df[df['filename'].isin(lijst)][['filename','hr','pred_hr','secs']].groupby('filename',sort=False)
+    rides = ride_series(df, lijst, ['hr','pred_hr'])
     
     ncols = cols
     nrows = rows
        
     fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(20,10), sharey=False)
-    for (key, ax) in zip(grouped.groups.keys(), axes.flatten()):
-        grouped.get_group(key).plot(x='secs', y=['hr','pred_hr'], ax=ax)
-        ax.legend().set_visible(False)
-        ax.set_title(grouped.get_group(key).filename.unique());
+    for (key, ax) in zip(rides, axes.flatten()):
+        draw_ride(ax, rides[key], SERIES_STYLES['model_performance'])
+        ax.set_xlabel('secs')
+        ax.set_title(key);
     
     fig.suptitle('Plots of example rides with {}'.format(value_to_sort) , fontsize=16) 
     
@@ -44,4 +47,9 @@ def graph_rides_model_performance(df, df_metrics, number_of_files, value_to_sort
     plt.tight_layout()
     fig.subplots_adjust(top=0.91)
     
+    if output_path:
+        fig.savefig(output_path)
+        plt.close(fig)
+        return output_path
+
     return plt.show()
\ No newline at end of file
@@ -0,0 +1,282 @@
+import os
+import json
+import time
+import datetime
+import functools
+import cProfile
+import tracemalloc
+
+import pandas as pd
+import psutil
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows, the peak RSS then comes from psutil
+    resource = None
+
+# instrumentation of the pipeline stages. Every stage writes one JSON line with its wall and cpu time, RSS, rows
+# and rows / sec to the log file, next to events like the per fold / candidate timings of the nested cv.
+# Without a log file (the default) stage() and instrumented() only check a flag, so they can stay in the hot paths.
+# The configuration is kept in environment variables, so worker processes of pools and the orchestrator log too
+
+LOG_ENV = 'RIDE_INSTRUMENTATION_LOG'
+PROFILE_ENV = 'RIDE_INSTRUMENTATION_PROFILE'
+PROFILE_DIR_ENV = 'RIDE_INSTRUMENTATION_PROFILE_DIR'
+RUN_ENV = 'RIDE_INSTRUMENTATION_RUN'
+
+# profile modes: None, 'cprofile' (a .prof file per stage, see pstats) or 'tracemalloc' (traced peak per stage)
+PROFILE_MODES = [None, 'cprofile', 'tracemalloc']
+
+_state = {'log_path': os.environ.get(LOG_ENV) or None, 'profile': os.environ.get(PROFILE_ENV) or None,
+          'profile_dir': os.environ.get(PROFILE_DIR_ENV) or None, 'run': os.environ.get(RUN_ENV) or None,
+          'stack': [], 'profiling': False}
+
+
+def configure(log_path=None, profile=None, profile_dir=None, run=None):
+    '''
+    Enables (or with log_path None disables) the instrumentation of this process and the processes it starts
+
+            Parameters:
+                    log_path (str): JSONL file the records are appended to, default = None (disabled)
+                    profile (str): None (default), 'cprofile' or 'tracemalloc' capture per stage
+                    profile_dir (str): directory of the cProfile files, default = directory of the log file
+                    run (str): identifier of the run in every record, default = start time and pid
+    '''
+    if profile not in PROFILE_MODES:
+        raise ValueError('profile should be one of {}, got {}'.format(PROFILE_MODES, profile))
+    if log_path is not None:
+        log_path = os.path.abspath(log_path)
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        profile_dir = os.path.abspath(profile_dir or os.path.dirname(log_path))
+        run = run or '{}_{}'.format(datetime.datetime.now().strftime('%Y%m%d_%H%M%S'), os.getpid())
+    else:
+        profile, profile_dir, run = None, None, None
+
+    _state.update({'log_path': log_path, 'profile': profile, 'profile_dir': profile_dir, 'run': run})
+    for name, value in [(LOG_ENV, log_path), (PROFILE_ENV, profile), (PROFILE_DIR_ENV, profile_dir), (RUN_ENV, run)]:
+        if value is None:
+            os.environ.pop(name, None)
+        else:
+            os.environ[name] = value
+
+
+def enabled():
+    return _state['log_path'] is not None
+
+
+def _json_default(value):
+    # numpy scalars and arrays, anything else as text
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return str(value)
+
+
+def log_event(event, **fields):
+    '''
+    Appends one record to the log file (nothing when the instrumentation is disabled)
+
+            Parameters:
+                    event (str): type of the record, e.g. 'stage' or 'cv_task'
+                    fields: JSON serializable values of the record
+    '''
+    if _state['log_path'] is None:
+        return
+    record = {'event': event, 'run': _state['run'], 'time': datetime.datetime.now().isoformat(), 'pid': os.getpid()}
+    record.update(fields)
+    line = (json.dumps(record, default=_json_default) + '\n').encode('utf-8')
+    # a single append write per record, so the lines of several processes do not mix
+    fd = os.open(_state['log_path'], os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def _peak_rss_mb():
+    # peak RSS of the process and of its finished child processes
+    if resource is not None:
+        scale = 1024**2 if os.uname().sysname == 'Darwin' else 1024
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale)
+    info = psutil.Process().memory_info()
+    return getattr(info, 'peak_wset', info.rss) / 1024**2, None
+
+
+class _NullStage:
+    # stage of a disabled instrumentation, the same object every time
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+class Stage:
+    '''
+    Context manager which measures a stage and logs it on exit. Set rows (or extra fields) inside the block
+    when the number of processed records is only known there
+
+            Parameters:
+                    name (str): name of the stage
+                    rows (int): number of processed records, default = None
+                    fields: extra JSON serializable values of the record
+    '''
+    def __init__(self, name, rows=None, **fields):
+        self.name = name
+        self.rows = rows
+        self.fields = fields
+        self.profiler = None
+        self.owner = False
+        self.tracing = False
+
+    def __enter__(self):
+        self.parent = _state['stack'][-1] if _state['stack'] else None
+        _state['stack'].append(self.name)
+        self.rss_start = psutil.Process().memory_info().rss
+        self.peak_start, _ = _peak_rss_mb()
+
+        # only the outermost profiled stage captures, nested stages are part of its profile
+        self.owner = _state['profile'] is not None and not _state['profiling']
+        if self.owner:
+            _state['profiling'] = True
+            if _state['profile'] == 'cprofile':
+                self.profiler = cProfile.Profile()
+                self.profiler.enable()
+            else:
+                # tracing which was started elsewhere keeps running, only its peak is reset
+                self.tracing = not tracemalloc.is_tracing()
+                if self.tracing:
+                    tracemalloc.start()
+                elif hasattr(tracemalloc, 'reset_peak'):
+                    tracemalloc.reset_peak()
+
+        self.cpu_start = time.process_time()
+        self.wall_start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        wall = time.perf_counter() - self.wall_start
+        cpu = time.process_time() - self.cpu_start
+        _state['stack'].pop()
+
+        rss = psutil.Process().memory_info().rss
+        record = {'stage': self.name, 'parent': self.parent, 'status': 'ok' if exc_type is None else 'error',
+                  'wall_s': wall, 'cpu_s': cpu, 'rss_mb': rss / 1024**2,
+                  'rss_delta_mb': (rss - self.rss_start) / 1024**2}
+        peak, peak_children = _peak_rss_mb()
+        # the peak RSS is a high-water mark of the process, the growth shows whether this stage raised it
+        record.update({'peak_rss_mb': peak, 'peak_rss_growth_mb': peak - self.peak_start,
+                       'peak_rss_children_mb': peak_children})
+        if self.rows is not None:
+            record.update({'rows': int(self.rows), 'rows_per_sec': self.rows / max(wall, 1e-9)})
+        if exc_type is not None:
+            record['error'] = '{}: {}'.format(exc_type.__name__, exc)
+
+        if self.owner:
+            _state['profiling'] = False
+            if self.profiler is not None:
+                self.profiler.disable()
+                path = os.path.join(_state['profile_dir'], '{}_{}_{}.prof'.format(
+                    self.name, os.getpid(), datetime.datetime.now().strftime('%Y%m%d_%H%M%S_%f')))
+                self.profiler.dump_stats(path)
+                record['profile'] = path
+            else:
+                record['traced_peak_mb'] = tracemalloc.get_traced_memory()[1] / 1024**2
+                if self.tracing:
+                    tracemalloc.stop()
+
+        record.update(self.fields)
+        log_event('stage', **record)
+        return False
+
+
+def stage(name, rows=None, **fields):
+    '''
+    Returns a context manager which logs the wall / cpu time, RSS and rows / sec of a block, e.g.
+
+        with stage('ride_stats', rows=len(df)):
+            df_stats = ride_stats_calculation(df)
+
+            Parameters:
+                    name (str): name of the stage
+                    rows (int): number of processed records, default = None
+                    fields: extra JSON serializable values of the record
+            Returns:
+                    Stage, or a shared no-op object when the instrumentation is disabled
+    '''
+    if _state['log_path'] is None:
+        return _NULL_STAGE
+    return Stage(name, rows, **fields)
+
+
+def instrumented(name=None, rows_arg=0):
+    '''
+    Returns a decorator which runs every call of a function as a stage
+
+            Parameters:
+                    name (str): name of the stage, default = name of the function
+                    rows_arg (int or str): position or keyword of the argument whose length is the number of rows
+                                           (only arguments with a shape, like DataFrames and arrays), default = 0
+            Returns:
+                    decorator
+    '''
+    def decorator(function):
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if _state['log_path'] is None:
+                return function(*args, **kwargs)
+            if isinstance(rows_arg, int):
+                value = args[rows_arg] if rows_arg < len(args) else None
+            else:
+                value = kwargs.get(rows_arg)
+            shape = getattr(value, 'shape', None)
+            with Stage(stage_name, rows=shape[0] if shape else None):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def read_log(log_path, event=None):
+    '''
+    Returns the records of a log file as a pandas DataFrame
+
+            Parameters:
+                    log_path (str): JSONL file of the instrumentation
+                    event (str): optional type of the records, e.g. 'stage' or 'cv_task'
+            Returns:
+                    df: pandas DataFrame with one row per record
+    '''
+    with open(log_path, 'r') as f:
+        df = pd.DataFrame([json.loads(line) for line in f if line.strip()])
+    if event is not None and len(df):
+        df = df[df['event'] == event].dropna(axis=1, how='all').reset_index(drop=True)
+    return df
+
+
+def stage_summary(log_path, by=('run', 'stage')):
+    '''
+    Returns the calls, wall / cpu time, rows / sec and peak RSS per run and stage of a log file, to find the stage
+    of a run which regressed
+
+            Parameters:
+                    log_path (str): JSONL file of the instrumentation
+                    by (tuple): columns to group by, default = ('run', 'stage')
+            Returns:
+                    df: pandas DataFrame with one row per group
+    '''
+    df = read_log(log_path, event='stage')
+    for col in ['rows', 'rows_per_sec']:
+        if col not in df.columns:
+            df[col] = float('nan')
+    return df.groupby(list(by)).agg(calls=('stage', 'size'), wall_s=('wall_s', 'sum'), cpu_s=('cpu_s', 'sum'),
+                                    rows=('rows', 'sum'), rows_per_sec=('rows_per_sec', 'median'),
+                                    peak_rss_mb=('peak_rss_mb', 'max'),
+                                    errors=('status', lambda s: int((s == 'error').sum()))).reset_index()
@@ -0,0 +1,425 @@
+import os
+import time
+import pickle
+import hashlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+from sklearn.model_selection import GroupKFold, ParameterSampler
+
+from lightgbm_hyperparam_nested_cv_proc import LGB_PARAM_TEST
+from instrumentation import instrumented, log_event
+
+# lgb.train lost the verbose_eval argument in LightGBM 4
+LGB_LEGACY_API = int(lgb.__version__.split('.')[0]) < 4
+
+# parameters which define the binning of a dataset. feature_pre_filter is off so a binned dataset can be reused
+# for candidates with a different min_child_samples
+DATASET_PARAMS = {'feature_pre_filter': False, 'max_bin': 255, 'verbose': -1}
+
+# data of the worker processes, set once per worker by _init_worker
+_DATA = {}
+
+
+def _init_worker(X, y, dataset_path=None):
+    _DATA['X'] = X
+    _DATA['y'] = y
+    if dataset_path is not None:
+        # the full modelset is binned once per worker, folds are subsets sharing its bins
+        _DATA['full'] = lgb.Dataset(dataset_path, params=DATASET_PARAMS).construct()
+
+
+def _train(params, train_set, num_boost_round, valid_set):
+    # returns the booster and the rmse on the validation set per boosting round
+    evals = {}
+    kwargs = {'valid_sets': [valid_set], 'valid_names': ['valid'], 'callbacks': [lgb.record_evaluation(evals)]}
+    if LGB_LEGACY_API:
+        kwargs['verbose_eval'] = False
+    booster = lgb.train(params, train_set, num_boost_round, **kwargs)
+    return booster, evals['valid']['rmse']
+
+
+def _dataset(index, reference=None):
+    if 'full' in _DATA:
+        return _DATA['full'].subset(np.sort(index))
+    X, y = _DATA['X'], _DATA['y']
+    return lgb.Dataset(X.iloc[index], label=y[index], reference=reference, free_raw_data=False,
+                       params=DATASET_PARAMS)
+
+
+def dataset_fingerprint(X, y):
+    '''
+    Returns a fingerprint of the modelset content, used as name of the cached binary dataset
+
+            Parameters:
+                    X: pandas DataFrame with the features
+                    y: numpy array with the target
+            Returns:
+                    str: sha1 hex digest of the columns, the values, the target and the binning parameters
+    '''
+    sha1 = hashlib.sha1()
+    sha1.update(repr((list(X.columns), sorted(DATASET_PARAMS.items()))).encode('utf-8'))
+    sha1.update(pd.util.hash_pandas_object(X, index=False).values.tobytes())
+    sha1.update(np.ascontiguousarray(y).tobytes())
+    return sha1.hexdigest()
+
+
+def construct_binned_dataset(X, y, dataset_cache_dir, fingerprint=None):
+    '''
+    Returns the path of the binned LightGBM dataset of the full modelset. The binary dataset is cached on disk
+    and only constructed when the modelset changed
+
+            Parameters:
+                    X: pandas DataFrame with the features
+                    y: numpy array with the target
+                    dataset_cache_dir (str): directory of the cached binary datasets
+                    fingerprint (str): dataset_fingerprint of X and y when already known, default = calculated
+            Returns:
+                    str: path of the binary dataset
+    '''
+    os.makedirs(dataset_cache_dir, exist_ok=True)
+    fingerprint = fingerprint or dataset_fingerprint(X, y)
+    path = os.path.join(dataset_cache_dir, 'lgb_dataset_' + fingerprint + '.bin')
+    if not os.path.exists(path):
+        start_time = time.time()
+        lgb.Dataset(X, label=y, params=DATASET_PARAMS).save_binary(path + '.tmp')
+        os.replace(path + '.tmp', path)
+        print('Constructed binned dataset in {:.1f} seconds: {}'.format(time.time() - start_time, path))
+    return path
+
+
+def _booster_params(candidate, num_threads, random_state, early_stopping_rounds):
+    params = {'objective': 'rmse', 'metric': 'rmse', 'seed': random_state, 'num_threads': num_threads,
+              'verbose': -1, 'feature_pre_filter': False}
+    if early_stopping_rounds:
+        params['early_stopping_round'] = early_stopping_rounds
+    params.update(candidate)
+    return params
+
+
+def _candidate_task(fold, rung, candidate_id, candidate, outer_train, inner_splits, num_boost_round, num_threads,
+                    random_state, early_stopping_rounds):
+    # evaluates one candidate on the inner folds of one outer fold. Early stopping uses the inner validation fold
+    start_time = time.time()
+    params = _booster_params(candidate, num_threads, random_state, early_stopping_rounds)
+
+    scores, fit_times, best_iterations = [], [], []
+    for inner_train, inner_valid in inner_splits:
+        fit_start = time.time()
+        train_index, valid_index = outer_train[inner_train], outer_train[inner_valid]
+        train_set = _dataset(train_index)
+        valid_set = _dataset(valid_index, reference=train_set)
+        booster, rmse = _train(params, train_set, num_boost_round, valid_set)
+        fit_times.append(time.time() - fit_start)
+
+        # rmse at the best iteration when early stopping was used, otherwise of the full model
+        best_iteration = booster.best_iteration or len(rmse)
+        best_iterations.append(best_iteration)
+        scores.append(-float(rmse[best_iteration - 1]))
+
+    return {'fold': fold, 'rung': rung, 'candidate': candidate_id, 'params': candidate, 'scores': scores,
+            'fit_times': fit_times, 'best_iterations': best_iterations,
+            'seconds': time.time() - start_time, 'pid': os.getpid()}
+
+
+def _refit_task(fold, params, outer_train, outer_test, num_boost_round, num_threads, random_state):
+    # refits the best candidate on the outer train fold. The outer test fold is only used for the evaluation
+    start_time = time.time()
+    train_set = _dataset(outer_train)
+    # without early stopping the test fold is only evaluated, it does not influence the model
+    _, rmse = _train(_booster_params(params, num_threads, random_state, None), train_set, num_boost_round,
+                     _dataset(outer_test, reference=train_set))
+
+    return {'fold': fold, 'rung': None, 'candidate': 'refit', 'rmse': float(rmse[-1]),
+            'num_boost_round': num_boost_round, 'seconds': time.time() - start_time, 'pid': os.getpid()}
+
+
+def search_rungs(search, n_iter, num_boost_round, eta=3):
+    '''
+    Returns the rungs of a hyperparameter search as (number of candidates, fraction of rides, boosting rounds)
+
+            Parameters:
+                    search (str): 'random' for a randomized search or 'halving' for successive halving
+                    n_iter (int): number of sampled candidates
+                    num_boost_round (int): maximum number of boosting rounds
+                    eta (int): with 'halving' only the best 1 / eta candidates of a rung go to the next rung, which
+                               has eta times more rides and boosting rounds, default = 3
+            Returns:
+                    list: (number of candidates, fraction of rides, boosting rounds) per rung
+    '''
+    if search == 'random':
+        return [(n_iter, 1.0, num_boost_round)]
+    if search != 'halving':
+        raise ValueError("search should be 'random' or 'halving', got {}".format(search))
+
+    n_rungs = max(1, int(np.floor(np.log(n_iter) / np.log(eta))))
+    rungs = []
+    for rung in range(n_rungs):
+        fraction = float(eta) ** (rung - (n_rungs - 1))
+        rungs.append((int(np.ceil(n_iter / eta**rung)), fraction, max(1, int(np.ceil(num_boost_round * fraction)))))
+    return rungs
+
+
+def cv_results_from_candidates(candidates):
+    '''
+    Returns RandomizedSearchCV.cv_results_ shaped results for the evaluated candidates of one outer fold
+
+            Parameters:
+                    candidates (list): result of the highest rung of every candidate of one outer fold
+            Returns:
+                    dict: params, param_<name>, split<i>_test_score, mean/std/rank_test_score, mean/std_fit_time and
+                          the rung ('iter') and fraction of rides ('n_resources') of the scores
+    '''
+    scores = np.array([c['scores'] for c in candidates])
+    fit_times = np.array([c['fit_times'] for c in candidates])
+
+    results = {'params': [c['params'] for c in candidates]}
+    for name in sorted(set(name for c in candidates for name in c['params'])):
+        results['param_' + name] = np.ma.masked_array([c['params'].get(name) for c in candidates], dtype=object,
+                                                      mask=[name not in c['params'] for c in candidates])
+    for i in range(scores.shape[1]):
+        results['split{}_test_score'.format(i)] = scores[:, i]
+    results['mean_test_score'] = scores.mean(axis=1)
+    results['std_test_score'] = scores.std(axis=1)
+    results['iter'] = np.array([c['rung'] for c in candidates])
+    results['n_resources'] = np.array([c['fraction'] for c in candidates])
+    # rank 1 is the best (highest) score of the highest rung, like sklearn
+    order = np.lexsort((-results['mean_test_score'], -results['iter']))
+    results['rank_test_score'] = np.empty(len(candidates), dtype=np.int32)
+    results['rank_test_score'][order] = np.arange(1, len(candidates) + 1)
+    results['mean_fit_time'] = fit_times.mean(axis=1)
+    results['std_fit_time'] = fit_times.std(axis=1)
+
+    return results
+
+
+def _checkpoint_path(checkpoint_dir, fold, rung, candidate):
+    if candidate == 'refit':
+        return os.path.join(checkpoint_dir, 'fold{:02d}_outer.pkl'.format(fold))
+    return os.path.join(checkpoint_dir, 'fold{:02d}_rung{}_cand{:03d}.pkl'.format(fold, rung, candidate))
+
+
+def _run_fingerprint(data_fingerprint, groups, settings):
+    # fingerprint of everything a task result depends on: the modelset, the rides and the tuning arguments
+    sha1 = hashlib.sha1(data_fingerprint.encode('utf-8'))
+    sha1.update(pd.util.hash_pandas_object(pd.Series(groups, dtype=object), index=False).values.tobytes())
+    sha1.update(repr(sorted(settings.items())).encode('utf-8'))
+    return sha1.hexdigest()
+
+
+def _save_checkpoint(path, result):
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(result, f)
+    os.replace(path + '.tmp', path)
+
+
+def _subsample_rides(train_index, groups, fraction, min_rides, seed):
+    # rides (not records) are sampled, the same rides for all candidates of a rung
+    if fraction >= 1:
+        return train_index
+    rides = np.unique(groups[train_index])
+    n_rides = min(len(rides), max(min_rides, int(round(fraction * len(rides)))))
+    sampled = np.random.RandomState(seed).choice(rides, n_rides, replace=False)
+    return train_index[np.isin(groups[train_index], sampled)]
+
+
+@instrumented()
+def run_nested_cv(df, num_boost_round=50, n_iter=25, number_inner_splits=5, number_outer_splits=10,
+                  proc_results_name='list_model_lgb', checkpoint_dir=None, cpu_budget=None, num_threads=1,
+                  early_stopping_rounds=5, random_state=101, reuse_dataset=False, dataset_cache_dir=None,
+                  search='random', eta=3):
+    '''
+    Returns outer and inner cv results for nested cross-validation in lightgbm with hyperparameter search.
+    Outer folds x candidates run as tasks in a process pool, every finished task is checkpointed, so a run
+    which stopped resumes where it stopped
+
+            Parameters:
+                    df: pandas DataFrame object based on second by second data with 'hr' and 'filename'
+                    num_boost_round (int): maximum number of boosting rounds, default = 50
+                    n_iter (int): number of candidates sampled from LGB_PARAM_TEST, default = 25
+                    number_inner_splits (int): number of inner folds, default = 5
+                    number_outer_splits (int): number of outer folds, default = 10
+                    proc_results_name (str): prefix name for output file results of inner and outer fold
+                    checkpoint_dir (str): directory for the checkpoints, default = proc_results_name + '_checkpoints'.
+                                          Checkpoints of a run on other data or with other tuning arguments are
+                                          not resumed
+                    cpu_budget (int): total number of cpus used, default = all cpus
+                    num_threads (int): LightGBM threads per task. cpu_budget // num_threads tasks run at once
+                    early_stopping_rounds (int): early stopping on the inner validation fold, default = 5
+                    random_state (int): seed of the candidate sampling and LightGBM, default = 101
+                    reuse_dataset (bool): bin the full modelset once and train on Dataset.subset of it for every
+                                          fold and candidate, instead of binning every fold again, default = False
+                    dataset_cache_dir (str): directory to cache the binned dataset between runs (with reuse_dataset),
+                                             default = proc_results_name + '_datasets'
+                    search (str): 'random' (default) evaluates all candidates on all rides and boosting rounds.
+                                  'halving' uses successive halving: candidates start on a fraction of the rides
+                                  and boosting rounds and only the best 1 / eta go to the next rung (see search_rungs)
+                    eta (int): reduction factor of successive halving, default = 3
+            Returns:
+                    outer_fold_results (list): rmse per outer fold
+                    inner_fold_results (list): cv_results_ shaped dict per outer fold
+                    timings (list): seconds, worker pid, fold, rung and candidate per task
+    '''
+    checkpoint_dir = checkpoint_dir or proc_results_name + '_checkpoints'
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    cpu_budget = cpu_budget or os.cpu_count()
+    n_workers = max(1, cpu_budget // num_threads)
+
+    groups = df['filename'].to_numpy()
+    X = df.drop(columns=['hr','filename'])
+    y = df['hr'].to_numpy(dtype=np.float64)
+
+    # the same candidates are evaluated in every outer fold, like RandomizedSearchCV with a fixed random_state
+    candidates = list(ParameterSampler(LGB_PARAM_TEST, n_iter=n_iter, random_state=random_state))
+    rungs = search_rungs(search, n_iter, num_boost_round, eta)
+
+    # checkpoints only belong to this run when the modelset, the rides and the tuning arguments are the same.
+    # The search and the resources of every rung are part of it: a rung 0 result of a random search is on all
+    # rides and boosting rounds, the rung 0 result of successive halving on a fraction of them. The dataset mode too,
+    # the bins of the full modelset differ from the bins of every fold
+    data_fingerprint = dataset_fingerprint(X, y)
+    fingerprint = _run_fingerprint(data_fingerprint, groups,
+                                   {'n_iter': n_iter, 'random_state': random_state,
+                                    'number_inner_splits': number_inner_splits,
+                                    'number_outer_splits': number_outer_splits, 'num_boost_round': num_boost_round,
+                                    'early_stopping_rounds': early_stopping_rounds, 'search': search, 'eta': eta,
+                                    'rungs': rungs, 'reuse_dataset': reuse_dataset})
+
+    inner_CV = GroupKFold(n_splits = number_inner_splits)
+    outer_CV = GroupKFold(n_splits = number_outer_splits)
+
+    folds = list(outer_CV.split(X, y, groups=groups))
+
+    # training records and inner splits per fold and rung
+    rung_data = {}
+    for fold, (train_index, _) in enumerate(folds):
+        for rung, (_, fraction, _) in enumerate(rungs):
+            index = _subsample_rides(train_index, groups, fraction, number_inner_splits,
+                                     random_state + 1000 * fold + rung)
+            rung_data[(fold, rung)] = (index, list(inner_CV.split(index, groups=groups[index])))
+
+    # resume from the checkpoints of an earlier run
+    results = {}
+    stale = 0
+    for name in os.listdir(checkpoint_dir):
+        if name.endswith('.pkl'):
+            with open(os.path.join(checkpoint_dir, name), 'rb') as f:
+                result = pickle.load(f)
+            if result.get('fingerprint') != fingerprint:
+                stale += 1
+                continue
+            results[(result['fold'], result['rung'], result['candidate'])] = result
+    if stale:
+        print('Ignoring {} checkpoints of another modelset or tuning configuration in {}'.format(stale,
+                                                                                               checkpoint_dir))
+    if results:
+        print('Resuming with {} finished tasks from {}'.format(len(results), checkpoint_dir))
+
+    start_time = time.time()
+
+    def survivors(fold, rung):
+        # candidates of a rung: all candidates in the first rung, the best of the previous rung afterwards
+        if rung == 0:
+            return list(range(len(candidates)))
+        previous = survivors(fold, rung - 1)
+        scores = [np.mean(results[(fold, rung - 1, c)]['scores']) for c in previous]
+        order = np.argsort(-np.array(scores), kind='stable')
+        return [previous[i] for i in order[:rungs[rung][0]]]
+
+    def rung_done(fold, rung):
+        return all((fold, rung, c) in results for c in survivors(fold, rung))
+
+    def current_rung(fold):
+        rung = 0
+        while rung < len(rungs) - 1 and rung_done(fold, rung):
+            rung += 1
+        return rung
+
+    def fold_candidates(fold):
+        # the result of the highest rung of every candidate
+        last = {}
+        for rung in range(current_rung(fold) + 1):
+            for c in survivors(fold, rung):
+                if (fold, rung, c) in results:
+                    last[c] = results[(fold, rung, c)]
+        return [last[c] for c in sorted(last)]
+
+    def submit_rung(executor, futures, fold):
+        rung = current_rung(fold)
+        if rung_done(fold, rung):
+            if (fold, None, 'refit') not in results:
+                inner = [results[(fold, rung, c)] for c in survivors(fold, rung)]
+                best = int(np.argmax([np.mean(c['scores']) for c in inner]))
+                # refit with the mean best iteration of the inner folds of the best candidate
+                rounds = int(np.ceil(np.mean(inner[best]['best_iterations'])))
+                train_index, test_index = folds[fold]
+                future = executor.submit(_refit_task, fold, inner[best]['params'], train_index, test_index, rounds,
+                                         num_threads, random_state)
+                futures[future] = (fold, None, 'refit')
+            return
+        index, inner_splits = rung_data[(fold, rung)]
+        for c in survivors(fold, rung):
+            if (fold, rung, c) not in results:
+                future = executor.submit(_candidate_task, fold, rung, c, candidates[c], index, inner_splits,
+                                         rungs[rung][2], num_threads, random_state, early_stopping_rounds)
+                futures[future] = (fold, rung, c)
+
+    dataset_path = None
+    if reuse_dataset:
+        dataset_path = construct_binned_dataset(X, y, dataset_cache_dir or proc_results_name + '_datasets',
+                                                data_fingerprint)
+        # the workers only need the binned dataset
+        X = None
+
+    with ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker,
+                             initargs=(X, y, dataset_path)) as executor:
+        futures = {}
+        for fold in range(len(folds)):
+            submit_rung(executor, futures, fold)
+
+        while futures:
+            future = next(as_completed(futures))
+            fold, rung, candidate = futures.pop(future)
+            result = future.result()
+            if candidate != 'refit':
+                result['fraction'] = rungs[rung][1]
+            result['fingerprint'] = fingerprint
+            results[(fold, rung, candidate)] = result
+            _save_checkpoint(_checkpoint_path(checkpoint_dir, fold, rung, candidate), result)
+            log_event('cv_task', fold=fold, rung=rung, candidate=candidate, seconds=result['seconds'],
+                      worker_pid=result['pid'],
+                      score=result['rmse'] if candidate == 'refit' else float(np.mean(result['scores'])))
+
+            if candidate == 'refit':
+                inner = cv_results_from_candidates(fold_candidates(fold))
+                best = int(np.argmin(inner['rank_test_score']))
+                print('>fold=%d, rmse=%.3f, est=%.3f, cfg=%s' % (fold, result['rmse'], -inner['mean_test_score'][best],
+                                                                  inner['params'][best]))
+            elif rung_done(fold, rung):
+                # the next rung, or the refit after the last rung
+                submit_rung(executor, futures, fold)
+
+    inner_fold_results = [cv_results_from_candidates(fold_candidates(fold)) for fold in range(len(folds))]
+    outer_fold_results = [results[(fold, None, 'refit')]['rmse'] for fold in range(len(folds))]
+    timings = [{key: result[key] for key in ['fold', 'rung', 'candidate', 'seconds', 'pid']}
+               for _, result in sorted(results.items(), key=lambda item: str(item[0]))]
+
+    # summarize the estimated performance of the model
+    print('RSME: %.3f (%.3f)' % (np.mean(outer_fold_results), np.std(outer_fold_results)))
+
+    # dump the files
+    with open(proc_results_name + "_inner" + ".pkl", 'wb') as f:
+        pickle.dump(inner_fold_results, f)
+
+    with open(proc_results_name + "_outer" + ".pkl", 'wb') as f:
+        pickle.dump(outer_fold_results, f)
+
+    with open(proc_results_name + "_timings" + ".pkl", 'wb') as f:
+        pickle.dump(timings, f)
+
+    print(f"Runtime of the program is {time.time() - start_time} seconds, "
+          f"{sum(t['seconds'] for t in timings)} task seconds on {n_workers} workers x {num_threads} threads")
+
+    return outer_fold_results, inner_fold_results, timings
@@ -2,12 +2,73 @@ import pandas as pd
 import numpy as np
 from sklearn.metrics import mean_squared_error, r2_score
 
+from instrumentation import instrumented
+
 def rmse_r2_test(g):
     rmse_test = np.sqrt(mean_squared_error(g['hr'], g['pred_hr']))
     r2_test = r2_score(g['hr'], g['pred_hr'] )
     return pd.Series({'rmse_test':rmse_test, 'r2_test':r2_test})
 
-def metrics_feat_sel(df_test_name, df_test_name_incl, y_test, model_name, name_output, scaled_test_set=True):
+def predict_in_chunks(model_name, X, chunksize=500000):
+    '''
+    Returns the predictions of a model, predicted in chunks into one preallocated array
+
+            Parameters:
+                    model_name: fitted model object with a predict method
+                    X: numpy array or pandas DataFrame
+                    chunksize (int): maximum number of records per predict call, default = 500000
+            Returns:
+                    numpy array with the float64 prediction of every record
+    '''
+    n = X.shape[0]
+    pred = np.empty(n, dtype=np.float64)
+    for start in range(0, n, chunksize):
+        end = min(start + chunksize, n)
+        chunk = X.iloc[start:end] if isinstance(X, pd.DataFrame) else X[start:end]
+        pred[start:end] = np.ravel(model_name.predict(chunk))
+    return pred
+
+def _r2(sse, sst, n):
+    # same edge cases as sklearn r2_score: NaN for less than two records, 1 for a perfect fit of a constant
+    with np.errstate(divide='ignore', invalid='ignore'):
+        r2 = 1 - sse / sst
+    r2 = np.where(sst == 0, np.where(sse == 0, 1.0, 0.0), r2)
+    return np.where(n < 2, np.nan, r2)
+
+def metrics_vectorized(filename, y_true, y_pred):
+    '''
+    Returns RMSE and R2 per ride from grouped sums of the residuals and squares, and the total RMSE and R2
+
+            Parameters:
+                    filename: array with the ride filename of every record
+                    y_true: array with the heart rate of every record
+                    y_pred: array with the predicted heart rate of every record
+            Returns:
+                    DataFrame: pandas DataFrame with filename, rmse_test and r2_test per ride (sorted by filename)
+                    rmse_total (float): RMSE over all records
+                    r2_total (float): R2 over all records
+    '''
+    y_true = np.asarray(y_true, dtype=np.float64)
+    y_pred = np.asarray(y_pred, dtype=np.float64)
+    codes, names = pd.factorize(np.asarray(filename), sort=True)
+
+    n = np.bincount(codes, minlength=len(names))
+    sse = np.bincount(codes, weights=(y_true - y_pred)**2, minlength=len(names))
+    # sum of squares around the ride mean, with the ride mean subtracted first for precision
+    mean = np.bincount(codes, weights=y_true, minlength=len(names)) / np.maximum(n, 1)
+    sst = np.bincount(codes, weights=(y_true - mean[codes])**2, minlength=len(names))
+
+    df_model_metrics = pd.DataFrame({'filename': names, 'rmse_test': np.sqrt(sse / np.maximum(n, 1)),
+                                     'r2_test': _r2(sse, sst, n)})
+
+    rmse_total = np.sqrt(sse.sum() / len(y_true))
+    r2_total = float(_r2(sse.sum(), ((y_true - y_true.mean())**2).sum(), len(y_true)))
+
+    return df_model_metrics, rmse_total, r2_total
+
+@instrumented()
+def metrics_feat_sel(df_test_name, df_test_name_incl, y_test, model_name, name_output, scaled_test_set=True,
+                     engine='groupby', chunksize=500000):
     '''
     Returns a pandas DataFrame with RMSE, R2 and modelname on ride level
 
@@ -18,9 +79,27 @@ def metrics_feat_sel(df_test_name, df_test_name_incl, y_test, model_name, name_o
                     model_name: name given to fitted sklearn model object
                     name_output: (str) preferred modelname in DataFrame column output
                     scaled_test_set: (default) set to True if model based on scaled train and testset
+                    engine: (str) 'groupby' (default) or 'vectorized'. The vectorized engine predicts once, in chunks,
+                            and calculates all metrics from grouped sums without copying the testset
+                    chunksize: (int) number of records per predict call of the vectorized engine, default = 500000
             Returns:
                     DataFrame: pandas DataFrame with RMSE, R2 and modelname on ride level
     '''
+    if engine == 'vectorized':
+        # both testset variants are aligned on position, like the scaled testset
+        pred_hr = predict_in_chunks(model_name, df_test_name, chunksize)
+        df_model_metrics, rmse_total, r2_total = metrics_vectorized(df_test_name_incl['filename'].to_numpy(),
+                                                                    np.ravel(np.asarray(y_test)), pred_hr)
+        df_model_metrics['name'] = 'metrics_' + name_output
+
+        print ('Mean RMSE over files', np.mean(df_model_metrics.rmse_test))
+        print ('Total RMSE', rmse_total)
+        print ('R2 test', r2_total)
+
+        return df_model_metrics
+    elif engine != 'groupby':
+        raise ValueError("engine should be 'groupby' or 'vectorized', got {}".format(engine))
+
     if scaled_test_set:
         X_tst = pd.DataFrame(df_test_name.copy())
 
@@ -1,36 +1,293 @@
 # function to reduce memory. Will be used frequently in code
-# code from kaggle https://www.kaggle.com/gemartin/load-data-reduce-memory-usage
+# originally based on code from kaggle https://www.kaggle.com/gemartin/load-data-reduce-memory-usage
+# the downcast is now planned first: the schema is inferred from streaming min/max values and the precision loss
+# of every float column, so lat/lon or cumulative features are not blindly converted to float16
+
+import json
 
 import numpy as np
+import pandas as pd
+from pandas.api.types import union_categoricals
+
+from instrumentation import instrumented
+
+INT_TYPES = [np.uint8, np.int8, np.uint16, np.int16, np.uint32, np.int32, np.uint64, np.int64]
+FLOAT_TYPES = [np.float16, np.float32]
+
+
+def _is_text(dtype):
+    return not isinstance(dtype, pd.CategoricalDtype) and (dtype == object or pd.api.types.is_string_dtype(dtype))
+
+
+class DowncastPlan:
+    '''
+    Reusable downcast schema (column name -> dtype) as inferred by plan_downcast
+
+            Parameters:
+                    dtypes (dict): target dtype per column, e.g. {'hr': 'uint8', 'lat': 'float64', 'filename': 'category'}
+    '''
+
+    def __init__(self, dtypes):
+        self.dtypes = dict(dtypes)
+        self.report = None
+
+    def __repr__(self):
+        return 'DowncastPlan({})'.format(self.dtypes)
+
+    def save(self, path):
+        '''
+        Saves the plan as json, so later loads can skip the inference step
+        '''
+        with open(path, 'w') as f:
+            json.dump(self.dtypes, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Returns a DowncastPlan saved with DowncastPlan.save
+        '''
+        with open(path, 'r') as f:
+            return cls(json.load(f))
+
+    def apply(self, df, verbose=True):
+        return apply_downcast_plan(df, self, verbose=verbose)
+
+    def read_csv(self, path, chunksize=1000000, **kwargs):
+        return read_csv_downcast(path, plan=self, chunksize=chunksize, **kwargs)
+
+
+class _ColumnStats:
+    # running statistics of one column over all chunks
+
+    def __init__(self, dtype):
+        self.dtype = dtype
+        self.min = np.inf
+        self.max = -np.inf
+        self.rows = 0
+        self.float_errors = [0.0 for _ in FLOAT_TYPES]
+        self.uniques = set()
+        self.too_many_uniques = False
+
+    def update(self, values, categorical_max_ratio):
+        self.rows += len(values)
+        if self.dtype.kind in 'iuf':
+            values = values.to_numpy()
+            if self.dtype.kind == 'f':
+                values = values[~np.isnan(values)]
+            if len(values) == 0:
+                return
+            self.min = min(self.min, values.min())
+            self.max = max(self.max, values.max())
+            if self.dtype.kind == 'f':
+                # largest absolute error when converting to float16 and float32 (infinite values convert exactly)
+                values = values[np.isfinite(values)]
+                with np.errstate(over='ignore', invalid='ignore'):
+                    for i, float_type in enumerate(FLOAT_TYPES):
+                        error = np.abs(values.astype(float_type).astype(np.float64) - values).max()
+                        self.float_errors[i] = max(self.float_errors[i], error if np.isfinite(error) else np.inf)
+        elif _is_text(self.dtype) and not self.too_many_uniques:
+            self.uniques.update(values.dropna().unique())
+            if len(self.uniques) > categorical_max_ratio * max(self.rows, 1):
+                self.too_many_uniques = True
+                self.uniques = set()
+
+    def target(self, tolerance, categorical_max_ratio):
+        if self.dtype.kind in 'iu':
+            if self.rows == 0 or not np.isfinite(self.min):
+                return str(self.dtype)
+            for int_type in INT_TYPES:
+                info = np.iinfo(int_type)
+                if self.min >= info.min and self.max <= info.max:
+                    return np.dtype(int_type).name
+        elif self.dtype.kind == 'f':
+            for float_type, error in zip(FLOAT_TYPES, self.float_errors):
+                if error <= tolerance:
+                    return np.dtype(float_type).name
+            return 'float64'
+        elif _is_text(self.dtype):
+            if not self.too_many_uniques and len(self.uniques) <= categorical_max_ratio * self.rows:
+                return 'category'
+        return str(self.dtype)
+
+
+def plan_downcast(chunks, tolerance=1e-3, tolerances=None, categorical_max_ratio=0.5):
+    '''
+    Returns a DowncastPlan inferred from streaming min/max values and the precision loss of float columns
+
+            Parameters:
+                    chunks: pandas DataFrame or iterable of DataFrames (e.g. pd.read_csv(path, chunksize=1000000))
+                    tolerance (float): maximum absolute error allowed when downcasting floats, default = 1e-3
+                    tolerances (dict): optional tolerance per column overruling the default tolerance
+                    categorical_max_ratio (float): text columns with at most this ratio of unique values per record
+                                                   become categorical (e.g. 'filename'), default = 0.5
+            Returns:
+                    DowncastPlan: target dtype per column
+    '''
+    if isinstance(chunks, pd.DataFrame):
+        chunks = [chunks]
+    tolerances = tolerances or {}
+
+    stats = {}
+    for chunk in chunks:
+        for col in chunk.columns:
+            if col not in stats:
+                stats[col] = _ColumnStats(chunk[col].dtype)
+            stats[col].update(chunk[col], categorical_max_ratio)
+
+    return DowncastPlan({col: s.target(tolerances.get(col, tolerance), categorical_max_ratio)
+                         for col, s in stats.items()})
+
 
-def reduce_mem_usage(df, verbose=True):
-    import numpy as np
-    numerics = ['int16', 'int32', 'int64', 'float16', 'float32', 'float64']
-    start_mem = df.memory_usage().sum() / 1024**2
+def _fitting_dtype(values, dtype):
+    # the dtype of the plan, or a wider dtype when the values do not fit it (e.g. new data read with a saved plan).
+    # The wider dtype also holds the range of the planned dtype, so columns converted earlier still fit
+    if dtype == 'category' or values.dtype.kind not in 'iufb':
+        return dtype
+    target = np.dtype(dtype)
+    if target.kind not in 'iuf':
+        return dtype
+    x = values.to_numpy()
+    if values.dtype.kind == 'f':
+        x = x[~np.isnan(x)]
+        if target.kind in 'iu' and (len(x) < len(values) or not np.all(np.isfinite(x)) or np.any(x != np.round(x))):
+            # missing, infinite or fractional values do not fit an integer
+            return 'float64'
+    if len(x) == 0:
+        return dtype
+    lo, hi = x.min(), x.max()
+
+    if target.kind in 'iu':
+        info = np.iinfo(target)
+        if lo >= info.min and hi <= info.max:
+            return dtype
+        for int_type in INT_TYPES:
+            wider = np.iinfo(int_type)
+            if wider.min <= min(lo, info.min) and wider.max >= max(hi, info.max):
+                return np.dtype(int_type).name
+        return 'float64'
+
+    finite = x[np.isfinite(x)] if values.dtype.kind == 'f' else x
+    largest = np.abs(finite).max() if len(finite) else 0
+    for float_type in [float_type for float_type in FLOAT_TYPES + [np.float64] if np.dtype(float_type) >= target]:
+        if largest <= np.finfo(float_type).max:
+            return np.dtype(float_type).name
+    return 'float64'
+
+
+def _memory_mb(df):
+    return df.memory_usage(deep=True).sum() / 1024**2
+
+
+def _widen_plan(plan, col, values, verbose):
+    # dtype of a column of the plan, widened (in the plan) when the values do not fit
+    dtype = _fitting_dtype(values, plan.dtypes[col])
+    if dtype != plan.dtypes[col]:
+        if verbose:
+            print('Column {} does not fit {}, widened to {}'.format(col, plan.dtypes[col], dtype))
+        plan.dtypes[col] = dtype
+    return dtype
+
+
+def apply_downcast_plan(df, plan, verbose=True):
+    '''
+    Returns the pandas DataFrame converted to the dtypes of a DowncastPlan. Columns are converted one at a time and
+    unchanged columns are not copied, so peak memory stays at the frame plus its (smaller) downcast columns.
+    Values never wrap or overflow: a column whose values do not fit its planned dtype gets a wider dtype, which is
+    stored in the plan
+
+            Parameters:
+                    df: pandas DataFrame object
+                    plan: DowncastPlan object
+                    verbose (bool): print the memory usage after optimization
+            Returns:
+                    df: pandas DataFrame with downcasted columns. The memory report is stored in plan.report
+    '''
+    start_mem = _memory_mb(df)
+
+    columns = {}
     for col in df.columns:
-        col_type = df[col].dtypes
-        if col_type in numerics:
-            c_min = df[col].min()
-            c_max = df[col].max()
-            if str(col_type)[:3] == 'int':
-                if c_min > np.iinfo(np.int8).min and c_max < np.iinfo(np.int8).max:
-                    df[col] = df[col].astype(np.int8)
-                elif c_min > np.iinfo(np.int16).min and c_max < np.iinfo(np.int16).max:
-                    df[col] = df[col].astype(np.int16)
-                elif c_min > np.iinfo(np.int32).min and c_max < np.iinfo(np.int32).max:
-                    df[col] = df[col].astype(np.int32)
-                elif c_min > np.iinfo(np.int64).min and c_max < np.iinfo(np.int64).max:
-                    df[col] = df[col].astype(np.int64)
-            else:
-                if c_min > np.finfo(np.float16).min and c_max < np.finfo(np.float16).max:
-                    df[col] = df[col].astype(np.float16)
-                elif c_min > np.finfo(np.float32).min and c_max < np.finfo(np.float32).max:
-                    df[col] = df[col].astype(np.float32)
-                else:
-                    df[col] = df[col].astype(np.float64)
-
-    end_mem = df.memory_usage().sum() / 1024**2
-    print('Memory usage after optimization is: {:.2f} MB'.format(end_mem))
-    print('Decreased by {:.1f}%'.format(100 * (start_mem - end_mem) / start_mem))
-
-    return df
\ No newline at end of file
+        values = df[col]
+        dtype = plan.dtypes.get(col)
+        if dtype is not None and str(values.dtype) != dtype:
+            dtype = _widen_plan(plan, col, values, verbose)
+            values = values.astype(dtype)
+        columns[col] = values
+    df = pd.concat(columns, axis=1, copy=False) if columns else df
+
+    end_mem = _memory_mb(df)
+    plan.report = {'start_mb': start_mem, 'end_mb': end_mem,
+                   'decrease_perc': 100 * (start_mem - end_mem) / start_mem if start_mem else 0.0}
+    if verbose:
+        print('Memory usage after optimization is: {:.2f} MB'.format(end_mem))
+        print('Decreased by {:.1f}%'.format(plan.report['decrease_perc']))
+
+    return df
+
+
+def read_csv_downcast(path, plan=None, chunksize=1000000, tolerance=1e-3, verbose=True, **kwargs):
+    '''
+    Returns a pandas DataFrame read from csv in chunks, with every chunk converted while reading, so the full
+    frame is never held with its original dtypes. Columns whose values do not fit the plan are widened, like
+    apply_downcast_plan
+
+            Parameters:
+                    path (str): path of the csv file
+                    plan: DowncastPlan object, default infers the plan with a first streaming pass over the file
+                    chunksize (int): number of records per chunk, default = 1000000
+                    tolerance (float): maximum absolute error when downcasting floats (only used to infer a plan)
+                    verbose (bool): print the memory usage after optimization
+                    **kwargs: passed on to pd.read_csv
+            Returns:
+                    df: pandas DataFrame with downcasted columns
+    '''
+    if plan is None:
+        plan = plan_downcast(pd.read_csv(path, chunksize=chunksize, **kwargs), tolerance=tolerance)
+
+    # every chunk is parsed with the inferred dtypes and checked against the plan before it is converted, the csv
+    # parser itself would wrap values which do not fit. Categories are united after reading
+    chunks = []
+    for chunk in pd.read_csv(path, chunksize=chunksize, **kwargs):
+        for col in plan.dtypes:
+            if col in chunk.columns and str(chunk[col].dtype) != plan.dtypes[col]:
+                chunk[col] = chunk[col].astype(_widen_plan(plan, col, chunk[col], verbose))
+        chunks.append(chunk)
+
+    if not chunks:
+        return pd.read_csv(path, **kwargs)
+
+    # columns widened by a later chunk
+    for chunk in chunks:
+        for col, dtype in plan.dtypes.items():
+            if col in chunk.columns and dtype != 'category' and str(chunk[col].dtype) != dtype:
+                chunk[col] = chunk[col].astype(dtype)
+
+    categories = {col: union_categoricals([chunk[col] for chunk in chunks]) for col, dtype in plan.dtypes.items()
+                  if dtype == 'category' and col in chunks[0].columns}
+    for chunk in chunks:
+        for col in categories:
+            chunk[col] = pd.Categorical(chunk[col], categories=categories[col].categories)
+
+    df = pd.concat(chunks, ignore_index=True, copy=False)
+    if verbose:
+        print('Memory usage after optimization is: {:.2f} MB'.format(_memory_mb(df)))
+
+    return df
+
+
+@instrumented()
+def reduce_mem_usage(df, verbose=True, plan=None, tolerance=1e-3):
+    '''
+    Returns a pandas DataFrame with reduced memory usage
+
+            Parameters:
+                    df: pandas DataFrame object
+                    verbose (bool): print the memory usage after optimization, default = True
+                    plan: optional DowncastPlan object (e.g. from an earlier load) which skips the inference step
+                    tolerance (float): maximum absolute error allowed when downcasting floats, default = 1e-3
+            Returns:
+                    df: pandas DataFrame with downcasted columns
+    '''
+    if plan is None:
+        plan = plan_downcast(df, tolerance=tolerance)
+
+    return apply_downcast_plan(df, plan, verbose=verbose)
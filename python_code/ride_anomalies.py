@@ -0,0 +1,118 @@
+import numpy as np
+import pandas as pd
+
+from ride_segments import ride_segments, run_length_encode
+from instrumentation import instrumented
+
+# data quality anomalies as a compact interval index instead of row wise flag columns. Every anomaly is a run of
+# records within a ride, stored as (filename, start_secs, end_secs, kind) with both ends included
+
+# minimum length in records of a run before it counts as an anomaly
+DEFAULT_MIN_RECORDS = {'zero': 10, 'flatline': 30, 'above_max': 1, 'out_of_range': 1, 'ratio_plateau': 30}
+
+
+@instrumented()
+def detect_anomalies(df, rider_params, min_records=None):
+    '''
+    Returns the anomaly intervals of all rides, found with run-length encoding over the whole frame
+
+            Parameters:
+                    df: pandas DataFrame with second by second 'secs', 'hr', 'watts', 'cad' and 'filename',
+                        ordered by secs within a ride
+                    rider_params (dict): rider configuration with 'rider_max_watts' and 'rider_max_cad', and
+                                         optionally 'rider_min_hr' and 'rider_max_hr' for out of range heart rates
+                    min_records (dict): minimum run length per anomaly type, overrules DEFAULT_MIN_RECORDS
+            Returns:
+                    df: pandas DataFrame with filename, start_secs, end_secs and kind per interval. Kinds are
+                        zero_<col>, flatline_<col> (constant non zero values), above_max_watts, above_max_cad,
+                        out_of_range_hr and ratio_plateau (constant non zero hr / power ratio)
+    '''
+    min_records = dict(DEFAULT_MIN_RECORDS, **(min_records or {}))
+    order, names, starts, ends = ride_segments(df['filename'])
+
+    def values(col):
+        v = df[col].to_numpy(dtype=np.float64)
+        return v if order is None else v[order]
+
+    secs = values('secs')
+    cols = {col: values(col) for col in ['hr', 'watts', 'cad']}
+
+    found = []
+
+    def add_runs(kind, run_starts, run_lengths, selected, min_length):
+        selected = selected & (run_lengths >= min_length)
+        found.append((kind, run_starts[selected], run_lengths[selected]))
+
+    for col, v in cols.items():
+        # runs of equal values: zero runs and flatlines (constant non zero values, e.g. a stuck sensor)
+        run_starts, run_lengths = run_length_encode(v, starts)
+        first = v[run_starts]
+        add_runs('zero_' + col, run_starts, run_lengths, first == 0, min_records['zero'])
+        add_runs('flatline_' + col, run_starts, run_lengths, (first != 0) & ~np.isnan(first), min_records['flatline'])
+
+    for col, param in [('watts', 'rider_max_watts'), ('cad', 'rider_max_cad')]:
+        mask = cols[col] > rider_params[param]
+        run_starts, run_lengths = run_length_encode(mask, starts)
+        add_runs('above_max_' + col, run_starts, run_lengths, mask[run_starts], min_records['above_max'])
+
+    if 'rider_min_hr' in rider_params and 'rider_max_hr' in rider_params:
+        # zero heart rates are zero runs already (the notebooks set out of range heart rates to 0)
+        hr = cols['hr']
+        mask = ((hr > 0) & (hr < rider_params['rider_min_hr'])) | (hr > rider_params['rider_max_hr'])
+        run_starts, run_lengths = run_length_encode(mask, starts)
+        add_runs('out_of_range_hr', run_starts, run_lengths, mask[run_starts], min_records['out_of_range'])
+
+    # hr / power ratio plateaus: power and heart rate moving in lockstep, as in hr_power_ratio of the notebooks
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.round(cols['watts'] / cols['hr'] * 100, 2)
+    run_starts, run_lengths = run_length_encode(ratio, starts)
+    first = ratio[run_starts]
+    add_runs('ratio_plateau', run_starts, run_lengths, np.isfinite(first) & (first != 0), min_records['ratio_plateau'])
+
+    kinds = np.concatenate([np.repeat(kind, len(s)) for kind, s, _ in found]).astype(object)
+    run_starts = np.concatenate([s for _, s, _ in found]).astype(np.int64)
+    run_ends = run_starts + np.concatenate([l for _, _, l in found]).astype(np.int64) - 1
+    ride = np.searchsorted(starts, run_starts, side='right') - 1
+
+    df_anomalies = pd.DataFrame({'filename': pd.Categorical.from_codes(ride, categories=list(names)),
+                                 'start_secs': secs[run_starts], 'end_secs': secs[run_ends],
+                                 'kind': pd.Categorical(kinds)})
+    return df_anomalies.sort_values(['filename', 'start_secs', 'kind']).reset_index(drop=True)
+
+
+def anomaly_mask(df, df_anomalies, kinds=None):
+    '''
+    Returns a boolean mask of the records which are within an anomaly interval of their ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second 'secs' and 'filename'
+                    df_anomalies: pandas DataFrame from detect_anomalies
+                    kinds (list): optional anomaly kinds to use, default uses all kinds
+            Returns:
+                    numpy array with True for records within an anomaly interval
+    '''
+    if kinds is not None:
+        df_anomalies = df_anomalies[df_anomalies['kind'].isin(kinds)]
+
+    # one number per (ride, secs): the ride code times a span larger than any secs, plus the secs
+    codes, names = pd.factorize(np.concatenate([np.asarray(df['filename'], dtype=object),
+                                                np.asarray(df_anomalies['filename'], dtype=object)]))
+    row_codes, interval_codes = codes[:len(df)], codes[len(df):]
+    secs = df['secs'].to_numpy(dtype=np.float64)
+    span = max(np.nanmax(np.abs(secs)) if len(secs) else 0.0,
+               df_anomalies['end_secs'].abs().max() if len(df_anomalies) else 0.0) * 2 + 2
+    offset = span / 2
+    row_keys = row_codes * span + secs + offset
+    start_keys = np.sort(interval_codes * span + df_anomalies['start_secs'].to_numpy(dtype=np.float64) + offset)
+    end_keys = np.sort(interval_codes * span + df_anomalies['end_secs'].to_numpy(dtype=np.float64) + offset)
+
+    # intervals containing a record: the intervals starting before or at it minus those ending before it
+    containing = np.searchsorted(start_keys, row_keys, side='right') - np.searchsorted(end_keys, row_keys, side='left')
+    return containing > 0
+
+
+def drop_anomalies(df, df_anomalies, kinds=None):
+    '''
+    Returns the pandas DataFrame without the records within an anomaly interval (see anomaly_mask)
+    '''
+    return df[~anomaly_mask(df, df_anomalies, kinds)]
@@ -0,0 +1,318 @@
+import os
+import json
+import time
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from ride_ingestion import file_md5, read_ride_file
+from ride_stats_calculation import ride_stats_calculation_vectorized
+from feature_generation import DEFAULT_FEATURE_SPEC, build_feature_frame, simple_cycling_features
+from instrumentation import instrumented
+
+# bump this version when the calculation of any feature group changes, so all cached entries are invalidated
+FEATURE_SPEC_VERSION = 3
+
+# ride statistics which depend on a single rider threshold. These are cached as separate groups
+# so changing e.g. rider_max_watts only recalculates the power extremes
+EXTREME_COLUMNS = ['count_power_extremes', 'perc_power_extremes', 'count_cad_extremes', 'perc_cad_extremes']
+
+
+def preprocess_ride(df, rider_params):
+    '''
+    Returns the row level preprocessing columns of 0. Data exploration.ipynb for a single ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second data of one ride
+                    rider_params (dict): rider configuration with 'rider_min_hr' and 'rider_max_hr'
+            Returns:
+                    df: pandas DataFrame with cleaned 'hr', 'hr_power_zero', 'hr_power_ratio' and consecutive similar values
+    '''
+    out = pd.DataFrame(index=df.index)
+    # single heart rate anomalies are put to zero
+    out['hr'] = np.where(((df['hr']<rider_params['rider_min_hr']) | (df['hr']>rider_params['rider_max_hr'])), 0, df['hr'])
+    out['hr_power_zero'] = np.where((out['hr']==0) & (df['watts'] == 0) , 0,1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out['hr_power_ratio'] = np.round(df['watts']/out['hr']*100, 2)
+
+    # a ride is one segment, so the run id alone defines the consecutive similar values
+    for name, values in [('hr', out['hr']), ('power', df['watts']), ('cad', df['cad']),
+                         ('hr_power_ratio', out['hr_power_ratio'])]:
+        out['consecutive_' + name + '_similar_values'] = values.groupby(values.diff().ne(0).cumsum()).transform('size')
+
+    return out
+
+
+def cycling_features(df, rider_params):
+    '''
+    Returns the simple cycling features of 2. Feature engineering.ipynb for a single ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second data of one ride
+                    rider_params (dict): rider configuration (not used, no feature depends on it)
+            Returns:
+                    df: pandas DataFrame with corrected 'cad' and 'watts', 'rotation_speed' and 'torque'
+    '''
+    return simple_cycling_features(df)
+
+
+def engineered_features(df, rider_params):
+    '''
+    Returns the lag, rolling, delta, power and cumulative features of DEFAULT_FEATURE_SPEC for a single ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second data of one ride including 'secs' and the cycling
+                        features
+                    rider_params (dict): rider configuration (not used, no feature depends on it)
+            Returns:
+                    df: pandas DataFrame with one float32 column per feature
+    '''
+    return build_feature_frame(df, DEFAULT_FEATURE_SPEC)
+
+
+def ride_stats(df, rider_params):
+    '''
+    Returns the ride statistics of ride_stats_calculation for a single ride, without the rider threshold extremes
+
+            Parameters:
+                    df: pandas DataFrame with preprocessed second by second data of one ride
+                    rider_params (dict): rider configuration
+            Returns:
+                    df: pandas DataFrame with one row of ride statistics
+    '''
+    df_stats = ride_stats_calculation_vectorized(df, rider_params)
+    return df_stats.drop(columns=EXTREME_COLUMNS)
+
+
+def _extremes(col, name, param):
+    def calculate(df, rider_params):
+        count = int((df[col] > rider_params[param]).sum())
+        return pd.DataFrame({'count_' + name + '_extremes': [count],
+                             'perc_' + name + '_extremes': [np.round((count / len(df))*100,0)]})
+    return calculate
+
+
+# registry of the cached feature groups.
+# level: 'row' groups return one row per record, 'ride' groups one row per ride
+# params: rider parameters the group depends on directly
+# requires: groups whose columns are needed as input
+# spec: optional feature specification, part of the cache key
+FEATURE_GROUPS = {
+    'ride_preprocessing': {'level': 'row', 'function': preprocess_ride,
+                           'params': ['rider_min_hr', 'rider_max_hr'], 'requires': []},
+    'cycling_features': {'level': 'row', 'function': cycling_features,
+                         'params': [], 'requires': []},
+    'engineered_features': {'level': 'row', 'function': engineered_features,
+                            'params': [], 'requires': ['cycling_features'], 'spec': DEFAULT_FEATURE_SPEC},
+    'ride_stats': {'level': 'ride', 'function': ride_stats,
+                   'params': [], 'requires': ['ride_preprocessing']},
+    'ride_power_extremes': {'level': 'ride', 'function': _extremes('watts', 'power', 'rider_max_watts'),
+                            'params': ['rider_max_watts'], 'requires': []},
+    'ride_cad_extremes': {'level': 'ride', 'function': _extremes('cad', 'cad', 'rider_max_cad'),
+                          'params': ['rider_max_cad'], 'requires': []},
+}
+
+
+def group_params(group, rider_params):
+    '''
+    Returns the rider parameters a feature group depends on, including those of the groups it requires
+
+            Parameters:
+                    group (str): name of the feature group in FEATURE_GROUPS
+                    rider_params (dict): rider configuration
+            Returns:
+                    dict: rider parameters used (directly or indirectly) by the group
+    '''
+    spec = FEATURE_GROUPS[group]
+    params = {param: rider_params[param] for param in spec['params']}
+    for required in spec['requires']:
+        params.update(group_params(required, rider_params))
+    return params
+
+
+def cache_key(ride_md5, group, rider_params):
+    '''
+    Returns the content address of a feature group for a ride
+
+            Parameters:
+                    ride_md5 (str): md5 of the ride file
+                    group (str): name of the feature group in FEATURE_GROUPS
+                    rider_params (dict): rider configuration
+            Returns:
+                    str: sha1 hex digest of ride hash, group, spec version, feature specification and the rider parameters used
+    '''
+    key = json.dumps([ride_md5, group, FEATURE_SPEC_VERSION, FEATURE_GROUPS[group].get('spec'),
+                      group_params(group, rider_params)], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class RideFeatureCache:
+    '''
+    Content addressed, size bounded cache of per ride feature groups stored as parquet files
+
+            Parameters:
+                    cache_dir (str): directory of the cache
+                    max_bytes (int): maximum size of the cache on disk, least recently used entries are evicted first,
+                                     default = 2GB
+    '''
+    INDEX_NAME = '_index.json'
+
+    def __init__(self, cache_dir, max_bytes=2 * 1024**3):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+
+        path = os.path.join(cache_dir, self.INDEX_NAME)
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                index = json.load(f)
+        else:
+            index = {}
+        # entries: key -> size and last access, files: ride path -> mtime, size and md5
+        self.entries = index.get('entries', {})
+        self.files = index.get('files', {})
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + '.parquet')
+
+    def ride_md5(self, path):
+        '''
+        Returns the md5 of a ride file, only hashing again when its mtime or size changed
+        '''
+        stat = os.stat(path)
+        entry = self.files.get(os.path.abspath(path))
+        if entry is None or entry['mtime'] != stat.st_mtime or entry['size'] != stat.st_size:
+            entry = {'mtime': stat.st_mtime, 'size': stat.st_size, 'md5': file_md5(path)}
+            self.files[os.path.abspath(path)] = entry
+        return entry['md5']
+
+    def get(self, key):
+        '''
+        Returns the cached pandas DataFrame of a key, or None when it is not in the cache
+        '''
+        if key not in self.entries or not os.path.exists(self._path(key)):
+            self.entries.pop(key, None)
+            return None
+        self.entries[key]['last_access'] = time.time()
+        return pd.read_parquet(self._path(key))
+
+    def put(self, key, df):
+        '''
+        Stores a pandas DataFrame under a key
+        '''
+        path = self._path(key)
+        df.to_parquet(path + '.tmp', index=False)
+        os.replace(path + '.tmp', path)
+        self.entries[key] = {'size': os.path.getsize(path), 'last_access': time.time()}
+
+    def size(self):
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def evict(self):
+        '''
+        Removes the least recently used entries until the cache fits in max_bytes
+        '''
+        total = self.size()
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_access']):
+            if total <= self.max_bytes:
+                break
+            total -= self.entries.pop(key)['size']
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+
+    def save(self):
+        '''
+        Evicts entries when needed and writes the cache index to disk
+        '''
+        self.evict()
+        path = os.path.join(self.cache_dir, self.INDEX_NAME)
+        with open(path + '.tmp', 'w') as f:
+            json.dump({'entries': self.entries, 'files': self.files}, f)
+        os.replace(path + '.tmp', path)
+
+
+def ride_feature_group(cache, path, group, rider_params, _ride=None):
+    '''
+    Returns a feature group for a single ride, from the cache or calculated (and cached) when missing
+
+            Parameters:
+                    cache: RideFeatureCache object
+                    path (str): path of the ride csv file
+                    group (str): name of the feature group in FEATURE_GROUPS
+                    rider_params (dict): rider configuration
+            Returns:
+                    df: pandas DataFrame with the columns of the feature group
+    '''
+    key = cache_key(cache.ride_md5(path), group, rider_params)
+    df = cache.get(key)
+    if df is not None:
+        return df
+
+    spec = FEATURE_GROUPS[group]
+    df_ride = read_ride_file(path) if _ride is None else _ride
+    df_ride = df_ride.drop(columns=['filename'])
+    # columns of required groups replace the raw columns with the same name
+    for required in spec['requires']:
+        df_required = ride_feature_group(cache, path, required, rider_params, _ride=_ride)
+        df_ride = df_ride.drop(columns=[c for c in df_required.columns if c in df_ride.columns])
+        df_ride = pd.concat([df_ride, df_required], axis=1)
+    df_ride['filename'] = os.path.basename(path)
+
+    df = spec['function'](df_ride, rider_params).reset_index(drop=True)
+    df = df.drop(columns=['filename'], errors='ignore')
+    # row level groups keep 'secs' so cached rides never need the ride file again
+    if spec['level'] == 'row' and 'secs' not in df.columns:
+        df.insert(0, 'secs', df_ride['secs'].values)
+    cache.put(key, df)
+
+    return df
+
+
+@instrumented()
+def build_feature_table(files, rider_params, cache, groups, verbose=True):
+    '''
+    Returns the feature groups for all rides. Only rides (or groups) which are not yet in the cache are calculated,
+    so adding a ride only calculates that ride and changing a rider threshold only the groups which depend on it
+
+            Parameters:
+                    files (list): paths of ride csv files
+                    rider_params (dict): rider configuration (e.g. json.load(c)["rider_params"])
+                    cache: RideFeatureCache object
+                    groups (list): names of feature groups in FEATURE_GROUPS, all of the same level
+            Returns:
+                    df: pandas DataFrame with 'filename' and the columns of the groups. For 'row' groups also 'secs'
+    '''
+    levels = set(FEATURE_GROUPS[group]['level'] for group in groups)
+    if len(levels) != 1:
+        raise ValueError('feature groups should all be row level or all be ride level, got {}'.format(levels))
+    level = levels.pop()
+
+    start_time = time.time()
+    calculated = 0
+    frames = []
+    for path in files:
+        keys = [cache_key(cache.ride_md5(path), group, rider_params) for group in groups]
+        missing = [key for key in keys if key not in cache.entries]
+        # read the ride file once when one of its groups has to be calculated
+        df_ride = read_ride_file(path) if missing else None
+        calculated += bool(missing)
+
+        parts = [ride_feature_group(cache, path, group, rider_params, _ride=df_ride) for group in groups]
+        if level == 'row':
+            parts = parts[:1] + [part.drop(columns=['secs']) for part in parts[1:]]
+        df = pd.concat(parts, axis=1)
+        df.insert(0, 'filename', os.path.basename(path))
+        frames.append(df)
+
+    cache.save()
+
+    if verbose:
+        print('Calculated {} rides, {} from cache in {:.1f} seconds'.format(calculated, len(files) - calculated,
+                                                                            time.time() - start_time))
+
+    df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
+    if len(df):
+        df['filename'] = df['filename'].astype('category')
+
+    return df
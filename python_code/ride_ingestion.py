@@ -0,0 +1,193 @@
+import os
+import glob
+import json
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import instrumented
+
+# explicit dtypes of the 23 columns in the Golden Cheetah ride_level_data csv export
+# sensor channels can contain decimals (and blanks) depending on the device, so they are read as float32.
+# positions and distance keep float64 since float32 is not precise enough for them
+RIDE_LEVEL_DTYPES = {'secs': np.float32, 'cad': np.float32, 'hr': np.float32, 'km': np.float64, 'kph': np.float32,
+                     'nm': np.float32, 'watts': np.float32, 'alt': np.float32, 'lon': np.float64, 'lat': np.float64,
+                     'headwind': np.float32, 'slope': np.float32, 'temp': np.float32, 'interval': np.float32,
+                     'lrbalance': np.float32, 'lte': np.float32, 'rte': np.float32, 'lps': np.float32, 'rps': np.float32,
+                     'smo2': np.float32, 'thb': np.float32, 'o2hb': np.float32, 'hhb': np.float32}
+
+MANIFEST_NAME = '_manifest.json'
+
+
+def file_md5(path, block_size=1 << 20):
+    '''
+    Returns the md5 hex digest of a file
+
+            Parameters:
+                    path (str): path of the file
+                    block_size (int): number of bytes read at once, default = 1MB
+            Returns:
+                    str: md5 hex digest of the file content
+    '''
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def read_ride_file(path, columns=None):
+    '''
+    Returns a pandas DataFrame of a single Golden Cheetah ride file with explicit dtypes
+
+            Parameters:
+                    path (str): path of the ride csv file
+                    columns (list): optional subset of columns to read, default reads all 23 columns
+            Returns:
+                    df: pandas DataFrame with stripped column names and a 'filename' column
+    '''
+    # the GC export has a space after each separator. Map the raw header to the stripped names
+    with open(path, 'r') as f:
+        header = f.readline().rstrip('\n').split(',')
+    raw_names = {name.strip(): name for name in header}
+
+    names = [name for name in raw_names if columns is None or name in columns]
+    dtypes = {raw_names[name]: RIDE_LEVEL_DTYPES.get(name, np.float32) for name in names}
+
+    df = pd.read_csv(path, usecols=[raw_names[name] for name in names], dtype=dtypes)
+    df.columns = [x.strip() for x in df.columns]
+    df['filename'] = os.path.basename(path)
+
+    return df
+
+
+def _partition_path(store_dir, filename):
+    return os.path.join(store_dir, os.path.splitext(filename)[0] + '.parquet')
+
+
+def _load_manifest(store_dir):
+    path = os.path.join(store_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_manifest(store_dir, manifest):
+    # write to a temporary file first so a crash never leaves a half written manifest behind
+    path = os.path.join(store_dir, MANIFEST_NAME)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(path + '.tmp', path)
+
+
+def _ingest_one(path, store_dir, md5):
+    df = read_ride_file(path)
+    df.drop(columns=['filename']).to_parquet(_partition_path(store_dir, os.path.basename(path)), index=False)
+    return os.path.basename(path), len(df), md5
+
+
+@instrumented()
+def ingest_ride_files(files, store_dir, n_jobs=None, verbose=True):
+    '''
+    Parses ride files in a process pool and writes each ride to a partitioned parquet store.
+    Only files which are new or of which the content changed are parsed again
+
+            Parameters:
+                    files (list): paths of ride csv files (e.g. glob.glob('ride_level_data/*.csv'))
+                    store_dir (str): directory of the parquet store, one partition per filename
+                    n_jobs (int): number of worker processes, default = number of cpus
+                    verbose (bool): print the number of parsed and skipped files
+            Returns:
+                    dict: manifest with per filename the mtime, size, md5 and number of records
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    manifest = _load_manifest(store_dir)
+
+    # decide which files need parsing. The mtime and size are checked first, the hash only when these changed
+    todo = []
+    for path in files:
+        filename = os.path.basename(path)
+        stat = os.stat(path)
+        entry = manifest.get(filename)
+        if entry is not None and os.path.exists(_partition_path(store_dir, filename)):
+            if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                continue
+            md5 = file_md5(path)
+            if entry['md5'] == md5:
+                entry['mtime'], entry['size'] = stat.st_mtime, stat.st_size
+                continue
+        else:
+            md5 = file_md5(path)
+        todo.append((path, md5, stat))
+
+    if todo:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_ingest_one, path, store_dir, md5) for path, md5, _ in todo]
+            for (path, _, stat), future in zip(todo, futures):
+                filename, count_records, md5 = future.result()
+                manifest[filename] = {'mtime': stat.st_mtime, 'size': stat.st_size, 'md5': md5,
+                                      'count_records': count_records}
+
+    _save_manifest(store_dir, manifest)
+
+    if verbose:
+        print('Parsed {} ride files, {} unchanged'.format(len(todo), len(files) - len(todo)))
+
+    return manifest
+
+
+@instrumented()
+def load_ride_store(store_dir, filenames=None, columns=None):
+    '''
+    Returns a pandas DataFrame with the rides of a parquet store created by ingest_ride_files
+
+            Parameters:
+                    store_dir (str): directory of the parquet store
+                    filenames (list): optional subset of ride filenames to load, default loads all rides
+                    columns (list): optional subset of columns to load, default loads all columns
+            Returns:
+                    df: pandas DataFrame with second by second data and a categorical 'filename' column
+    '''
+    manifest = _load_manifest(store_dir)
+    if filenames is None:
+        filenames = sorted(manifest)
+
+    frames = [pd.read_parquet(_partition_path(store_dir, filename), columns=columns) for filename in filenames]
+    counts = [len(frame) for frame in frames]
+
+    df = pd.concat(frames, ignore_index=True, copy=False) if frames else pd.DataFrame(columns=columns)
+    df['filename'] = pd.Categorical.from_codes(np.repeat(np.arange(len(filenames)), counts),
+                                               categories=list(filenames))
+
+    return df
+
+
+@instrumented()
+def read_process_data(store_dir, files=None, n_jobs=None):
+    '''
+    Returns a pandas DataFrame for further processing, like read_process_data in 0. Data exploration.ipynb,
+    but based on the cached parquet store
+
+            Parameters:
+                    store_dir (str): directory of the parquet store
+                    files (list or str): ride csv files or glob pattern to ingest first, default uses the store as is
+                    n_jobs (int): number of worker processes for ingestion, default = number of cpus
+            Returns:
+                    df: pandas DataFrame with second by second data, 'filename' and 'date'
+    '''
+    if isinstance(files, str):
+        files = glob.glob(files)
+    if files is not None:
+        ingest_ride_files(files, store_dir, n_jobs=n_jobs)
+
+    # keep only the columns used further on
+    df = load_ride_store(store_dir, filenames=None if files is None else sorted(os.path.basename(fp) for fp in files),
+                         columns=['secs', 'cad', 'hr', 'watts', 'alt', 'slope', 'temp'])
+
+    dates = pd.to_datetime(pd.Series(df['filename'].cat.categories).str[:10], format='%Y_%m_%d')
+    df['date'] = dates.values[df['filename'].cat.codes.values]
+
+    return df
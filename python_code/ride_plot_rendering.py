@@ -0,0 +1,130 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import matplotlib
+from matplotlib.lines import Line2D
+
+from ride_segments import ride_segments
+from downsampling import minmax_indices
+from instrumentation import instrumented
+
+# headless rendering of ride figures (anomalies, model performance, simple ride plots) to png / svg files.
+# Series are downsampled to the pixel width of an axis and drawn as Line2D artists, without pandas plotting
+
+# series per figure kind: column, axis ('left' or 'right' for a twin axis) and line style
+SERIES_STYLES = {
+    'anomalies': [('watts', 'left', {'color': 'C0'}), ('hr', 'left', {'color': 'C1'})],
+    'model_performance': [('hr', 'left', {'color': 'C0'}), ('pred_hr', 'left', {'color': 'C1'})],
+    'simple': [('hr', 'left', {'color': 'r', 'alpha': 0.8}), ('watts', 'right', {'color': 'b', 'alpha': 0.3}),
+               ('cad', 'left', {'color': 'g', 'alpha': 0.6})],
+}
+
+
+def ride_series(df, filenames, columns):
+    '''
+    Returns the second by second arrays of the selected rides, found with one pass over the frame
+
+            Parameters:
+                    df: pandas DataFrame with 'filename', 'secs' and the columns, ordered by secs within a ride
+                    filenames (list): rides to select, in the order of the result
+                    columns (list): columns to select
+            Returns:
+                    dict: filename -> dict with 'secs' and the columns as numpy arrays
+    '''
+    selected = df['filename'].isin(filenames).to_numpy()
+    df = df.loc[selected, ['filename', 'secs'] + list(columns)]
+    order, names, starts, ends = ride_segments(df['filename'])
+
+    arrays = {}
+    for col in ['secs'] + list(columns):
+        values = df[col].to_numpy(dtype=np.float64)
+        arrays[col] = values if order is None else values[order]
+
+    rides = {}
+    for name, start, end in zip(names, starts, ends):
+        rides[name] = {col: values[start:end] for col, values in arrays.items()}
+    return {name: rides[name] for name in filenames if name in rides}
+
+
+def axis_width_px(ax):
+    # width of an axis in pixels, the useful number of points of a line
+    return max(int(ax.get_window_extent().width), 2)
+
+
+def draw_ride(ax, ride, styles, width_px=None):
+    '''
+    Draws the series of one ride on an axis, downsampled to (twice) the pixel width of the axis
+
+            Parameters:
+                    ax: matplotlib axis
+                    ride (dict): 'secs' and the columns as numpy arrays (see ride_series)
+                    styles (list): (column, 'left' or 'right', Line2D keyword arguments) per series
+                    width_px (int): width of the axis in pixels, default = measured from the axis
+            Returns:
+                    list: Line2D handles of the series
+    '''
+    width_px = width_px or axis_width_px(ax)
+    twin = None
+    handles = []
+    for col, side, style in styles:
+        target = ax
+        if side == 'right':
+            twin = twin or ax.twinx()
+            target = twin
+        # min-max per pixel column keeps every peak, which is what the eye sees at this resolution
+        idx = minmax_indices(ride[col], 2 * width_px)
+        line = Line2D(ride['secs'][idx], ride[col][idx], label=col, **style)
+        target.add_line(line)
+        target.autoscale_view()
+        handles.append(line)
+    return handles
+
+
+def _init_worker():
+    matplotlib.use('Agg')
+
+
+def _render_ride(filename, ride, kind, path, figsize, dpi):
+    import matplotlib.pyplot as plt
+
+    fig, ax = plt.subplots(figsize=figsize, dpi=dpi)
+    handles = draw_ride(ax, ride, SERIES_STYLES[kind], width_px=int(figsize[0] * dpi))
+    ax.set_title(filename)
+    ax.set_xlabel('secs')
+    ax.legend(handles=handles, loc='upper right')
+    fig.tight_layout()
+    fig.savefig(path)
+    plt.close(fig)
+    return path
+
+
+@instrumented()
+def render_ride_figures(df, filenames, output_dir, kind='anomalies', fmt='png', n_jobs=None, figsize=(10,4),
+                        dpi=100):
+    '''
+    Renders one figure per ride in a process pool with the Agg backend and writes them to a directory
+
+            Parameters:
+                    df: pandas DataFrame with 'filename', 'secs' and the columns of the figure kind
+                    filenames (list): rides to render
+                    output_dir (str): directory of the figures
+                    kind (str): 'anomalies' (watts, hr), 'model_performance' (hr, pred_hr) or 'simple'
+                                (hr, cad and watts on a twin axis), default = 'anomalies'
+                    fmt (str): 'png' (default) or 'svg'
+                    n_jobs (int): number of processes, default = all cpus
+                    figsize (tuple): figure size in inches, default = (10,4)
+                    dpi (int): dots per inch, default = 100
+            Returns:
+                    list: paths of the written figures
+    '''
+    if kind not in SERIES_STYLES:
+        raise ValueError('kind should be one of {}, got {}'.format(list(SERIES_STYLES), kind))
+    os.makedirs(output_dir, exist_ok=True)
+
+    rides = ride_series(df, filenames, [col for col, _, _ in SERIES_STYLES[kind]])
+    with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker) as executor:
+        futures = [executor.submit(_render_ride, name, ride, kind,
+                                   os.path.join(output_dir, os.path.splitext(name)[0] + '.' + fmt), figsize, dpi)
+                   for name, ride in rides.items()]
+        return [future.result() for future in futures]
@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+
+# helpers to work on contiguous ride segments instead of df.groupby('filename')
+
+
+def ride_segments(filename):
+    '''
+    Returns the ordering and boundaries of the rides in a frame with second by second data
+
+            Parameters:
+                    filename: pandas Series (or array) with the ride filename of every record
+            Returns:
+                    order: positions which sort the records by filename (stable, None when already sorted)
+                    names: numpy array with the sorted unique filenames
+                    starts: numpy array with the start position of every ride in the sorted records
+                    ends: numpy array with the end position (exclusive) of every ride in the sorted records
+    '''
+    codes, names = pd.factorize(filename, sort=True)
+    names = np.asarray(names)
+    codes = np.asarray(codes)
+
+    order = None
+    if len(codes) > 1 and (np.diff(codes) < 0).any():
+        order = np.argsort(codes, kind='stable')
+
+    counts = np.bincount(codes, minlength=len(names))
+    ends = np.cumsum(counts)
+    starts = ends - counts
+
+    return order, names, starts, ends
+
+
+def segment_ids(starts, n):
+    '''
+    Returns for every sorted record the position of its ride in starts
+
+            Parameters:
+                    starts: numpy array with the start position of every ride
+                    n (int): total number of records
+            Returns:
+                    numpy array with the ride position of every record
+    '''
+    ids = np.zeros(n, dtype=np.int64)
+    ids[starts[1:]] = 1
+    return np.cumsum(ids)
+
+
+def run_length_encode(values, starts):
+    '''
+    Returns the runs of equal consecutive values. Runs never cross ride boundaries
+
+            Parameters:
+                    values: numpy array with (sorted) second by second values
+                    starts: numpy array with the start position of every ride
+            Returns:
+                    run_starts: numpy array with the start position of every run
+                    run_lengths: numpy array with the length of every run
+    '''
+    n = len(values)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    change = np.empty(n, dtype=bool)
+    change[0] = True
+    # NaN never equals NaN, so every NaN starts its own run (like itertools.groupby)
+    change[1:] = values[1:] != values[:-1]
+    change[starts] = True
+
+    run_starts = np.flatnonzero(change)
+    run_lengths = np.diff(np.append(run_starts, n))
+
+    return run_starts, run_lengths
+
+
+def segment_longest_run(mask, starts):
+    '''
+    Returns per ride the length of the longest run of consecutive True values
+
+            Parameters:
+                    mask: boolean numpy array with (sorted) second by second values
+                    starts: numpy array with the start position of every ride
+            Returns:
+                    numpy array with the longest run per ride (0 when there is no True value)
+    '''
+    run_starts, run_lengths = run_length_encode(mask, starts)
+    selected = mask[run_starts]
+
+    longest = np.zeros(len(starts), dtype=np.int64)
+    run_ride = np.searchsorted(starts, run_starts[selected], side='right') - 1
+    np.maximum.at(longest, run_ride, run_lengths[selected])
+
+    return longest
+
+
+def segment_reduce(ufunc, values, starts, fill=np.nan):
+    '''
+    Returns per ride the reduction of the values ignoring NaN, like the pandas groupby min/max/sum
+
+            Parameters:
+                    ufunc: numpy ufunc used for the reduction (np.minimum, np.maximum or np.add)
+                    values: numpy array with (sorted) second by second values
+                    starts: numpy array with the start position of every ride
+                    fill: value for rides without any valid value, default = NaN
+            Returns:
+                    numpy array with the reduced value per ride
+    '''
+    values = np.asarray(values, dtype=np.float64)
+    if len(starts) == 0:
+        return np.zeros(0)
+
+    valid = ~np.isnan(values)
+    if valid.all():
+        return ufunc.reduceat(values, starts)
+
+    # replace NaN by the identity of the reduction so it does not count
+    identity = {np.minimum: np.inf, np.maximum: -np.inf, np.add: 0.0}[ufunc]
+    out = ufunc.reduceat(np.where(valid, values, identity), starts)
+    out[np.add.reduceat(valid, starts) == 0] = fill
+
+    return out
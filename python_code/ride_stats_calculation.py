@@ -1,12 +1,20 @@
 import numpy as np
+import pandas as pd
 import json
 
-def ride_stats_calculation(df):
+from ride_segments import ride_segments, segment_longest_run, segment_reduce
+from instrumentation import instrumented
+
+@instrumented()
+def ride_stats_calculation(df, engine='groupby', config_path='rider_config.json'):
     '''
     Returns a pandas DataFrame with ride statistics
 
             Parameters:
                     df: pandas DataFrame object based on second by second data
+                    engine (str): 'groupby' (default) for the pandas groupby calculation or 'vectorized' for the
+                                  single pass calculation over the ride segments. Both return the same columns
+                    config_path (str): path of the rider configuration, default = 'rider_config.json'
                                         
             Returns:
                     df: pandas DataFrame with ride statistics
@@ -16,9 +24,14 @@ def ride_stats_calculation(df):
     # imports the rider configuration. Define these in 'rider_config.json'
     
 
-    with open('rider_config.json', 'r') as c:
+    with open(config_path, 'r') as c:
         rider_params = json.load(c)["rider_params"]
     
+    if engine == 'vectorized':
+        return ride_stats_calculation_vectorized(df, rider_params)
+    elif engine != 'groupby':
+        raise ValueError("engine should be 'groupby' or 'vectorized', got {}".format(engine))
+    
         
     # calculate some overall statistics per ride
     df_stats = df.groupby('filename').agg(count_records = ('filename', 'size'), mean_hr = ('hr', 'mean'), 
@@ -94,4 +107,105 @@ def ride_stats_calculation(df):
     df_stats['consecutive_hr_power_ratio_similar_values'] = df.groupby('filename').consecutive_hr_power_ratio_similar_values.max().reset_index().iloc[:,1]
     df_stats['perc_consecutive_hr_power_ratio_similar_values'] = np.round((df_stats['consecutive_hr_power_ratio_similar_values'] / df_stats['count_records'])*100,0)
     
-    return df_stats
\ No newline at end of file
+    return df_stats
+
+
+def ride_stats_calculation_vectorized(df, rider_params):
+    '''
+    Returns a pandas DataFrame with ride statistics, calculated from one sort by filename.
+    All statistics are NumPy reductions over the contiguous ride segments and keyed by filename
+
+            Parameters:
+                    df: pandas DataFrame object based on second by second data
+                    rider_params (dict): rider configuration with 'rider_max_watts' and 'rider_max_cad'
+                                        
+            Returns:
+                    df: pandas DataFrame with ride statistics (same columns as ride_stats_calculation)
+    '''
+    order, names, starts, ends = ride_segments(df['filename'])
+    count_records = ends - starts
+
+    def values(col):
+        # second by second values sorted by filename
+        v = df[col].to_numpy()
+        return v if order is None else v[order]
+
+    def extreme(ufunc, v):
+        out = segment_reduce(ufunc, v, starts)
+        # keep the integer dtype of the column like the pandas groupby does
+        if np.issubdtype(v.dtype, np.integer):
+            out = out.astype(v.dtype)
+        return out
+
+    def count(mask):
+        return np.add.reduceat(mask.astype(np.int64), starts)
+
+    def perc(x):
+        return np.round((x / count_records)*100,0)
+
+    stats = {'filename': names, 'count_records': count_records}
+
+    cols = {'hr': 'hr', 'cad': 'cad', 'power': 'watts', 'temp': 'temp', 'alt': 'alt', 'slope': 'slope'}
+    data = {col: values(col) for col in cols.values()}
+
+    # mean and sample variance with a second pass over the deviations of the ride mean
+    sums, valid_counts, means = {}, {}, {}
+    for col, v in data.items():
+        valid = ~np.isnan(v) if v.dtype.kind == 'f' else np.ones(len(v), dtype=bool)
+        valid_counts[col] = count(valid)
+        sums[col] = segment_reduce(np.add, v, starts, fill=0.0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means[col] = sums[col] / valid_counts[col]
+
+    for name, col in cols.items():
+        stats['mean_' + name] = means[col]
+    for name, col in cols.items():
+        stats['min_' + name] = extreme(np.minimum, data[col])
+        stats['max_' + name] = extreme(np.maximum, data[col])
+
+    def variance(col):
+        v = data[col].astype(np.float64)
+        deviation = v - np.repeat(means[col], count_records)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            var = segment_reduce(np.add, deviation**2, starts, fill=0.0) / (valid_counts[col] - 1)
+        var[valid_counts[col] < 2] = np.nan
+        return var
+
+    stats['std_hr'] = np.sqrt(variance('hr'))
+    # note: like the groupby calculation std_power holds the variance of the power
+    stats['std_power'] = variance('watts')
+
+    df_stats = pd.DataFrame(stats)
+
+    df_stats['cv_hr'] = np.round((df_stats['std_hr'] / df_stats['mean_hr']),2)
+    df_stats['cv_power'] = np.round((df_stats['std_power'] / df_stats['mean_power']),2)
+
+    # add extent of strange records
+    for name, col in [('hr', 'hr'), ('cad', 'cad'), ('power', 'watts')]:
+        df_stats['count_zero_' + name] = count(data[col] == 0)
+    for name in ['hr', 'cad', 'power']:
+        df_stats['perc_count_zero_' + name] = perc(df_stats['count_zero_' + name])
+
+    df_stats['count_zero_hr_power'] = count(values('hr_power_zero') == 0)
+    df_stats['perc_count_zero_hr_power'] = perc(df_stats['count_zero_hr_power'])
+
+    # add variables which relates to longest period with no data (zeros)
+    for name, col in [('hr', 'hr'), ('cad', 'cad'), ('power', 'watts')]:
+        df_stats[name + '_longest_zero_run'] = segment_longest_run(data[col] == 0, starts)
+    for name in ['hr', 'cad', 'power']:
+        df_stats['perc_' + name + '_longest_zero_run'] = perc(df_stats[name + '_longest_zero_run'])
+
+    # rider specific
+    df_stats['count_power_extremes'] = count(data['watts'] > rider_params['rider_max_watts'])
+    df_stats['count_cad_extremes'] = count(data['cad'] > rider_params['rider_max_cad'])
+
+    df_stats['perc_power_extremes'] = perc(df_stats['count_power_extremes'])
+    df_stats['perc_cad_extremes'] = perc(df_stats['count_cad_extremes'])
+
+    # add longest value of consequetive similar values
+    for name in ['hr', 'power', 'cad', 'hr_power_ratio']:
+        col = 'consecutive_' + name + '_similar_values'
+        df_stats[col] = extreme(np.maximum, values(col))
+        df_stats['perc_' + col] = perc(df_stats[col])
+
+    return df_stats
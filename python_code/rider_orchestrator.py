@@ -0,0 +1,342 @@
+import os
+import sys
+import glob
+import json
+import time
+import pickle
+import hashlib
+import traceback
+import multiprocessing
+from collections import Counter
+from sklearn.model_selection import GroupKFold
+
+import numpy as np
+import pandas as pd
+import lightgbm as lgb
+import psutil
+
+from ride_ingestion import ingest_ride_files, load_ride_store
+from ride_stats_calculation import ride_stats_calculation
+from ride_feature_cache import FEATURE_SPEC_VERSION, RideFeatureCache, build_feature_table
+from lightgbm_nested_cv_runner import run_nested_cv
+from model_performance_rides import metrics_vectorized
+from instrumentation import stage as instrumented_stage
+
+# batch retraining of all riders of a club. Every rider has its own directory:
+#   <riders_dir>/<rider>/rider_config.json      {"rider_params": {...}, "tuning": {...run_nested_cv arguments}}
+#   <riders_dir>/<rider>/ride_level_data/*.csv  Golden Cheetah ride exports
+#   <riders_dir>/<rider>/output/                 results of all stages (created)
+# The stages run as a DAG per rider. A stage is skipped when the fingerprint of its inputs did not change
+
+CONFIG_NAME = 'rider_config.json'
+RIDES_DIR = 'ride_level_data'
+OUTPUT_DIR = 'output'
+STATE_NAME = '_stages.json'
+
+# raw columns next to the engineered features in the modelset
+MODELSET_RAW_COLUMNS = ['secs', 'alt', 'slope', 'temp']
+
+# fraction of the rides (the most recent ones) held out by the evaluation
+HOLDOUT_FRACTION = 0.2
+
+# rough peak memory of a rider as a multiple of the size of its ride csv files (features are ~250 float32 columns)
+MEMORY_FACTOR = 20
+
+
+def _fingerprint(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def _rider_paths(rider_dir):
+    output_dir = os.path.join(rider_dir, OUTPUT_DIR)
+    return {'config': os.path.join(rider_dir, CONFIG_NAME),
+            'files': sorted(glob.glob(os.path.join(rider_dir, RIDES_DIR, '*.csv'))),
+            'output': output_dir,
+            'store': os.path.join(output_dir, 'ride_store'),
+            'cache': os.path.join(output_dir, 'feature_cache'),
+            'stats': os.path.join(output_dir, 'df_stats.parquet'),
+            'modelset': os.path.join(output_dir, 'df_modelset.parquet'),
+            'tuning': os.path.join(output_dir, 'list_model_lgb'),
+            'tuning_inner': os.path.join(output_dir, 'list_model_lgb_inner.pkl'),
+            'tuning_outer': os.path.join(output_dir, 'list_model_lgb_outer.pkl'),
+            'metrics': os.path.join(output_dir, 'df_metrics.parquet'),
+            'evaluation': os.path.join(output_dir, 'evaluation.json'),
+            'model': os.path.join(output_dir, 'model_lgb.txt')}
+
+
+def _row_level_frame(paths, rider_params, groups):
+    # raw columns from the parquet store next to cached row level groups. Both are in sorted filename order
+    cache = RideFeatureCache(paths['cache'])
+    df_groups = build_feature_table(paths['files'], rider_params, cache, groups, verbose=False)
+    filenames = [os.path.basename(path) for path in paths['files']]
+    df_raw = load_ride_store(paths['store'], filenames=filenames,
+                             columns=[c for c in ['cad', 'watts'] + MODELSET_RAW_COLUMNS
+                                      if c not in df_groups.columns])
+    if len(df_raw) != len(df_groups):
+        raise ValueError('ride store and feature cache differ in number of records: {} vs {}'.format(
+            len(df_raw), len(df_groups)))
+    return pd.concat([df_raw.drop(columns=['filename']), df_groups], axis=1)
+
+
+def stage_ingest(paths, config, inputs):
+    manifest = ingest_ride_files(paths['files'], paths['store'], n_jobs=config['cpu_budget'], verbose=False)
+    filenames = set(os.path.basename(path) for path in paths['files'])
+    return _fingerprint(sorted((name, entry['md5']) for name, entry in manifest.items() if name in filenames))
+
+
+def stage_stats(paths, config, inputs):
+    df = _row_level_frame(paths, config['rider_params'], ['ride_preprocessing'])
+    df_stats = ride_stats_calculation(df, engine='vectorized', config_path=paths['config'])
+    df_stats.to_parquet(paths['stats'], index=False)
+
+
+def stage_features(paths, config, inputs):
+    df = _row_level_frame(paths, config['rider_params'],
+                          ['ride_preprocessing', 'cycling_features', 'engineered_features'])
+    # records with a heart rate anomaly (put to zero by the preprocessing) are no training target
+    df = df[df['hr'] > 0]
+    df = df.drop(columns=[c for c in df.columns if c.startswith('consecutive_')] + ['hr_power_zero', 'hr_power_ratio'])
+    df.reset_index(drop=True).to_parquet(paths['modelset'], index=False)
+
+
+def _holdout_rides(df):
+    # the most recent rides (filenames start with the date), like the holdout period of the notebooks
+    filenames = np.sort(df['filename'].unique().astype(str))
+    return set(filenames[len(filenames) - max(1, int(round(HOLDOUT_FRACTION * len(filenames)))):])
+
+
+def _check_tuning_rides(df, holdout, rider, tuning):
+    # fails early (instead of deep in GroupKFold) when too few rides are left for the outer and inner folds
+    number_outer_splits = tuning.get('number_outer_splits', 10)
+    number_inner_splits = tuning.get('number_inner_splits', 5)
+    groups = df['filename'].astype(str).to_numpy()
+    rides = len(np.unique(groups))
+    smallest = 0
+    if rides >= number_outer_splits:
+        folds = GroupKFold(n_splits=number_outer_splits).split(groups, groups=groups)
+        smallest = min(len(np.unique(groups[train_index])) for train_index, _ in folds)
+    if rides < number_outer_splits or smallest < number_inner_splits:
+        raise ValueError('rider {} has {} rides with a heart rate for the tuning ({} more are held out), too few for '
+                         'number_outer_splits = {} and number_inner_splits = {}: the smallest outer training fold has '
+                         '{} rides'.format(rider, rides, len(holdout), number_outer_splits, number_inner_splits,
+                                           smallest))
+
+
+def stage_tuning(paths, config, inputs):
+    df = pd.read_parquet(paths['modelset'])
+    # the rides held out by the evaluation are not tuned on, so its holdout metrics are out of sample
+    holdout = _holdout_rides(df)
+    df = df[~df['filename'].astype(str).isin(holdout)].reset_index(drop=True)
+    _check_tuning_rides(df, holdout, os.path.basename(os.path.dirname(paths['output'])), config['tuning'])
+    # run_nested_cv only resumes checkpoints of the same modelset and tuning configuration
+    run_nested_cv(df, proc_results_name=paths['tuning'], cpu_budget=config['cpu_budget'], **config['tuning'])
+
+
+def _best_params(paths):
+    with open(paths['tuning_inner'], 'rb') as f:
+        inner = pickle.load(f)
+    with open(paths['tuning_outer'], 'rb') as f:
+        outer = pickle.load(f)
+    # the parameters chosen most often over the outer folds, ties go to the lowest outer rmse
+    chosen = [json.dumps(results['params'][int(np.argmin(results['rank_test_score']))], sort_keys=True)
+              for results in inner]
+    votes = Counter(chosen)
+    best = min(range(len(chosen)), key=lambda i: (-votes[chosen[i]], outer[i]))
+    return json.loads(chosen[best]), outer
+
+
+def stage_evaluation(paths, config, inputs):
+    df = pd.read_parquet(paths['modelset'])
+    params, outer = _best_params(paths)
+    booster_params = dict(params, objective='regression', metric='rmse', verbose=-1,
+                          seed=config['tuning'].get('random_state', 101), num_threads=config['cpu_budget'])
+    num_boost_round = config['tuning'].get('num_boost_round', 50)
+
+    # the parameters are tuned without the holdout rides (see stage_tuning)
+    holdout = _holdout_rides(df)
+    is_holdout = df['filename'].astype(str).isin(holdout).to_numpy()
+
+    X = df.drop(columns=['hr', 'filename'])
+    y = df['hr'].to_numpy(dtype=np.float64)
+    model = lgb.train(booster_params, lgb.Dataset(X[~is_holdout], y[~is_holdout]), num_boost_round=num_boost_round)
+    df_metrics, rmse_total, r2_total = metrics_vectorized(df['filename'].astype(str).to_numpy()[is_holdout],
+                                                          y[is_holdout], model.predict(X[is_holdout]))
+    df_metrics['name'] = 'metrics_lgb'
+    df_metrics.to_parquet(paths['metrics'], index=False)
+
+    # the final model uses all rides
+    model = lgb.train(booster_params, lgb.Dataset(X, y), num_boost_round=num_boost_round)
+    model.save_model(paths['model'])
+
+    with open(paths['evaluation'], 'w') as f:
+        json.dump({'params': params, 'num_boost_round': num_boost_round,
+                   'nested_cv_rmse_mean': float(np.mean(outer)), 'nested_cv_rmse_std': float(np.std(outer)),
+                   'holdout_rides': len(holdout), 'holdout_rmse': float(rmse_total), 'holdout_r2': float(r2_total),
+                   'holdout_mean_ride_rmse': float(df_metrics['rmse_test'].mean())}, f, indent=1)
+
+
+# stages in topological order
+# requires: stages whose output is input of the stage
+# config: parts of the rider configuration the stage depends on
+# outputs: files that must exist to skip the stage
+STAGES = {
+    'ingest': {'function': stage_ingest, 'requires': [], 'config': [], 'outputs': ['store']},
+    'stats': {'function': stage_stats, 'requires': ['ingest'], 'config': ['rider_params'], 'outputs': ['stats']},
+    'features': {'function': stage_features, 'requires': ['ingest'], 'config': ['rider_params'],
+                 'outputs': ['modelset']},
+    'tuning': {'function': stage_tuning, 'requires': ['features'], 'config': ['tuning'],
+               'outputs': ['tuning_inner', 'tuning_outer']},
+    'evaluation': {'function': stage_evaluation, 'requires': ['tuning'], 'config': ['tuning'],
+                   'outputs': ['evaluation', 'metrics', 'model']},
+}
+
+
+def _load_state(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def _save_state(path, state):
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=1)
+    os.replace(path + '.tmp', path)
+
+
+def run_rider(rider_dir, cpu_budget=None, force=False, verbose=True):
+    '''
+    Runs the stages of one rider, skipping the stages whose inputs did not change since the last run
+
+            Parameters:
+                    rider_dir (str): directory of the rider with rider_config.json and ride_level_data
+                    cpu_budget (int): number of cpus of the rider, default = all cpus
+                    force (bool): run all stages, also when their inputs did not change
+                    verbose (bool): print a line per stage
+            Returns:
+                    dict: per stage 'ran' or 'skipped'
+    '''
+    paths = _rider_paths(rider_dir)
+    os.makedirs(paths['output'], exist_ok=True)
+    with open(paths['config'], 'r') as c:
+        config = json.load(c)
+    config.setdefault('tuning', {})
+    config['cpu_budget'] = cpu_budget or os.cpu_count()
+
+    state_path = os.path.join(paths['output'], STATE_NAME)
+    state = _load_state(state_path)
+    rider = os.path.basename(os.path.normpath(rider_dir))
+
+    done = {}
+    for name, stage in STAGES.items():
+        # the ingest output fingerprint is the content of the rides, so its input is checked by ingest_ride_files
+        inputs = {required: state[required]['output'] for required in stage['requires']}
+        fingerprint = _fingerprint(name, FEATURE_SPEC_VERSION, HOLDOUT_FRACTION, inputs,
+                                   {key: config[key] for key in stage['config']})
+        outputs_exist = all(os.path.exists(paths[output]) for output in stage['outputs'])
+        if (not force and name != 'ingest' and state.get(name, {}).get('fingerprint') == fingerprint
+                and outputs_exist):
+            done[name] = 'skipped'
+            if verbose:
+                print('{}: {} skipped, inputs unchanged'.format(rider, name))
+            continue
+
+        start_time = time.time()
+        with instrumented_stage(name, rider=rider):
+            output = stage['function'](paths, config, inputs)
+        state[name] = {'fingerprint': fingerprint, 'output': output or fingerprint,
+                       'seconds': time.time() - start_time}
+        _save_state(state_path, state)
+        done[name] = 'ran'
+        if verbose:
+            print('{}: {} ran in {:.1f} seconds'.format(rider, name, state[name]['seconds']))
+
+    return done
+
+
+def _run_rider_process(rider_dir, cpu_budget, force, status_path):
+    try:
+        status = {'status': 'ok', 'stages': run_rider(rider_dir, cpu_budget=cpu_budget, force=force)}
+    except Exception:
+        status = {'status': 'failed', 'error': traceback.format_exc()}
+    with open(status_path, 'w') as f:
+        json.dump(status, f, indent=1)
+
+
+def estimate_rider_memory(rider_dir):
+    '''
+    Returns the estimated peak memory in bytes of a rider, MEMORY_FACTOR times the size of its ride files
+    '''
+    return MEMORY_FACTOR * sum(os.path.getsize(path) for path in _rider_paths(rider_dir)['files'])
+
+
+def run_riders(riders_dir, max_parallel=None, cpu_budget=None, memory_fraction=0.8, force=False, poll_seconds=1.0):
+    '''
+    Runs all riders of a directory, several riders at once as long as their estimated memory fits
+
+            Parameters:
+                    riders_dir (str): directory with one directory per rider
+                    max_parallel (int): maximum number of riders at once, default = number of cpus
+                    cpu_budget (int): total number of cpus, divided over the riders running at once, default = all cpus
+                    memory_fraction (float): fraction of the memory the running riders may use, default = 0.8
+                    force (bool): run all stages, also when their inputs did not change
+                    poll_seconds (float): interval to check for finished riders
+            Returns:
+                    dict: status per rider ('ok' with the stages or 'failed' with the error)
+    '''
+    riders = sorted(d for d in os.listdir(riders_dir) if os.path.exists(os.path.join(riders_dir, d, CONFIG_NAME)))
+    cpu_budget = cpu_budget or os.cpu_count()
+    max_parallel = max(1, min(max_parallel or cpu_budget, len(riders) or 1))
+    rider_cpus = max(1, cpu_budget // max_parallel)
+
+    # largest riders first, so the small ones fill the memory which is left
+    todo = sorted(riders, key=lambda r: -estimate_rider_memory(os.path.join(riders_dir, r)))
+    running = {}
+    results = {}
+    # riders run in their own (non daemon) process, so the nested cv can start its own process pool
+    context = multiprocessing.get_context('spawn')
+    while todo or running:
+        # the estimates of running riders are reserved out of the total memory, also when they did not allocate
+        # their memory yet, and a new rider has to fit in the memory which is available now
+        memory_info = psutil.virtual_memory()
+        reserved = sum(m for _, m, _ in running.values())
+        available = memory_info.available * memory_fraction
+        for rider in list(todo):
+            if len(running) >= max_parallel:
+                break
+            rider_dir = os.path.join(riders_dir, rider)
+            memory = estimate_rider_memory(rider_dir)
+            # a rider always starts when nothing else runs, even when its estimate does not fit
+            if running and memory > min(memory_info.total * memory_fraction - reserved, available):
+                continue
+            status_path = os.path.join(rider_dir, OUTPUT_DIR, '_status.json')
+            os.makedirs(os.path.dirname(status_path), exist_ok=True)
+            if os.path.exists(status_path):
+                os.remove(status_path)
+            process = context.Process(target=_run_rider_process, args=(rider_dir, rider_cpus, force, status_path))
+            process.start()
+            running[rider] = (process, memory, status_path)
+            reserved += memory
+            available -= memory
+            todo.remove(rider)
+            print('Started rider {} ({:.0f} MB estimated, {} cpus)'.format(rider, memory / 1024**2, rider_cpus))
+
+        time.sleep(poll_seconds)
+        for rider, (process, _, status_path) in list(running.items()):
+            if process.is_alive():
+                continue
+            process.join()
+            if os.path.exists(status_path):
+                with open(status_path, 'r') as f:
+                    results[rider] = json.load(f)
+            else:
+                results[rider] = {'status': 'failed', 'error': 'exit code {}'.format(process.exitcode)}
+            del running[rider]
+            print('Finished rider {}: {}'.format(rider, results[rider]['status']))
+
+    return results
+
+
+if __name__ == '__main__':
+    results = run_riders(sys.argv[1])
+    sys.exit(int(any(result['status'] != 'ok' for result in results.values())))
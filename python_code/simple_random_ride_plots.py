@@ -1,7 +1,9 @@
 import random
 import matplotlib.pyplot as plt
 
-def simple_ride_plots(df, number_of_ride_files = 4, nrows = 2, ncols = 2):
+from ride_plot_rendering import SERIES_STYLES, ride_series, draw_ride
+
+def simple_ride_plots(df, number_of_ride_files = 4, nrows = 2, ncols = 2, output_path = None):
     '''
     Returns a plot with random ride(s) and power / heart rate / cadence development
 
@@ -10,24 +12,24 @@ def simple_ride_plots(df, number_of_ride_files = 4, nrows = 2, ncols = 2):
                     number_of_ride_files (int): number of random ride files to plot, default = 4
                     rows (int): number of rows in plot (rows * cols = number of files), default = 2 
                     cols (int): number of columns in plot (rows * cols = number of files), default = 2
+                    output_path (str): optional path (png or svg) to save the plot to instead of showing it
             Returns:
-                    plot: matplotlib object with heart rate and predicted heart rate
+                    plot: matplotlib object with heart rate and predicted heart rate (or the output path)
     '''
        
     lijst = random.sample(df.filename.unique().tolist(), number_of_ride_files)
 
-    grouped = df[df['filename'].isin(lijst)][['filename','hr','watts','cad','secs']].groupby('filename',sort=False)
+    rides = ride_series(df, lijst, ['hr','watts','cad'])
     
     ncols = ncols
     nrows = nrows
        
     fig, axes = plt.subplots(nrows=nrows, ncols=ncols, figsize=(20,12), sharey=False)
-    for (key, ax) in zip(grouped.groups.keys(), axes.flatten()):
-        grouped.get_group(key).plot(x='secs', y=['hr'],  ax=ax, color='r', alpha=0.8)
-        grouped.get_group(key).plot(x='secs', y=['watts'], ax=ax.twinx(), color='b', alpha=0.3)
-        grouped.get_group(key).plot(x='secs', y=['cad'], ax=ax, color='g', alpha=0.6)
+    for (key, ax) in zip(rides, axes.flatten()):
+        handles = draw_ride(ax, rides[key], SERIES_STYLES['simple'])
+        ax.legend(handles=handles)
 
-        ax.set_title(grouped.get_group(key).filename.unique());
+        ax.set_title(key);
         ax.set_xlabel('secs')
         handles, labels = ax.get_legend_handles_labels()
         fig.suptitle('Plots of example rides', fontsize=16) 
@@ -36,4 +38,9 @@ def simple_ride_plots(df, number_of_ride_files = 4, nrows = 2, ncols = 2):
     plt.tight_layout()
     fig.subplots_adjust(top=0.92)
     
+    if output_path:
+        fig.savefig(output_path)
+        plt.close(fig)
+        return output_path
+
     return plt.show()
\ No newline at end of file
@@ -0,0 +1,339 @@
+import os
+import glob
+import math
+import time
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from feature_generation import DEFAULT_FEATURE_SPEC, _entry_names, build_feature_block, simple_cycling_features
+from ride_ingestion import read_ride_file
+
+# streaming version of the features of DEFAULT_FEATURE_SPEC. Every sample of a live ride updates ring buffers with
+# the history of the columns and their running (cumulative) sums, so the feature vector costs the same for the first
+# and the ten thousandth second of a ride. The results match build_feature_block on the full ride
+
+
+class StreamingFeatureState:
+    '''
+    Feature state of one live ride, updated with one sample per second
+
+            Parameters:
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+    '''
+
+    def __init__(self, spec=DEFAULT_FEATURE_SPEC):
+        self.spec = spec
+        self.entries = []
+        names = []
+        windows = [1]
+        for entry in spec:
+            entry_names = _entry_names(entry)
+            self.entries.append((entry, np.arange(len(names), len(names) + len(entry_names)),
+                                 [col for _, col, _ in entry_names], [window for _, _, window in entry_names]))
+            names += [name for name, _, _ in entry_names]
+            if entry['kind'] in ('lag', 'delta', 'sma'):
+                windows += entry['windows']
+        self.names = names
+
+        # columns (raw or features) whose history is needed get a row in the ring buffers
+        history = [col for entry in spec if entry['kind'] in ('lag', 'delta', 'sma') for col in entry['cols']]
+        self.sources = list(dict.fromkeys(history))
+        self.source_index = {col: i for i, col in enumerate(self.sources)}
+        self.feature_index = {name: i for i, name in enumerate(names)}
+        self.size = max(windows) + 1
+
+        # per entry the ring buffer rows and windows as arrays, so an entry is updated with a few numpy operations
+        self.compiled = []
+        for entry, idx, cols, wins in self.entries:
+            rows = np.array([self.source_index.get(col, -1) for col in cols])
+            # features used by later entries (e.g. 1s_delta_watts)
+            referenced = [(j, names[j]) for j in idx if names[j] in self.source_index]
+            self.compiled.append((entry['kind'], idx, cols, np.array(wins, dtype=object if entry['kind'] == 'cumsum'
+                                                                         else np.int64), rows, entry.get('round'),
+                                  referenced))
+        self.reset()
+
+    def reset(self):
+        '''
+        Starts a new ride
+        '''
+        n_sources = len(self.sources)
+        self.pos = -1
+        self.values = np.full((n_sources, self.size), np.nan)
+        # cumulative sum of the valid values and cumulative count of the missing values through every second
+        self.csum = np.zeros((n_sources, self.size))
+        self.cmiss = np.zeros((n_sources, self.size))
+        self.current = np.full(n_sources, np.nan)
+        self.current_csum = np.zeros(n_sources)
+        self.current_cmiss = np.zeros(n_sources)
+        self.totals = {}
+        self.features = np.full(len(self.names), np.nan)
+        self.raw = {}
+
+    def _set_source(self, col, value):
+        i = self.source_index.get(col)
+        if i is None:
+            return
+        slot = (self.pos - 1) % self.size
+        previous_csum = self.csum[i, slot] if self.pos > 0 else 0.0
+        previous_cmiss = self.cmiss[i, slot] if self.pos > 0 else 0.0
+        missing = math.isnan(value)
+        self.current[i] = value
+        self.current_csum[i] = previous_csum + (0.0 if missing else value)
+        self.current_cmiss[i] = previous_cmiss + missing
+
+    def _history(self, table, rows, windows, before_start):
+        # value of a ring buffer table window seconds ago, before_start when that is before the ride start
+        slots = (self.pos - windows) % self.size
+        out = table[rows, slots]
+        return np.where(self.pos - windows >= 0, out, before_start)
+
+    def update(self, sample):
+        '''
+        Returns the feature vector after one more second of the ride
+
+                Parameters:
+                        sample (dict): values of the raw columns of one second, e.g. secs, watts, cad and slope
+                Returns:
+                        numpy array with the features in the order of self.names (float64, view of the state)
+        '''
+        self.pos += 1
+        raw = dict(sample)
+        raw.update(stream_cycling_features(raw))
+        self.raw = raw
+        for col in self.sources:
+            if col in raw:
+                self._set_source(col, float(raw[col]))
+
+        f = self.features
+        for kind, idx, cols, windows, rows, decimals, referenced in self.compiled:
+            if kind == 'power':
+                f[idx] = np.array([raw[col] for col in cols], dtype=np.float64) ** windows
+            elif kind == 'lag':
+                f[idx] = self._history(self.values, rows, windows, np.nan)
+            elif kind == 'delta':
+                f[idx] = self.current[rows] - self._history(self.values, rows, windows, np.nan)
+            elif kind == 'sma':
+                total = self.current_csum[rows] - self._history(self.csum, rows, windows, 0.0)
+                missing = self.current_cmiss[rows] - self._history(self.cmiss, rows, windows, 0.0)
+                # like rolling(window) the mean needs window valid values within the ride
+                f[idx] = np.where((self.pos < windows - 1) | (missing > 0), np.nan, total / windows)
+            elif kind == 'cumsum':
+                for j, col, window in zip(idx, cols, windows):
+                    value = float(raw[col])
+                    if window == 'total':
+                        self.totals[col] = self.totals.get(col, 0.0) + (0.0 if math.isnan(value) else value)
+                    total = np.nan if math.isnan(value) else self.totals[col]
+                    # like build_feature_block the average is over the secs of the sample, not over the samples
+                    f[j] = total if window == 'total' else total / float(raw['secs'])
+                    if decimals is not None:
+                        f[j] = np.round(f[j], decimals)
+
+            # features used by later entries become sources as soon as they are known
+            for j, name in referenced:
+                raw[name] = f[j]
+                self._set_source(name, f[j])
+
+        # store the values of this second in the ring buffers
+        slot = self.pos % self.size
+        self.values[:, slot] = self.current
+        self.csum[:, slot] = self.current_csum
+        self.cmiss[:, slot] = self.current_cmiss
+
+        return f
+
+
+def stream_cycling_features(sample):
+    '''
+    Returns the corrected cadence and power, rotation speed and torque of one second (see simple_cycling_features)
+
+            Parameters:
+                    sample (dict): 'cad' and 'watts' of one second
+            Returns:
+                    dict: 'cad', 'watts', 'rotation_speed' and 'torque'
+    '''
+    # float32 like the ride files, so the features equal the batch calculation
+    cad = np.float32(sample['cad'])
+    watts = np.float32(sample['watts'])
+    cad = np.float32(0) if (watts == 0) and (cad > 0) else cad
+    watts = np.float32(0) if (watts > 0) and (cad == 0) else watts
+
+    rotation_speed = np.round(np.float32((2*math.pi)/60) * cad, 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        torque = np.round(watts / rotation_speed, 2)
+    if not np.isfinite(torque):
+        torque = np.float32(0)
+
+    return {'cad': cad, 'watts': watts, 'rotation_speed': rotation_speed, 'torque': torque}
+
+
+class StreamingHRPredictor:
+    '''
+    Predicts the heart rate of live rides from one sample per second
+
+            Parameters:
+                    model: fitted model with a predict method (e.g. LGBMRegressor), the booster is used directly
+                    feature_columns (list): columns of the model input in training order. Raw columns are taken from
+                                            the sample, engineered columns from the feature state
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+    '''
+
+    def __init__(self, model, feature_columns, spec=DEFAULT_FEATURE_SPEC):
+        self.model = model
+        self.feature_columns = list(feature_columns)
+        self.spec = spec
+        self.rides = {}
+        # skip the input validation of the sklearn api, a single row is predicted every second
+        booster = getattr(model, 'booster_', None)
+        self._predict = booster.predict if booster is not None else model.predict
+
+        names = StreamingFeatureState(spec).names
+        self._engineered = np.array([col in names for col in self.feature_columns])
+        self._feature_positions = np.array([names.index(col) for col in self.feature_columns if col in names],
+                                           dtype=np.int64)
+        self._raw_columns = [col for col in self.feature_columns if col not in names]
+        self._row = np.empty((1, len(self.feature_columns)), dtype=np.float32)
+
+    def start_ride(self, ride_id):
+        self.rides[ride_id] = StreamingFeatureState(self.spec)
+
+    def end_ride(self, ride_id):
+        self.rides.pop(ride_id, None)
+
+    def features(self, ride_id, sample):
+        '''
+        Returns the model input row (float32, like the batch feature block) after one sample of a ride
+        '''
+        if ride_id not in self.rides:
+            self.start_ride(ride_id)
+        state = self.rides[ride_id]
+        f = state.update(sample)
+        row = self._row
+        row[0, self._engineered] = f[self._feature_positions]
+        row[0, ~self._engineered] = [state.raw.get(col, np.nan) for col in self._raw_columns]
+        return row
+
+    def update(self, ride_id, sample):
+        '''
+        Returns the predicted heart rate after one sample of a ride
+
+                Parameters:
+                        ride_id: identifier of the ride, e.g. the filename
+                        sample (dict): values of the raw columns of one second
+                Returns:
+                        float: pred_hr
+        '''
+        return float(self._predict(self.features(ride_id, sample))[0])
+
+
+def batch_features(df, feature_columns, spec=DEFAULT_FEATURE_SPEC):
+    '''
+    Returns the model input of full rides, calculated like 2. Feature engineering.ipynb
+
+            Parameters:
+                    df: pandas DataFrame with second by second raw data and 'filename'
+                    feature_columns (list): columns of the model input in training order
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+            Returns:
+                    float32 numpy array with the model input
+    '''
+    df = df.assign(**simple_cycling_features(df))
+    block, names = build_feature_block(df, spec)
+    columns = {name: block[:, j] for j, name in enumerate(names)}
+    return np.column_stack([columns[col] if col in columns else df[col].to_numpy(dtype=np.float32)
+                            for col in feature_columns]).astype(np.float32)
+
+
+def replay_rides(files, model, feature_columns, spec=DEFAULT_FEATURE_SPEC, atol=1e-6, verbose=True):
+    '''
+    Streams ride csv files second by second through a StreamingHRPredictor and compares the streamed features
+    and predictions with the batch calculation, raises an AssertionError when any ride differs more than atol
+
+            Parameters:
+                    files (list): paths of ride csv files, e.g. data_examples/ride_level_data/*.csv
+                    model: fitted model with a predict method
+                    feature_columns (list): columns of the model input in training order
+                    spec (list): feature specification, default = DEFAULT_FEATURE_SPEC
+                    atol (float): largest absolute feature and prediction difference allowed, default = 1e-6
+                    verbose (bool): print a line per ride
+            Returns:
+                    df: pandas DataFrame with per ride the number of samples, the largest feature and prediction
+                        difference and the median / 99th percentile latency per sample in microseconds
+    '''
+    predictor = StreamingHRPredictor(model, feature_columns, spec)
+    results = []
+    for path in files:
+        df = read_ride_file(path)
+        X_batch = batch_features(df, feature_columns, spec)
+        pred_batch = np.asarray(predictor._predict(X_batch), dtype=np.float64)
+
+        filename = os.path.basename(path)
+        predictor.start_ride(filename)
+        samples = df.drop(columns=['filename']).to_dict('records')
+        X_stream = np.empty_like(X_batch)
+        pred_stream = np.empty(len(df))
+        latency = np.empty(len(df))
+        for i, sample in enumerate(samples):
+            start = time.perf_counter()
+            X_stream[i] = predictor.features(filename, sample)[0]
+            pred_stream[i] = predictor._predict(predictor._row)[0]
+            latency[i] = time.perf_counter() - start
+        predictor.end_ride(filename)
+
+        with np.errstate(invalid='ignore'):
+            feature_diff = np.abs(X_stream.astype(np.float64) - X_batch)
+        # a feature differs when the values differ or only one of them is missing
+        feature_diff[np.isnan(X_stream) != np.isnan(X_batch)] = np.inf
+        result = {'filename': filename, 'samples': len(df),
+                  'max_feature_diff': float(np.nanmax(feature_diff)) if len(df) else 0.0,
+                  'max_pred_diff': float(np.max(np.abs(pred_stream - pred_batch))) if len(df) else 0.0,
+                  'p50_latency_us': float(np.percentile(latency, 50) * 1e6) if len(df) else 0.0,
+                  'p99_latency_us': float(np.percentile(latency, 99) * 1e6) if len(df) else 0.0}
+        results.append(result)
+        if verbose:
+            print('{filename}: {samples} samples, max feature diff {max_feature_diff:.2e}, max pred diff '
+                  '{max_pred_diff:.2e}, latency p50 {p50_latency_us:.0f}us p99 {p99_latency_us:.0f}us'.format(**result))
+
+    df_results = pd.DataFrame(results)
+    mismatch = df_results[(df_results['max_feature_diff'] > atol) | (df_results['max_pred_diff'] > atol)]
+    if len(mismatch):
+        raise AssertionError('streamed features or predictions differ from the batch calculation for {}'.format(
+            ', '.join('{} (feature {:.3g}, pred_hr {:.3g})'.format(r.filename, r.max_feature_diff, r.max_pred_diff)
+                      for r in mismatch.itertuples())))
+    return df_results
+
+
+def write_gapped_ride(path, output_dir, gaps=((100, 160), (600, 601))):
+    '''
+    Writes a copy of a ride csv file without the records of some ranges, like a ride with sensor dropouts
+
+            Parameters:
+                    path (str): path of the ride csv file
+                    output_dir (str): directory of the copy
+                    gaps (tuple): (start, end) positions of the removed records
+            Returns:
+                    str: path of the copy
+    '''
+    with open(path, 'r') as f:
+        header, *lines = f.readlines()
+    removed = set(i for start, end in gaps for i in range(start, end))
+    output_path = os.path.join(output_dir, 'gapped_' + os.path.basename(path))
+    with open(output_path, 'w') as f:
+        f.writelines([header] + [line for i, line in enumerate(lines) if i not in removed])
+    return output_path
+
+
+if __name__ == '__main__':
+    # replay the example rides with a small model fitted on the batch features of the same rides
+    import lightgbm as lgb
+    from feature_generation import feature_names
+
+    files = sorted(glob.glob(os.path.join(os.path.dirname(__file__), '..', 'data_examples', 'ride_level_data', '*.csv')))
+    feature_columns = ['watts', 'cad', 'slope', 'rotation_speed', 'torque'] + feature_names()
+    df = pd.concat([read_ride_file(path) for path in files], ignore_index=True)
+    model = lgb.LGBMRegressor(n_estimators=50, verbose=-1).fit(batch_features(df, feature_columns), df['hr'])
+    with tempfile.TemporaryDirectory() as output_dir:
+        # the secs of a ride with dropouts have gaps, the cumulative averages then differ from a sample count
+        replay_rides(files + [write_gapped_ride(files[0], output_dir)], model, feature_columns)
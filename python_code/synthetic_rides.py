@@ -0,0 +1,189 @@
+import os
+import datetime
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from ride_ingestion import RIDE_LEVEL_DTYPES
+
+# synthetic rides in the Golden Cheetah ride_level_data csv schema, for benchmarks at any number of records.
+# Power is a sequence of efforts, heart rate follows the power with a lag (fast rise, slow recovery) and cardiac
+# drift, and sensor dropouts, flatlines and spikes are injected like in the real exports
+
+# the 23 columns of the export, in file order
+GC_COLUMNS = list(RIDE_LEVEL_DTYPES)
+
+# physiology of the synthetic rider
+SYNTHETIC_RIDER = {'ftp': 250, 'rest_hr': 55, 'max_hr': 188}
+
+# efforts as (share of ftp, mean duration in seconds, probability)
+EFFORTS = [(0.0, 30, 0.08), (0.55, 300, 0.30), (0.75, 240, 0.30), (0.90, 180, 0.15), (1.05, 120, 0.10),
+           (1.25, 60, 0.05), (2.50, 10, 0.02)]
+
+# heart rate time constants in seconds: rising with a higher effort, recovering after it
+HR_RISE_TAU = 25
+HR_RECOVERY_TAU = 70
+
+# injected anomalies per hour of riding (at anomaly_rate = 1) as (kind, events, minimum secs, maximum secs)
+ANOMALIES = [('hr_dropout', 1.0, 5, 120), ('power_dropout', 0.5, 5, 60), ('hr_flatline', 0.5, 30, 300),
+             ('power_flatline', 0.2, 30, 120), ('hr_spike', 1.0, 1, 3)]
+
+
+def _ema(x, tau, initial):
+    alpha = 1.0 / tau
+    out, _ = lfilter([alpha], [1, alpha - 1], x, zi=[(1 - alpha) * initial])
+    return out
+
+
+def _efforts(n_secs, rng, ftp):
+    # power levels of consecutive efforts with an AR(1) noise on top
+    shares, durations, probabilities = (np.array(x, dtype=np.float64) for x in zip(*EFFORTS))
+    n_efforts = int(n_secs / 20) + 10
+    chosen = rng.choice(len(EFFORTS), size=n_efforts, p=probabilities / probabilities.sum())
+    lengths = np.maximum(1, rng.exponential(durations[chosen])).astype(np.int64)
+    level = np.repeat(shares[chosen] * ftp, lengths)[:n_secs]
+    if len(level) < n_secs:
+        level = np.pad(level, (0, n_secs - len(level)), mode='edge')
+
+    noise = lfilter([1], [1, -0.8], rng.normal(0, 0.06 * ftp, n_secs))
+    return np.where(level > 0, np.maximum(0, level + noise), 0.0)
+
+
+def _inject(n_secs, rng, events_per_hour, min_secs, max_secs):
+    # random intervals (start, end) of an anomaly in a ride
+    n_events = rng.poisson(events_per_hour * n_secs / 3600)
+    starts = rng.integers(0, max(1, n_secs), n_events)
+    lengths = rng.integers(min_secs, max_secs + 1, n_events)
+    return [(start, min(n_secs, start + length)) for start, length in zip(starts, lengths)]
+
+
+def synthetic_ride(n_secs, rng=None, rider=SYNTHETIC_RIDER, anomaly_rate=1.0):
+    '''
+    Returns a pandas DataFrame with one synthetic ride in the 23 column Golden Cheetah schema
+
+            Parameters:
+                    n_secs (int): number of records (seconds) of the ride
+                    rng: numpy Generator, default = a new unseeded generator
+                    rider (dict): 'ftp', 'rest_hr' and 'max_hr' of the rider, default = SYNTHETIC_RIDER
+                    anomaly_rate (float): multiplier of the injected anomalies of ANOMALIES, 0 for a clean ride
+            Returns:
+                    df: pandas DataFrame with the GC_COLUMNS
+    '''
+    rng = rng or np.random.default_rng()
+    ftp, rest_hr, max_hr = rider['ftp'], rider['rest_hr'], rider['max_hr']
+    secs = np.arange(1, n_secs + 1)
+
+    watts = _efforts(n_secs, rng, ftp)
+    cad = np.where(watts > 0, rng.normal(85, 4, n_secs) + 0.04 * (watts - 0.7 * ftp), 0.0)
+    cad = np.clip(cad, 0, 130)
+
+    # heart rate: the fast response drives a rise, the slow one the recovery, plus drift over the ride
+    target = rest_hr + 35 + (max_hr - rest_hr - 35) * np.clip(watts / (1.2 * ftp), 0, 1)
+    target = target + 6 * secs / 3600 * (watts > 0)
+    hr = np.maximum(_ema(target, HR_RISE_TAU, rest_hr + 20), _ema(target, HR_RECOVERY_TAU, rest_hr + 20))
+    hr = np.minimum(hr + lfilter([1], [1, -0.9], rng.normal(0, 0.4, n_secs)), max_hr)
+
+    # speed from the power (air resistance), coasting slows down gradually
+    kph = _ema(3.6 * np.cbrt(np.maximum(watts, 10) / 0.25), 8, 20.0)
+    km = np.cumsum(kph / 3600)
+    alt = np.cumsum(lfilter([1], [1, -0.98], rng.normal(0, 0.02, n_secs)))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.nan_to_num(np.diff(alt, prepend=alt[0]) / (kph / 3.6) * 100)
+    heading = np.cumsum(rng.normal(0, 0.02, n_secs))
+    lon = 4.47798 + np.cumsum(np.cos(heading) * kph / 3.6) / 69000
+    lat = 51.5454 + np.cumsum(np.sin(heading) * kph / 3.6) / 111000
+    temp = np.round(rng.uniform(5, 25) + np.cumsum(rng.normal(0, 0.005, n_secs)))
+
+    watts, cad, hr = np.round(watts), np.round(cad), np.round(hr)
+    for kind, events, min_secs, max_secs in ANOMALIES:
+        for start, end in _inject(n_secs, rng, events * anomaly_rate, min_secs, max_secs):
+            if kind == 'hr_dropout':
+                hr[start:end] = 0
+            elif kind == 'power_dropout':
+                watts[start:end] = 0
+                cad[start:end] = 0
+            elif kind == 'hr_flatline':
+                hr[start:end] = hr[start]
+            elif kind == 'power_flatline':
+                watts[start:end] = watts[start]
+            elif kind == 'hr_spike':
+                hr[start:end] = rng.integers(max_hr + 20, 250)
+
+    df = pd.DataFrame(0, index=np.arange(n_secs), columns=GC_COLUMNS)
+    df['secs'], df['cad'], df['hr'], df['watts'] = secs, cad.astype(int), hr.astype(int), watts.astype(int)
+    df['km'], df['kph'], df['alt'], df['slope'] = np.round(km, 3), np.round(kph, 4), np.round(alt), np.round(slope, 5)
+    df['lon'], df['lat'], df['temp'] = np.round(lon, 5), np.round(lat, 5), temp.astype(int)
+    df['lrbalance'] = -255
+    return df
+
+
+def synthetic_ride_names(n_rides, rng, start=datetime.datetime(2017, 1, 1)):
+    '''
+    Returns ride filenames like the Golden Cheetah export (date and start time), one to three days apart
+    '''
+    days = np.cumsum(rng.integers(1, 4, n_rides))
+    seconds = rng.integers(6 * 3600, 21 * 3600, n_rides)
+    return [(start + datetime.timedelta(days=int(d), seconds=int(s))).strftime('%Y_%m_%d_%H_%M_%S') + '.csv'
+            for d, s in zip(days, seconds)]
+
+
+def _ride_lengths(n_rows, n_rides, rng):
+    # random ride lengths (at least one record each) which sum to n_rows
+    shares = rng.dirichlet(np.full(n_rides, 20.0))
+    lengths = np.maximum(1, np.floor(shares * n_rows).astype(np.int64))
+    lengths[np.argmax(lengths)] += n_rows - lengths.sum()
+    return lengths
+
+
+def synthetic_rides(n_rows, n_rides=None, seed=0, rider=SYNTHETIC_RIDER, anomaly_rate=1.0):
+    '''
+    Returns a pandas DataFrame with synthetic second by second data of several rides, like the concatenated
+    ride_level_data files with a 'filename' column
+
+            Parameters:
+                    n_rows (int): total number of records
+                    n_rides (int): number of rides, default = one ride per hour of records
+                    seed (int): seed of the generator, default = 0
+                    rider (dict): 'ftp', 'rest_hr' and 'max_hr' of the rider, default = SYNTHETIC_RIDER
+                    anomaly_rate (float): multiplier of the injected anomalies, default = 1
+            Returns:
+                    df: pandas DataFrame with the GC_COLUMNS and 'filename'
+    '''
+    rng = np.random.default_rng(seed)
+    n_rides = n_rides or max(1, int(round(n_rows / 3600)))
+    lengths = _ride_lengths(n_rows, min(n_rides, n_rows), rng)
+    names = synthetic_ride_names(len(lengths), rng)
+
+    rides = [synthetic_ride(int(length), rng, rider, anomaly_rate) for length in lengths]
+    df = pd.concat(rides, ignore_index=True)
+    df['filename'] = pd.Categorical.from_codes(np.repeat(np.arange(len(names)), lengths), categories=names)
+    return df
+
+
+def write_synthetic_rides(output_dir, n_rides, ride_secs=(1800, 10800), seed=0, rider=SYNTHETIC_RIDER,
+                          anomaly_rate=1.0):
+    '''
+    Writes synthetic ride csv files with the exact header of the Golden Cheetah export (a space after each comma)
+
+            Parameters:
+                    output_dir (str): directory of the ride files, e.g. <rider>/ride_level_data
+                    n_rides (int): number of rides
+                    ride_secs (tuple): minimum and maximum duration of a ride in seconds, default = (1800, 10800)
+                    seed (int): seed of the generator, default = 0
+                    rider (dict): 'ftp', 'rest_hr' and 'max_hr' of the rider, default = SYNTHETIC_RIDER
+                    anomaly_rate (float): multiplier of the injected anomalies, default = 1
+            Returns:
+                    list: paths of the written files
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    paths = []
+    for name in synthetic_ride_names(n_rides, rng):
+        df = synthetic_ride(int(rng.integers(ride_secs[0], ride_secs[1] + 1)), rng, rider, anomaly_rate)
+        path = os.path.join(output_dir, name)
+        with open(path, 'w') as f:
+            f.write(', '.join(GC_COLUMNS) + '\n')
+            df.to_csv(f, index=False, header=False)
+        paths.append(path)
+    return paths
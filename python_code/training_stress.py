@@ -0,0 +1,278 @@
+import json
+
+import numpy as np
+import pandas as pd
+from scipy.signal import lfilter
+
+from ride_segments import ride_segments
+from instrumentation import instrumented
+
+# training stress of 5. Training stress calculations.ipynb and Additional Replicating xPower Python code.ipynb for
+# all rides at once. Rides are handled as contiguous segments (see ride_segments), so nothing is grouped per ride
+
+# factors for TRIMP
+MALE = 1.92 # 1.67 if female
+TRIMP_WEIGHT_FACTOR = 0.64
+
+# heart rate zones of eTRIMP as fraction of the rider max heart rate. Zone i is above ETRIMP_ZONES[i-1]
+ETRIMP_ZONES = [0.5, 0.6, 0.7, 0.8, 0.9]
+
+# time constants in days of the acute and chronic training load
+ATL_DAYS = 7
+CTL_DAYS = 42
+
+
+def _ride_sma(x, pos, window):
+    # simple moving average within the ride, NaN for the first window - 1 seconds and windows with a missing value
+    n = len(x)
+    missing = np.isnan(x)
+    c = np.concatenate([[0.0], np.cumsum(np.where(missing, 0.0, x))])
+    m = np.concatenate([[0], np.cumsum(missing)])
+    idx = np.arange(n)
+    lo = np.maximum(idx + 1 - window, 0)
+    sma = (c[idx + 1] - c[lo]) / window
+    sma[(pos < window - 1) | (m[idx + 1] - m[lo] > 0)] = np.nan
+    return sma
+
+
+def segmented_ema(x, resets, n):
+    '''
+    Returns the exponential moving average (alpha = 2 / (n + 1)) of all rides in one lfilter pass. The average
+    restarts at the value itself on every reset position (e.g. the start of every ride)
+
+            Parameters:
+                    x: numpy array with (sorted) second by second values without NaN
+                    resets: boolean numpy array, True where the average restarts
+                    n (int): period of the exponential moving average
+            Returns:
+                    numpy array with the exponential moving average
+    '''
+    alpha = 2 / (n + 1)
+    beta = 1 - alpha
+    z = lfilter([alpha], [1, -beta], x)
+    if len(x) == 0:
+        return z
+
+    # the restarted average differs from the running one by beta^(t - r + 1) * (x[r] - z[r - 1]) after reset r
+    r = np.flatnonzero(resets)
+    previous = np.concatenate([[0.0], z])[r]
+    last_reset = np.maximum.accumulate(np.where(resets, np.arange(len(x)), -1))
+    correction = np.zeros(len(x))
+    after = last_reset >= 0
+    offset = np.zeros(len(x), dtype=np.int64)
+    offset[after] = np.searchsorted(r, last_reset[after])
+    with np.errstate(under='ignore'):
+        decay = beta ** (np.arange(len(x)) - last_reset + 1)
+    correction[after] = decay[after] * (x[r] - previous)[offset[after]]
+    return z + correction
+
+
+def ride_power_stress(df, ftp=None, xpower_window=25, np_window=30):
+    '''
+    Returns xPower, normalized power, intensity factor and TSS per ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second 'watts' and 'filename', ordered by secs within a ride
+                    ftp (float): functional threshold power of the rider. Without ftp IF and TSS are NaN
+                    xpower_window (int): window of the rolling average and period of the xPower average, default = 25
+                    np_window (int): window of the rolling average of normalized power, default = 30
+            Returns:
+                    df: pandas DataFrame with filename, time_sec, xPower, NP, IF and TSS per ride
+    '''
+    order, names, starts, ends = ride_segments(df['filename'])
+    watts = df['watts'].to_numpy(dtype=np.float64)
+    if order is not None:
+        watts = watts[order]
+    counts = ends - starts
+    pos = np.arange(len(watts)) - np.repeat(starts, counts)
+
+    # xPower: the 25s average with missing values at zero, like the notebook. The exponential average restarts at
+    # the first valid 25s average (where the previous average is zero)
+    sma = np.nan_to_num(_ride_sma(watts, pos, xpower_window))
+    resets = pos == 0
+    resets[1:] |= sma[:-1] == 0
+    xpower_ema = segmented_ema(sma, resets, xpower_window)
+    xpower = (np.add.reduceat(xpower_ema**4, starts) / counts)**0.25 if len(starts) else np.zeros(0)
+
+    # normalized power: 4th root of the mean of the 4th power of the valid 30s averages
+    sma = _ride_sma(watts, pos, np_window)
+    valid = ~np.isnan(sma)
+    ids = np.repeat(np.arange(len(starts)), counts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        np_power = (np.bincount(ids[valid], weights=sma[valid]**4, minlength=len(starts)) /
+                    np.bincount(ids[valid], minlength=len(starts)))**0.25
+
+    df_stress = pd.DataFrame({'filename': names, 'time_sec': counts, 'xPower': xpower, 'NP': np_power})
+    if ftp:
+        df_stress['IF'] = df_stress['NP'] / ftp
+        df_stress['TSS'] = (df_stress['time_sec'] * df_stress['NP'] * df_stress['IF']) / (ftp * 3600) * 100
+    else:
+        df_stress['IF'] = np.nan
+        df_stress['TSS'] = np.nan
+
+    return df_stress
+
+
+def ride_hr_stress(df, rider_params, cols=('hr', 'pred_hr')):
+    '''
+    Returns TRIMP points and zonal eTRIMP per ride for the measured and predicted heart rate
+
+            Parameters:
+                    df: pandas DataFrame with second by second heart rate columns and 'filename'
+                    rider_params (dict): rider configuration with 'rider_min_hr' (resting) and 'rider_max_hr'
+                    cols (tuple): heart rate columns, default = ('hr', 'pred_hr'). Missing columns are skipped
+            Returns:
+                    df: pandas DataFrame with filename, time_sec, the mean heart rate and 'TRIMP_points_<col>' and
+                        'eTRIMP_<col>' per heart rate column
+    '''
+    codes, names = pd.factorize(np.asarray(df['filename']), sort=True)
+    counts = np.bincount(codes, minlength=len(names))
+    resting_hr = rider_params['rider_min_hr']
+    maximum_hr = rider_params['rider_max_hr']
+    bounds = np.array(ETRIMP_ZONES) * maximum_hr
+
+    df_stress = pd.DataFrame({'filename': names, 'time_sec': counts})
+    for col in cols:
+        if col not in df.columns:
+            continue
+        hr = df[col].to_numpy(dtype=np.float64)
+        valid = ~np.isnan(hr)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean_hr = (np.bincount(codes[valid], weights=hr[valid], minlength=len(names)) /
+                       np.bincount(codes[valid], minlength=len(names)))
+        hrr = (mean_hr - resting_hr) / (maximum_hr - resting_hr)
+        df_stress[col] = mean_hr
+        df_stress['TRIMP_points_' + col] = (counts / 60) * hrr * TRIMP_WEIGHT_FACTOR * np.exp(MALE * hrr)
+
+        # zone 1 to 5 (upper bound inclusive), 0 below the first zone and for missing values
+        zone = np.where(valid, np.searchsorted(bounds, np.where(valid, hr, 0), side='left'), 0)
+        df_stress['eTRIMP_' + col] = np.bincount(codes, weights=zone, minlength=len(names)) / 60
+
+    return df_stress
+
+
+@instrumented()
+def ride_training_stress(df, rider_params, ftp=None, hr_cols=('hr', 'pred_hr')):
+    '''
+    Returns the power based (xPower, NP, IF, TSS) and heart rate based (TRIMP, eTRIMP) training stress per ride
+
+            Parameters:
+                    df: pandas DataFrame with second by second 'watts', heart rate columns and 'filename'
+                    rider_params (dict): rider configuration with 'rider_min_hr' and 'rider_max_hr'
+                    ftp (float): functional threshold power, default = rider_params.get('rider_ftp')
+                    hr_cols (tuple): heart rate columns, default = ('hr', 'pred_hr')
+            Returns:
+                    df: pandas DataFrame with the training stress per ride
+    '''
+    ftp = ftp or rider_params.get('rider_ftp')
+    df_power = ride_power_stress(df, ftp=ftp)
+    df_hr = ride_hr_stress(df, rider_params, cols=hr_cols)
+    return df_power.merge(df_hr.drop(columns=['time_sec']), on='filename')
+
+
+class PMCState:
+    '''
+    Incrementally updated acute (ATL) and chronic (CTL) training load and the stress balance (TSB)
+
+            Parameters:
+                    date: last day included in the state, default = None (no history)
+                    atl (float): acute training load at the end of date
+                    ctl (float): chronic training load at the end of date
+                    load (float): training load of date itself, so later rides of the same day can be added
+    '''
+
+    def __init__(self, date=None, atl=0.0, ctl=0.0, load=0.0):
+        self.date = None if date is None else pd.Timestamp(date).normalize()
+        self.atl = float(atl)
+        self.ctl = float(ctl)
+        self.load = float(load)
+
+    def __repr__(self):
+        return 'PMCState(date={}, atl={:.1f}, ctl={:.1f})'.format(self.date, self.atl, self.ctl)
+
+    def save(self, path):
+        '''
+        Saves the state as json
+        '''
+        with open(path, 'w') as f:
+            json.dump({'date': None if self.date is None else str(self.date.date()), 'atl': self.atl,
+                       'ctl': self.ctl, 'load': self.load}, f, indent=1)
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Returns a PMCState saved with PMCState.save
+        '''
+        with open(path, 'r') as f:
+            return cls(**json.load(f))
+
+    def update(self, daily_load, until=None):
+        '''
+        Returns ATL, CTL and TSB for the new days and moves the state to the last day. Only the new days are
+        calculated. Rides of the last day of the state are added to that day
+
+                Parameters:
+                        daily_load: pandas Series with the training load (e.g. TSS) indexed by date, several values
+                                    per day are summed
+                        until: optional last day, e.g. today when the last days had no rides
+                Returns:
+                        df: pandas DataFrame with date, load, ATL, CTL and TSB (yesterday's CTL - ATL) per day
+        '''
+        daily_load = pd.Series(daily_load, dtype=np.float64)
+        daily_load.index = pd.DatetimeIndex(daily_load.index).normalize()
+        daily_load = daily_load.groupby(level=0).sum()
+
+        if self.date is not None and len(daily_load) and daily_load.index.min() < self.date:
+            raise ValueError('the state already includes the days up to {}, got load of {}'.format(
+                self.date.date(), daily_load.index.min().date()))
+
+        days = [d for d in [self.date, until and pd.Timestamp(until).normalize()] if d is not None]
+        days += list(daily_load.index[[0, -1]]) if len(daily_load) else []
+        if not days:
+            return pd.DataFrame(columns=['date', 'load', 'ATL', 'CTL', 'TSB'])
+        start = self.date if self.date is not None else min(days)
+        end = max(days)
+
+        days = pd.date_range(start, end, freq='D')
+        load = np.array(daily_load.reindex(days, fill_value=0.0), dtype=np.float64)
+
+        atl0, ctl0 = self.atl, self.ctl
+        if self.date is not None:
+            # the first day is the last day of the state: go back to the day before and add its earlier load
+            atl0, ctl0 = self._previous(self.atl, ATL_DAYS), self._previous(self.ctl, CTL_DAYS)
+            load[0] += self.load
+
+        atl = self._decay(load, atl0, ATL_DAYS)
+        ctl = self._decay(load, ctl0, CTL_DAYS)
+        tsb = np.concatenate([[ctl0 - atl0], ctl[:-1] - atl[:-1]])
+
+        self.date, self.atl, self.ctl, self.load = days[-1], float(atl[-1]), float(ctl[-1]), float(load[-1])
+
+        return pd.DataFrame({'date': days, 'load': load, 'ATL': atl, 'CTL': ctl, 'TSB': tsb})
+
+    def _previous(self, value, days):
+        # value of the day before the state date, without the load of the state date
+        k = 1 - np.exp(-1 / days)
+        return (value - k * self.load) / (1 - k)
+
+    @staticmethod
+    def _decay(load, initial, days):
+        # exponentially weighted load, value = value + (load - value) * (1 - exp(-1 / days)) per day
+        k = 1 - np.exp(-1 / days)
+        return lfilter([k], [1, -(1 - k)], load, zi=[(1 - k) * initial])[0]
+
+
+def pmc_history(daily_load, until=None):
+    '''
+    Returns ATL, CTL and TSB over the whole history and the state to update them incrementally afterwards
+
+            Parameters:
+                    daily_load: pandas Series with the training load (e.g. TSS) indexed by date
+                    until: optional last day, default = the last day with load
+            Returns:
+                    df: pandas DataFrame with date, load, ATL, CTL and TSB per day
+                    state: PMCState after the last day
+    '''
+    state = PMCState()
+    df_pmc = state.update(daily_load, until=until)
+    return df_pmc, state
@@ -0,0 +1,436 @@
+import re
+import json
+
+import numpy as np
+import pandas as pd
+
+try:
+    from numba import njit, prange
+except ImportError:
+    # without numba the trees are walked with the numpy engine, see TreeEnsemble.predict_raw
+    njit, prange = None, range
+
+# array backed tree ensembles for batch scoring. A trained LightGBM or XGBoost model is exported once to flat node
+# arrays (feature, threshold, children, leaf value) and saved as npz. With numba the rows are scored by a compiled
+# kernel, at about the speed of the native prediction of the model libraries. The numpy engine walks all trees at
+# once, level by level, and is a portability fallback: it is about 3 times slower than the native prediction
+
+# missing value handling of a node
+MISSING_NONE = 0 # missing values are treated as zero (LightGBM missing_type None)
+MISSING_ZERO = 1 # zero and missing values go to the default child (LightGBM missing_type Zero)
+MISSING_NAN = 2 # missing values go to the default child (LightGBM missing_type NaN, XGBoost)
+
+_LGB_MISSING_TYPES = {'None': MISSING_NONE, 'Zero': MISSING_ZERO, 'NaN': MISSING_NAN}
+# values LightGBM treats as zero
+_LGB_ZERO_THRESHOLD = 1e-35
+
+# objectives of which the prediction is the raw score (or its exponent)
+_IDENTITY_OBJECTIVES = ['regression', 'regression_l2', 'l2', 'mean_squared_error', 'mse', 'regression_l1', 'l1',
+                        'huber', 'fair', 'quantile', 'mape', 'reg:squarederror', 'reg:linear',
+                        'reg:absoluteerror', 'reg:pseudohubererror']
+_EXP_OBJECTIVES = ['poisson', 'gamma', 'tweedie', 'count:poisson', 'reg:gamma', 'reg:tweedie']
+
+ENGINES = ['numba', 'numpy']
+# rows of a block of the numba engine, every tree is walked for the whole block while its nodes are in cache
+_NUMBA_BLOCK = 1024
+
+
+def _score_blocks(X, roots, feature, threshold, strict, children, flags, value, base_score, out, block):
+    # flags of a node: -1 for leaves, otherwise bit 0 nan_left, bit 1 default_left and bit 2 zero_to_default
+    n_blocks = (X.shape[0] + block - 1) // block
+    for b in prange(n_blocks):
+        start = b * block
+        stop = min(start + block, X.shape[0])
+        for i in range(start, stop):
+            out[i] = base_score
+        for t in range(roots.shape[0]):
+            for i in range(start, stop):
+                node = roots[t]
+                while flags[node] >= 0:
+                    x = X[i, feature[node]]
+                    if np.isnan(x):
+                        go_left = flags[node] & 1
+                    elif flags[node] & 4 and abs(x) <= _LGB_ZERO_THRESHOLD:
+                        go_left = (flags[node] >> 1) & 1
+                    elif strict:
+                        go_left = x < threshold[node]
+                    else:
+                        go_left = x <= threshold[node]
+                    node = children[2 * node + go_left]
+                out[i] += value[node]
+
+
+_score_blocks_numba = njit(parallel=True, nogil=True, cache=True)(_score_blocks) if njit is not None else None
+
+
+class TreeEnsemble:
+    '''
+    Tree ensemble as flat node arrays. Node i of tree t is at roots[t] + i, leaves have left == -1
+
+            Parameters:
+                    arrays (dict): 'feature', 'threshold', 'left', 'right', 'default_left', 'missing_type',
+                                   'value' (leaf values) and 'roots'
+                    feature_names (list): names of the input columns in model order
+                    strict (bool): True for x < threshold (XGBoost), False for x <= threshold (LightGBM)
+                    base_score (float): score added to the sum of the leaves
+                    transform (str): 'identity' or 'exp' applied to the raw score
+    '''
+
+    def __init__(self, arrays, feature_names, strict=False, base_score=0.0, transform='identity'):
+        self.feature = np.asarray(arrays['feature'], dtype=np.int32)
+        self.threshold = np.asarray(arrays['threshold'], dtype=np.float64)
+        self.left = np.asarray(arrays['left'], dtype=np.int32)
+        self.right = np.asarray(arrays['right'], dtype=np.int32)
+        self.default_left = np.asarray(arrays['default_left'], dtype=bool)
+        self.missing_type = np.asarray(arrays['missing_type'], dtype=np.int8)
+        self.value = np.asarray(arrays['value'], dtype=np.float64)
+        self.roots = np.asarray(arrays['roots'], dtype=np.int32)
+        self.feature_names = list(feature_names)
+        self.strict = bool(strict)
+        self.base_score = float(base_score)
+        self.transform = transform
+
+        # children of every node as [right, left], so the next node is children[2 * node + go_left]
+        self.children = np.stack([self.right, self.left], axis=1).ravel()
+        # XGBoost thresholds in float32, LightGBM thresholds can be too large for it (and are not compared in float32)
+        self.threshold32 = self.threshold.astype(np.float32) if self.strict else None
+        # direction of a missing value: like zero for missing_type None, the default child otherwise
+        self.nan_left = np.where(self.missing_type == MISSING_NONE, 0.0 <= self.threshold, self.default_left)
+        self.zero_to_default = self.missing_type == MISSING_ZERO
+        self.has_zero_type = bool(self.zero_to_default.any())
+        # node flags of the numba engine, see _score_blocks
+        flags = self.nan_left.astype(np.int8) | (self.default_left.astype(np.int8) << 1)
+        flags |= self.zero_to_default.astype(np.int8) << 2
+        self.flags = np.where(self.left < 0, -1, flags).astype(np.int8)
+
+    def __repr__(self):
+        return 'TreeEnsemble(trees={}, nodes={})'.format(len(self.roots), len(self.feature))
+
+    def save(self, path):
+        '''
+        Saves the ensemble as a npz file
+        '''
+        meta = {'feature_names': self.feature_names, 'strict': self.strict, 'base_score': self.base_score,
+                'transform': self.transform}
+        np.savez(path, feature=self.feature, threshold=self.threshold, left=self.left, right=self.right,
+                            default_left=self.default_left, missing_type=self.missing_type, value=self.value,
+                            roots=self.roots, meta=np.array(json.dumps(meta)))
+
+    @classmethod
+    def load(cls, path):
+        '''
+        Returns a TreeEnsemble saved with TreeEnsemble.save
+        '''
+        with np.load(path) as data:
+            meta = json.loads(str(data['meta']))
+            arrays = {key: data[key] for key in data.files if key != 'meta'}
+        return cls(arrays, **meta)
+
+    def model_input(self, X):
+        '''
+        Returns X as float32 numpy array with the columns in model order. The columns of a pandas DataFrame are
+        selected by name, also when LightGBM replaced whitespace in the names by '_' (e.g. 'a b' -> 'a_b').
+        Only numpy arrays are taken in positional order
+
+                Parameters:
+                        X: pandas DataFrame or 2-D numpy array
+                Returns:
+                        float32 numpy array
+        '''
+        if not isinstance(X, pd.DataFrame):
+            return np.asarray(X, dtype=np.float32)
+
+        columns = list(X.columns)
+        sanitized = {}
+        for col in columns:
+            sanitized.setdefault(re.sub(r'\s', '_', str(col)), []).append(col)
+        selected, missing = [], []
+        for name in self.feature_names:
+            if name in columns:
+                selected.append(name)
+            elif len(sanitized.get(name, [])) == 1:
+                selected.append(sanitized[name][0])
+            else:
+                missing.append(name)
+        if missing:
+            raise ValueError('X should have the feature names of the model (or be a numpy array in model order), '
+                             'missing {}'.format(missing))
+        return X[selected].to_numpy(dtype=np.float32)
+
+    def predict_raw(self, X, chunksize=None, engine=None):
+        '''
+        Returns the raw score (sum of the leaf values and the base score) of every row
+
+                Parameters:
+                        X: pandas DataFrame with the feature names or 2-D numpy array with the columns in model
+                           order, converted to float32 (see model_input)
+                        chunksize (int): rows per step of the numpy engine, default keeps the rows x trees node
+                                         matrix at about 4M nodes
+                        engine (str): 'numba' (compiled, the default when numba is installed) or 'numpy'
+                                      (portability fallback, about 3 times slower than the model libraries)
+                Returns:
+                        numpy array with the float64 raw score per row
+        '''
+        engine = engine or ('numba' if njit is not None else 'numpy')
+        if engine not in ENGINES:
+            raise ValueError('engine should be one of {}, got {}'.format(ENGINES, engine))
+        if engine == 'numba' and njit is None:
+            raise ValueError('engine numba needs numba to be installed')
+
+        X = self.model_input(X)
+        if X.ndim != 2 or X.shape[1] != len(self.feature_names):
+            raise ValueError('X should have {} columns, got shape {}'.format(len(self.feature_names), X.shape))
+
+        if engine == 'numba':
+            out = np.empty(len(X), dtype=np.float64)
+            # XGBoost compares in float32
+            threshold = self.threshold32 if self.strict else self.threshold
+            _score_blocks_numba(np.ascontiguousarray(X), self.roots, self.feature, threshold, self.strict,
+                                self.children, self.flags, self.value, self.base_score, out, _NUMBA_BLOCK)
+            return out
+
+        n_trees = len(self.roots)
+        n_features = X.shape[1]
+        chunksize = chunksize or max(1, (1 << 22) // max(n_trees, 1))
+        out = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), chunksize):
+            block = np.ascontiguousarray(X[start:start + chunksize]).ravel()
+            has_nan = bool(np.isnan(block).any())
+            # current node of every (row, tree) pair, row major. Only pairs at an internal node are walked further
+            node = np.tile(self.roots, len(block) // max(n_features, 1))
+            pairs = np.flatnonzero(self.left[node] >= 0)
+            rows = pairs // n_trees
+            while len(pairs):
+                current = node[pairs]
+                x = block[rows * n_features + self.feature[current]]
+                if self.strict:
+                    # XGBoost compares in float32
+                    go_left = x < self.threshold32[current]
+                else:
+                    go_left = x <= self.threshold[current]
+                if has_nan:
+                    missing = np.isnan(x)
+                    go_left[missing] = self.nan_left[current[missing]]
+                if self.has_zero_type:
+                    zero = self.zero_to_default[current] & ((np.abs(x) <= _LGB_ZERO_THRESHOLD) | np.isnan(x))
+                    go_left[zero] = self.default_left[current[zero]]
+
+                following = self.children[2 * current + go_left]
+                node[pairs] = following
+                internal = self.left[following] >= 0
+                pairs = pairs[internal]
+                rows = rows[internal]
+            out[start:start + len(block) // max(n_features, 1)] = (
+                self.value[node].reshape(-1, n_trees).sum(axis=1) + self.base_score)
+        return out
+
+    def predict(self, X, chunksize=None, engine=None):
+        '''
+        Returns the prediction of every row, like the predict method of the model library (see predict_raw)
+        '''
+        raw = self.predict_raw(X, chunksize, engine)
+        return np.exp(raw) if self.transform == 'exp' else raw
+
+
+def _transform(objective):
+    objective = str(objective).split(' ')[0]
+    if objective in _IDENTITY_OBJECTIVES:
+        return 'identity'
+    if objective in _EXP_OBJECTIVES:
+        return 'exp'
+    raise ValueError('objective {} is not supported, only regression objectives'.format(objective))
+
+
+def _flatten(trees, node_fields, leaf_field):
+    # trees: nested dicts; node_fields(node) -> (feature, threshold, default_left, missing_type, children)
+    arrays = {key: [] for key in ['feature', 'threshold', 'left', 'right', 'default_left', 'missing_type', 'value']}
+    roots = []
+    for tree in trees:
+        roots.append(len(arrays['feature']))
+        # breadth first, so the nodes of a tree are stored level by level
+        queue = [(tree, None, None)]
+        while queue:
+            node, parent, side = queue.pop(0)
+            i = len(arrays['feature'])
+            if parent is not None:
+                arrays[side][parent] = i
+            for key in arrays:
+                arrays[key].append(0)
+            arrays['left'][i] = arrays['right'][i] = -1
+            if leaf_field in node:
+                arrays['value'][i] = node[leaf_field]
+                continue
+            feature, threshold, default_left, missing_type, (left, right) = node_fields(node)
+            arrays['feature'][i] = feature
+            arrays['threshold'][i] = threshold
+            arrays['default_left'][i] = default_left
+            arrays['missing_type'][i] = missing_type
+            queue += [(left, i, 'left'), (right, i, 'right')]
+    arrays['roots'] = roots
+    return {key: np.array(values) for key, values in arrays.items()}
+
+
+def from_lightgbm(model):
+    '''
+    Returns the TreeEnsemble of a LightGBM model
+
+            Parameters:
+                    model: lightgbm Booster or fitted LGBMRegressor
+            Returns:
+                    TreeEnsemble
+    '''
+    booster = getattr(model, 'booster_', model)
+    dump = booster.dump_model()
+    if dump.get('num_tree_per_iteration', 1) != 1:
+        raise ValueError('only models with one tree per iteration (regression) are supported')
+
+    def node_fields(node):
+        if node['decision_type'] != '<=':
+            raise ValueError('categorical splits are not supported')
+        return (node['split_feature'], node['threshold'], node['default_left'],
+                _LGB_MISSING_TYPES[node['missing_type']], (node['left_child'], node['right_child']))
+
+    trees = [tree['tree_structure'] for tree in dump['tree_info']]
+    arrays = _flatten(trees, node_fields, 'leaf_value')
+    return TreeEnsemble(arrays, dump['feature_names'], strict=False,
+                        transform=_transform(dump.get('objective', 'regression')))
+
+
+def from_xgboost(model):
+    '''
+    Returns the TreeEnsemble of an XGBoost model
+
+            Parameters:
+                    model: xgboost Booster or fitted XGBRegressor
+            Returns:
+                    TreeEnsemble
+    '''
+    booster = model.get_booster() if hasattr(model, 'get_booster') else model
+    config = json.loads(booster.save_config())
+    learner = config['learner']
+    # base_score is a string, in recent versions a vector like '[1.0E2]'
+    base_score = float(str(learner['learner_model_param']['base_score']).strip('[]').split(',')[0])
+    objective = learner['objective']['name']
+    if learner['gradient_booster'].get('name', 'gbtree') != 'gbtree':
+        raise ValueError('only gbtree boosters are supported')
+
+    feature_names = booster.feature_names or ['f{}'.format(i) for i in range(booster.num_features())]
+    index = {name: i for i, name in enumerate(feature_names)}
+
+    def node_fields(node):
+        children = {child['nodeid']: child for child in node['children']}
+        split = node['split']
+        feature = index[split] if split in index else int(str(split).lstrip('f'))
+        return (feature, node['split_condition'], node['missing'] == node['yes'], MISSING_NAN,
+                (children[node['yes']], children[node['no']]))
+
+    trees = [json.loads(tree) for tree in booster.get_dump(dump_format='json')]
+    arrays = _flatten(trees, node_fields, 'leaf')
+    transform = _transform(objective)
+    if transform == 'exp':
+        # the base score of log link objectives is on the response scale
+        base_score = np.log(base_score)
+    return TreeEnsemble(arrays, feature_names, strict=True, base_score=base_score, transform=transform)
+
+
+def export_tree_ensemble(model, path=None):
+    '''
+    Returns the TreeEnsemble of a LightGBM or XGBoost model and saves it when a path is given
+
+            Parameters:
+                    model: LightGBM or XGBoost booster or sklearn api model
+                    path (str): optional npz path
+            Returns:
+                    TreeEnsemble
+    '''
+    module = type(getattr(model, 'booster_', model)).__module__
+    ensemble = from_xgboost(model) if module.startswith('xgboost') else from_lightgbm(model)
+    if path is not None:
+        ensemble.save(path)
+    return ensemble
+
+
+def check_equivalence(model, X, ensemble=None, atol=1e-3, engine=None, verbose=True):
+    '''
+    Returns the largest absolute difference between the library predictions and the TreeEnsemble predictions,
+    raises an AssertionError when it is larger than atol
+
+            Parameters:
+                    model: LightGBM or XGBoost booster or sklearn api model
+                    X: pandas DataFrame or 2-D numpy array, in model order (see model_input) for both predictions
+                    ensemble: TreeEnsemble of the model, default exports the model
+                    atol (float): largest absolute difference allowed, default = 1e-3 (XGBoost sums in float32)
+                    engine (str): engine of the TreeEnsemble predictions (see predict_raw), default = fastest
+                    verbose (bool): print the difference
+            Returns:
+                    float: largest absolute difference
+    '''
+    ensemble = ensemble or export_tree_ensemble(model)
+    X = ensemble.model_input(X)
+
+    booster = getattr(model, 'booster_', model)
+    if type(booster).__module__.startswith('xgboost'):
+        import xgboost as xgb
+        booster = model.get_booster() if hasattr(model, 'get_booster') else model
+        expected = booster.predict(xgb.DMatrix(X, feature_names=booster.feature_names))
+    else:
+        expected = booster.predict(X)
+
+    predicted = ensemble.predict(X, engine=engine)
+    difference = float(np.max(np.abs(np.asarray(expected, dtype=np.float64) - predicted))) if len(X) else 0.0
+    if verbose:
+        print('Largest absolute difference with the library predictions{}: {:.3g}'.format(
+            '' if engine is None else ' ({} engine)'.format(engine), difference))
+    if difference > atol:
+        raise AssertionError('TreeEnsemble predictions differ up to {:.3g} from the library'.format(difference))
+    return difference
+
+
+def check_engines(n_rows=20000, seed=0, verbose=True):
+    '''
+    Fits small LightGBM and XGBoost models on data with missing and zero values and checks the predictions of all
+    available engines against the library predictions, raises an AssertionError on any difference beyond atol
+
+            Parameters:
+                    n_rows (int): number of training records, default = 20000
+                    seed (int): seed of the data, default = 0
+                    verbose (bool): print a line per model and engine
+            Returns:
+                    df: pandas DataFrame with the largest absolute difference per model and engine
+    '''
+    import lightgbm as lgb
+    import xgboost as xgb
+
+    rng = np.random.default_rng(seed)
+    X = pd.DataFrame(rng.normal(size=(n_rows, 8)).astype(np.float32), columns=['x{}'.format(i) for i in range(8)])
+    # zeros (for missing_type Zero) and missing values in every column
+    X = X.mask(rng.random(X.shape) < 0.1, 0.0).mask(rng.random(X.shape) < 0.05)
+    y = 3 * X['x0'].fillna(0) + np.sin(2 * X['x1'].fillna(0)) + (X['x2'] == 0) + X['x3'].isna() + \
+        rng.normal(0, 0.1, n_rows)
+
+    lgb_params = {'n_estimators': 50, 'num_leaves': 31, 'verbose': -1}
+    models = {'lightgbm': lgb.LGBMRegressor(**lgb_params),
+              'lightgbm zero_as_missing': lgb.LGBMRegressor(zero_as_missing=True, **lgb_params),
+              'lightgbm use_missing=False': lgb.LGBMRegressor(use_missing=False, **lgb_params),
+              'lightgbm poisson': lgb.LGBMRegressor(objective='poisson', **lgb_params),
+              'xgboost': xgb.XGBRegressor(n_estimators=50, max_depth=6)}
+    engines = ENGINES if njit is not None else ['numpy']
+
+    results = []
+    for name, model in models.items():
+        model.fit(X, np.exp(y / 4) if 'poisson' in name else y)
+        ensemble = export_tree_ensemble(model)
+        # XGBoost sums the leaves in float32
+        atol = 1e-3 if name == 'xgboost' else 1e-6
+        for engine in engines:
+            if verbose:
+                print('{}: '.format(name), end='')
+            results.append({'model': name, 'engine': engine,
+                            'difference': check_equivalence(model, X, ensemble, atol=atol, engine=engine,
+                                                            verbose=verbose)})
+    return pd.DataFrame(results)
+
+
+if __name__ == '__main__':
+    # check both engines against the library predictions
+    check_engines()